@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Benchmarks FilterList (/opt/dns-filter/server.py) at production list sizes.
+
+For every list size and index design it generates synthetic block lists (and
+caches them under --work-dir, as that is slow for the larger sizes), then in a
+fresh process per run measures:
+
+  - load time, building the index from the list files or mapping a snapshot
+  - peak RSS of that process
+  - is_blocked() latency percentiles over a Zipf distributed query stream
+
+Results can be saved as a baseline and later runs compared against it; the
+exit status is 1 if anything got slower or bigger by more than --tolerance.
+Baselines only mean something on the machine (and Python) that recorded them.
+
+    ./benchmarks/dns_filter.py --sizes 100k,1M --save-baseline
+    ./benchmarks/dns_filter.py --sizes 100k,1M
+"""
+
+import argparse
+import bisect
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'to_copy', 'opt',
+    'dns-filter'))
+
+from index import DomainIndex, DomainSet  # noqa: E402
+from server import FilterList, compile_snapshot  # noqa: E402
+
+
+DEFAULT_SIZES = '100k,1M,5M'
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'dns_filter_baseline.json')
+DESIGNS = ('set', 'index', 'snapshot')
+# the metrics compared against the baseline (lower is better for all of
+# them), with how much they may grow regardless of --tolerance, as e.g. the
+# time to map a snapshot is too small to compare in relative terms
+METRICS = (
+    ('load_s', 0.05),
+    ('peak_rss_mb', 2.0),
+    ('p50_us', 0.25),
+    ('p99_us', 0.5),
+)
+
+LABEL_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+TLDS = [
+    ('com', 40), ('net', 10), ('org', 8), ('ru', 6), ('info', 5), ('xyz', 5),
+    ('de', 4), ('co.uk', 3), ('top', 3), ('cn', 3), ('com.br', 2), ('io', 2),
+    ('tk', 2), ('online', 2), ('site', 2), ('biz', 1), ('pw', 1), ('cc', 1),
+]
+# extra labels in front of the registered domain, as seen in threat feeds
+SUBDOMAIN_DEPTHS = [(0, 55), (1, 28), (2, 11), (3, 4), (4, 2)]
+# relative sizes of the generated lists
+LISTS = [('security', 60), ('adult', 30), ('ads', 10)]
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    for suffix, factor in (('k', 10 ** 3), ('m', 10 ** 6)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def format_size(size):
+    if size % 10 ** 6 == 0:
+        return '%dM' % (size // 10 ** 6)
+    if size % 10 ** 3 == 0:
+        return '%dk' % (size // 10 ** 3)
+    return str(size)
+
+
+def _weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def _label(rng):
+    return ''.join(rng.choice(LABEL_CHARS) for _ in range(rng.randint(3, 15)))
+
+
+def synthetic_domain(rng):
+    labels = [_label(rng) for _ in range(_weighted(rng, SUBDOMAIN_DEPTHS))]
+    labels.append(_label(rng))
+    labels.append(_weighted(rng, TLDS))
+    return '.'.join(labels)
+
+
+def generate_lists(filters_dir, size, seed):
+    """
+    Writes `size` unique domains across the LISTS; returns them.
+    """
+    rng = random.Random(seed)
+    domains = set()
+    while len(domains) < size:
+        domains.add(synthetic_domain(rng))
+    domains = sorted(domains)
+    rng.shuffle(domains)
+    os.makedirs(filters_dir)
+    total = sum(weight for _, weight in LISTS)
+    start = 0
+    for number, (list_name, weight) in enumerate(LISTS):
+        end = size if number == len(LISTS) - 1 else \
+            start + size * weight // total
+        path = os.path.join(filters_dir, '%s.domains.blacklist' % list_name)
+        with open(path, 'w') as list_file:
+            list_file.write('\n'.join(domains[start:end]) + '\n')
+        start = end
+    return domains
+
+
+def query_stream(domains, count, hit_ratio, zipf_s, seed):
+    """
+    `count` names drawn with a Zipf distribution from a universe where a
+    `hit_ratio` share of names are (sub-domains of) listed domains.
+    """
+    rng = random.Random(seed)
+    universe = []
+    for _ in range(min(100000, max(1000, count // 2))):
+        if rng.random() < hit_ratio:
+            name = rng.choice(domains)
+            if rng.random() < 0.5:
+                name = _label(rng) + '.' + name
+        else:
+            name = synthetic_domain(rng)
+        universe.append(name)
+    cumulative = []
+    total = 0.0
+    for rank in range(1, len(universe) + 1):
+        total += 1.0 / rank ** zipf_s
+        cumulative.append(total)
+    return [
+        universe[min(bisect.bisect(cumulative, rng.random() * total),
+                     len(universe) - 1)]
+        for _ in range(count)
+    ]
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _measure(design, filters_dir, snapshot_path, queries):
+    started = time.perf_counter()
+    if design == 'set':
+        filter_list = FilterList(filters_dir, index_class=DomainSet)
+    elif design == 'index':
+        filter_list = FilterList(filters_dir, index_class=DomainIndex)
+    else:
+        filter_list = FilterList(filters_dir, snapshot_path=snapshot_path)
+        if filter_list.index.mapping is None:
+            raise RuntimeError("Snapshot %s is stale" % snapshot_path)
+    load_s = time.perf_counter() - started
+
+    is_blocked = filter_list.is_blocked
+    # fault in the pages the stream touches first, so runs compare steady
+    # states rather than how warm the page cache happened to be
+    for name in queries:
+        is_blocked(name)
+    clock = time.perf_counter
+    timings = []
+    blocked = 0
+    started = clock()
+    for name in queries:
+        before = clock()
+        if is_blocked(name):
+            blocked += 1
+        timings.append(clock() - before)
+    elapsed = clock() - started
+    timings.sort()
+    return {
+        'domains': len(filter_list.index),
+        'load_s': load_s,
+        'qps': len(queries) / elapsed,
+        'blocked_ratio': blocked / len(queries),
+        'p50_us': percentile(timings, 0.50) * 1e6,
+        'p90_us': percentile(timings, 0.90) * 1e6,
+        'p99_us': percentile(timings, 0.99) * 1e6,
+        'p999_us': percentile(timings, 0.999) * 1e6,
+    }
+
+
+def run_isolated(*args):
+    """
+    Runs this script with `--child args...` in a fresh interpreter, so the
+    peak RSS is that of the run alone; returns its results plus
+    'peak_rss_mb'.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--child'] + list(args),
+        stdout=subprocess.PIPE)
+    with proc.stdout:
+        output = proc.stdout.read()
+    # rather than proc.wait(), for the child's resource usage
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    if status:
+        raise RuntimeError("Benchmark process failed: %s" % ' '.join(args))
+    result = json.loads(output.decode('utf-8'))
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024.0
+    return result
+
+
+def child(args):
+    if args[0] == 'compile':
+        compile_snapshot(*args[1:])
+        result = {}
+    else:
+        design, filters_dir, snapshot_path, queries_path = args[1:]
+        with open(queries_path) as queries_file:
+            queries = queries_file.read().split('\n')
+        result = _measure(design, filters_dir, snapshot_path, queries)
+    print(json.dumps(result))
+    return 0
+
+
+def run(args):
+    results = {}
+    for size in args.sizes:
+        label = format_size(size)
+        filters_dir = os.path.join(args.work_dir, label)
+        snapshot_path = os.path.join(args.work_dir, '%s.snapshot' % label)
+        if os.path.isdir(filters_dir):
+            domains = []
+            for path in sorted(os.listdir(filters_dir)):
+                with open(os.path.join(filters_dir, path)) as list_file:
+                    domains.extend(line.strip() for line in list_file)
+        else:
+            log("Generating %s domains in %s" % (label, filters_dir))
+            domains = generate_lists(filters_dir, size, args.seed)
+        queries_path = os.path.join(args.work_dir, '%s.queries' % label)
+        with open(queries_path, 'w') as queries_file:
+            queries_file.write('\n'.join(query_stream(
+                domains, args.queries, args.hit_ratio, args.zipf_s,
+                args.seed)))
+        del domains
+        for design in args.designs:
+            if design == 'snapshot':
+                run_isolated('compile', filters_dir, snapshot_path)
+            key = '%s/%s' % (design, label)
+            log("Running %s" % key)
+            results[key] = run_isolated(
+                'measure', design, filters_dir, snapshot_path, queries_path)
+            report_line(key, results[key])
+    return results
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+
+def report_line(key, result):
+    print('%-16s load %7.2fs  rss %8.1fMB  p50 %6.2fus  p90 %6.2fus  '
+          'p99 %6.2fus  p99.9 %7.2fus  %8.0f q/s' % (
+              key, result['load_s'], result['peak_rss_mb'], result['p50_us'],
+              result['p90_us'], result['p99_us'], result['p999_us'],
+              result['qps']))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how results differ from the baseline; returns the regressions.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            print('%-16s no baseline' % key)
+            continue
+        changes = []
+        for metric, noise in METRICS:
+            before = baseline[key].get(metric)
+            after = results[key][metric]
+            if before is None:
+                continue
+            changes.append('%s %.2f -> %.2f' % (metric, before, after))
+            if after > before * (1 + tolerance) and after - before > noise:
+                regressions.append((key, metric, before, after))
+        print('%-16s %s' % (key, '  '.join(changes)))
+    for key, metric, before, after in regressions:
+        print('REGRESSION %s %s: %.2f -> %.2f' % (key, metric, before, after))
+    return regressions
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        return child(sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        description="Benchmark dns-filter list loading and lookups.")
+    parser.add_argument(
+        '--sizes', default=DEFAULT_SIZES,
+        help="list sizes to test, e.g. 100k,1M (default: %(default)s)")
+    parser.add_argument(
+        '--designs', default=','.join(DESIGNS),
+        help="index designs to test, of %s (default: all)" % ', '.join(
+            DESIGNS))
+    parser.add_argument(
+        '--queries', type=int, default=200000,
+        help="queries per run (default: %(default)s)")
+    parser.add_argument(
+        '--hit-ratio', type=float, default=0.05,
+        help="share of distinct queried names that are listed "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--zipf-s', type=float, default=1.1,
+        help="Zipf exponent of the query stream (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--work-dir', default='/tmp/dns-filter-bench',
+        help="where generated lists are kept (default: %(default)s)")
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE,
+        help="baseline file (default: %(default)s)")
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help="store these results as the baseline rather than comparing")
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help="allowed slowdown or growth before it is a regression "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+    args.sizes = [parse_size(size) for size in args.sizes.split(',')]
+    args.designs = args.designs.split(',')
+    for design in args.designs:
+        if design not in DESIGNS:
+            parser.error("Unknown design: %s" % design)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        log("Saved baseline to %s" % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        log("No baseline at %s; run with --save-baseline to store one"
+            % args.baseline)
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    return 1 if compare(results, baseline, args.tolerance) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
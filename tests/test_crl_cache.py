@@ -0,0 +1,214 @@
+"""
+Tests for the CRL cache (/usr/bin/crl_cache.py), against CRLs made with
+`openssl ca` and served from a local HTTP stand-in.
+
+    python3 -m unittest discover tests
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from subprocess import DEVNULL, check_call
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'to_copy', 'usr',
+    'bin'))
+
+import crl_cache  # noqa: E402
+from cert_sessions import normalize_serial  # noqa: E402
+from crl_cache import (  # noqa: E402
+    CHANGED, FAILED, FRESH, NOT_MODIFIED, UNCHANGED, CRLCache)
+
+
+CA_CONFIG = """\
+[ca]
+default_ca = test_ca
+
+[test_ca]
+database = %(dir)s/index.txt
+crlnumber = %(dir)s/crlnumber
+default_md = sha256
+default_crl_days = 1
+"""
+REVOKED_SERIAL = '0A'
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+class ScratchCA:
+    """
+    A CA that issues CRLs revoking the serials it is given.
+    """
+    def __init__(self, ca_dir):
+        self.dir = ca_dir
+        self.config = os.path.join(ca_dir, 'ca.cnf')
+        with open(self.config, 'w') as config_file:
+            config_file.write(CA_CONFIG % {'dir': ca_dir})
+        with open(os.path.join(ca_dir, 'crlnumber'), 'w') as crlnumber:
+            crlnumber.write('01\n')
+        self._openssl('req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                      'ec_paramgen_curve:prime256v1', '-nodes', '-days', '2',
+                      '-subj', '/CN=Test CA', '-keyout', 'ca.key',
+                      '-out', 'ca.crt')
+
+    def _openssl(self, *args):
+        check_call(('openssl',) + args, cwd=self.dir, stdout=DEVNULL,
+                   stderr=DEVNULL)
+
+    def crl(self, revoked=()):
+        with open(os.path.join(self.dir, 'index.txt'), 'w') as index:
+            for serial in revoked:
+                index.write('R\t301231235959Z\t240101000000Z\t%s\tunknown\t'
+                            '/CN=client %s\n' % (serial, serial))
+        self._openssl('ca', '-config', self.config, '-gencrl',
+                      '-keyfile', 'ca.key', '-cert', 'ca.crt',
+                      '-out', 'crl.pem')
+        with open(os.path.join(self.dir, 'crl.pem'), 'rb') as crl_file:
+            return crl_file.read()
+
+
+class CRLHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.crls, path -> (body, ETag), honouring If-None-Match, and
+    records the headers of each request in server.requests.
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.crls:
+            self.send_error(404)
+            return
+        body, etag = self.server.crls[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CRLCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ca_dir = tempfile.mkdtemp()
+        ca = ScratchCA(cls.ca_dir)
+        cls.empty_crl = ca.crl()
+        cls.revoking_crl = ca.crl([REVOKED_SERIAL])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.ca_dir)
+
+    def setUp(self):
+        self.pki_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pki_dir)
+        self.server = HTTPServer(('127.0.0.1', 0), CRLHandler)
+        self.server.crls = {}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.cache = CRLCache(self.pki_dir)
+        os.makedirs(self.cache.cache_dir)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def list_urls(self, *paths):
+        with open(os.path.join(self.pki_dir, crl_cache.URL_FILE), 'w') as f:
+            f.write(''.join(self.url(path) + '\n' for path in paths))
+
+    def read(self, name):
+        with open(os.path.join(self.pki_dir, name)) as in_file:
+            return in_file.read()
+
+    def refresh(self, now):
+        self.server.requests = []
+        changed, outcomes = self.cache.refresh(now)
+        return changed, [outcome for _, outcome, _ in outcomes]
+
+    def test_conditional_refreshes(self):
+        self.server.crls['/ca.crl'] = (self.empty_crl, '"v1"')
+        self.list_urls('/ca.crl')
+        now = time.time()
+
+        self.assertEqual(self.refresh(now), (True, [CHANGED]))
+        self.assertEqual(self.read(crl_cache.SERIALS_FILE), '')
+        self.assertIn(crl_cache.PEM_BEGIN, self.read(crl_cache.CRLS_PEM))
+
+        # nextUpdate is a day off: not asked for again for MAX_AGE
+        self.assertEqual(self.refresh(now + 60), (False, [FRESH]))
+        self.assertEqual(self.server.requests, [])
+
+        now += crl_cache.MAX_AGE + 1
+        self.assertEqual(self.refresh(now), (False, [NOT_MODIFIED]))
+        (_, headers), = self.server.requests
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], LAST_MODIFIED)
+
+        # served again, but the same CRL
+        self.server.crls['/ca.crl'] = (self.empty_crl, '"v2"')
+        now += crl_cache.MAX_AGE + 1
+        self.assertEqual(self.refresh(now), (False, [UNCHANGED]))
+
+        self.server.crls['/ca.crl'] = (self.revoking_crl, '"v3"')
+        now += crl_cache.MAX_AGE + 1
+        self.assertEqual(self.refresh(now), (True, [CHANGED]))
+        self.assertEqual(self.read(crl_cache.SERIALS_FILE),
+                         normalize_serial(REVOKED_SERIAL) + '\n')
+        self.assertEqual(self.cache.serials(),
+                         {normalize_serial(REVOKED_SERIAL)})
+
+    def test_failed_fetch_keeps_the_cached_crl(self):
+        self.server.crls['/ca.crl'] = (self.revoking_crl, '"v1"')
+        self.list_urls('/ca.crl')
+        now = time.time()
+        self.assertEqual(self.refresh(now), (True, [CHANGED]))
+        crls_pem = self.read(crl_cache.CRLS_PEM)
+
+        del self.server.crls['/ca.crl']
+        now += crl_cache.MAX_AGE + 1
+        self.assertEqual(self.refresh(now), (False, [FAILED]))
+        self.assertEqual(self.read(crl_cache.CRLS_PEM), crls_pem)
+
+    def test_crl_never_fetched_leaves_the_files(self):
+        for name in (crl_cache.CRLS_PEM, crl_cache.SERIALS_FILE):
+            with open(os.path.join(self.pki_dir, name), 'w') as out_file:
+                out_file.write('from cloak-server\n')
+        self.server.crls['/ca.crl'] = (self.empty_crl, '"v1"')
+        self.list_urls('/ca.crl', '/down.crl')
+        self.assertEqual(self.refresh(time.time()),
+                         (False, [CHANGED, FAILED]))
+        self.assertEqual(self.read(crl_cache.CRLS_PEM), 'from cloak-server\n')
+        self.assertEqual(self.read(crl_cache.SERIALS_FILE),
+                         'from cloak-server\n')
+
+    def test_crls_reread_only_on_change(self):
+        reloads = os.path.join(self.pki_dir, 'reloads')
+        self.addCleanup(setattr, crl_cache, 'RELOAD_COMMANDS',
+                        crl_cache.RELOAD_COMMANDS)
+        crl_cache.RELOAD_COMMANDS = [['sh', '-c', 'echo >> ' + reloads]]
+        self.server.crls['/ca.crl'] = (self.empty_crl, '"v1"')
+        self.list_urls('/ca.crl')
+        args = ['refresh', '--pki-dir', self.pki_dir]
+
+        self.assertEqual(crl_cache.main(args), 0)
+        self.assertEqual(self.read('reloads'), '\n')
+        self.assertEqual(crl_cache.main(args), 0)
+        self.assertEqual(self.read('reloads'), '\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests for the IP list index of dns-filter (/opt/dns-filter/ip_index.py).
+
+    python3 -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'to_copy', 'opt',
+    'dns-filter'))
+
+from ip_filter import parse_network  # noqa: E402
+from ip_index import IPIndex  # noqa: E402
+
+
+SHARED_BIT = 1 << 63
+
+
+def address(text):
+    return parse_network(text)[0]
+
+
+class IPIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.filters_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.filters_dir)
+
+    def write_list(self, list_name, networks):
+        path = os.path.join(self.filters_dir, list_name + '.ips.blacklist')
+        with open(path, 'w') as list_file:
+            list_file.write(''.join(network + '\n' for network in networks))
+
+    def load(self, bits):
+        return IPIndex.load(self.filters_dir, bits.__getitem__)
+
+    def test_lists_on_their_own_bits(self):
+        self.write_list('a', ['10.0.0.0/24'])
+        self.write_list('b', ['10.0.0.0/16'])
+        index = self.load({'a': 1, 'b': 2})
+        self.assertEqual(index.match(address('10.0.0.5')), 3)
+        self.assertEqual(index.match(address('10.0.5.5')), 2)
+        self.assertEqual(index.match(address('10.1.0.0')), 0)
+        self.assertEqual(index.match(address('9.255.255.255')), 0)
+
+    def test_overlapping_lists_on_a_shared_bit(self):
+        self.write_list('a', ['10.0.0.0/24'])
+        self.write_list('b', ['10.0.0.0/16'])
+        self.write_list('c', ['10.0.255.0/24', '10.2.0.0/16'])
+        index = self.load({'a': SHARED_BIT, 'b': SHARED_BIT, 'c': SHARED_BIT})
+        for text in ('10.0.0.0', '10.0.0.5', '10.0.0.255', '10.0.5.5',
+                     '10.0.255.255', '10.2.3.4'):
+            self.assertEqual(index.match(address(text)), SHARED_BIT, text)
+        for text in ('9.255.255.255', '10.1.0.0', '10.3.0.0'):
+            self.assertEqual(index.match(address(text)), 0, text)
+
+    def test_adjacent_lists_on_a_shared_bit(self):
+        self.write_list('a', ['10.0.0.0/24'])
+        self.write_list('b', ['10.0.1.0/24'])
+        index = self.load({'a': SHARED_BIT, 'b': SHARED_BIT})
+        self.assertEqual(index.match(address('10.0.0.255')), SHARED_BIT)
+        self.assertEqual(index.match(address('10.0.1.0')), SHARED_BIT)
+        self.assertEqual(index.match(address('10.0.2.0')), 0)
+
+    def test_range_up_to_the_end_of_the_address_space(self):
+        self.write_list('a', ['255.255.255.0/24'])
+        index = self.load({'a': 1})
+        self.assertEqual(index.match(address('255.255.255.255')), 1)
+        self.assertEqual(index.match(address('255.255.254.255')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
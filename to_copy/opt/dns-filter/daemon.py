@@ -24,20 +24,66 @@ Changes:        23rd Jan 2009 (David Mytton <david@boxedice.com>)
 '''
 
 # Core modules
+from contextlib import closing
 import atexit
 import errno
 import os
+import select
 import signal
+import socket
 import sys
 import time
 
 
+# how long start() waits for the daemon to report it is ready
+START_TIMEOUT = 300
+# how long a daemon that drains() has to see its clients off, and how long
+# stop() gives it before resorting to SIGKILL
+DRAIN_TIMEOUT = 5
+STOP_TIMEOUT = DRAIN_TIMEOUT + 5
+# and how long it waits for it to die after that
+KILL_TIMEOUT = 5
+
+# passed to a replacement by start_replacement()
+LISTEN_FD_ENV = 'DAEMON_LISTEN_FD'
+READY_FD_ENV = 'DAEMON_READY_FD'
+
+
+def has_exited(pid):
+    """
+    Whether the process is gone, or a zombie: in a container whose PID 1
+    doesn't reap, one we didn't start may never be.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as stat_file:
+            # the state follows the command name, in parentheses
+            return stat_file.read().rpartition(')')[2].split()[0] == 'Z'
+    except FileNotFoundError:
+        return True
+
+
 class Daemon:
     """
     A generic daemon class.
 
     Usage: subclass the Daemon class and override the run() method
+
+    start() returns once the daemon is ready, which is as soon as run() is
+    called, unless the subclass sets `reports_ready` and calls notify_ready()
+    itself (e.g. once it has loaded what it serves).
+
+    A subclass that `drains` is not exited on SIGTERM: daemon_alive turns
+    False, and run() has until drain_deadline to finish what it is doing.
+
+    A subclass that `hands_off` has handoff_requested set on SIGUSR2, and
+    then passes its listening socket to start_replacement(), carrying on
+    until replacement_ready(); restart() does this rather than a stop() and
+    start(), so the socket keeps accepting throughout.
     """
+    reports_ready = False
+    drains = False
+    hands_off = False
+
     def __init__(self, pidfile, stdin=os.devnull,
                  stdout=os.devnull, stderr=os.devnull,
                  home_dir='.', umask=0o22, verbose=1,
@@ -52,6 +98,15 @@ class Daemon:
         self.daemon_alive = True
         self.use_gevent = use_gevent
         self.use_eventlet = use_eventlet
+        self.drain_deadline = None
+        self.handoff_requested = False
+        # our end of the pipe start() (or the daemon we replace) waits on
+        self.ready_fd = None
+        self.replacing = False
+        # (pid, ready pipe) of our replacement while it starts
+        self.replacement = None
+        # run again by start_replacement(), before anything chdir()s
+        self.command = [sys.executable, os.path.abspath(sys.argv[0]), 'start']
 
     def log(self, *args):
         if self.verbose >= 1:
@@ -66,15 +121,20 @@ class Daemon:
         if self.use_eventlet:
             import eventlet.tpool
             eventlet.tpool.killall()
+        # the first parent exits once we are ready, see notify_ready()
+        ready_r, ready_w = os.pipe()
         try:
             pid = os.fork()
             if pid > 0:
                 # Exit first parent
-                sys.exit(0)
+                os.close(ready_w)
+                sys.exit(self._wait_ready(ready_r))
         except OSError as e:
             sys.stderr.write(
                 "fork #1 failed: %d (%s)\n" % (e.errno, e.strerror))
             sys.exit(1)
+        os.close(ready_r)
+        self.ready_fd = ready_w
 
         # Decouple from parent environment
         os.chdir(self.home_dir)
@@ -110,26 +170,160 @@ class Daemon:
             os.dup2(so.fileno(), sys.stdout.fileno())
             os.dup2(se.fileno(), sys.stderr.fileno())
 
-        def sigtermhandler(signum, frame):
-            self.daemon_alive = False
-            sys.exit()
+        self._install_signal_handlers()
+
+        self.log("Started")
+
+        # Write pidfile
+        atexit.register(
+            self.delpid)  # Make sure pid file is removed if we quit
+        self._write_pid()
 
+    def _install_signal_handlers(self):
         if self.use_gevent:
             import gevent
             gevent.reinit()
-            gevent.signal(signal.SIGTERM, sigtermhandler, signal.SIGTERM, None)
-            gevent.signal(signal.SIGINT, sigtermhandler, signal.SIGINT, None)
+            gevent.signal(signal.SIGTERM, self._on_stop_signal,
+                          signal.SIGTERM, None)
+            gevent.signal(signal.SIGINT, self._on_stop_signal,
+                          signal.SIGINT, None)
         else:
-            signal.signal(signal.SIGTERM, sigtermhandler)
-            signal.signal(signal.SIGINT, sigtermhandler)
+            signal.signal(signal.SIGTERM, self._on_stop_signal)
+            signal.signal(signal.SIGINT, self._on_stop_signal)
+        if self.hands_off:
+            signal.signal(signal.SIGUSR2, self._on_handoff_signal)
+
+    def _on_stop_signal(self, signum, frame):
+        # a second one doesn't wait for the drain
+        if not self.drains or not self.daemon_alive:
+            self.daemon_alive = False
+            sys.exit()
+        self.stop_serving()
 
-        self.log("Started")
+    def _on_handoff_signal(self, signum, frame):
+        self.handoff_requested = True
 
-        # Write pidfile
-        atexit.register(
-            self.delpid)  # Make sure pid file is removed if we quit
-        pid = str(os.getpid())
-        open(self.pidfile, 'w+').write("%s\n" % pid)
+    def stop_serving(self):
+        """
+        Has run() drain and return, as on SIGTERM.
+        """
+        if self.daemon_alive:
+            self.daemon_alive = False
+            self.drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+
+    def drain_expired(self):
+        return self.drain_deadline is not None and \
+            time.monotonic() >= self.drain_deadline
+
+    def _write_pid(self):
+        tmp_path = '%s.%d.tmp' % (self.pidfile, os.getpid())
+        with open(tmp_path, 'w') as pf:
+            pf.write("%s\n" % os.getpid())
+        # in one go, as whoever is waiting on a replacement polls it
+        os.rename(tmp_path, self.pidfile)
+
+    def _wait_ready(self, ready_r, timeout=START_TIMEOUT):
+        """
+        Waits for the daemon to report it is ready; returns an exit status.
+        """
+        with os.fdopen(ready_r, 'rb', 0) as ready:
+            readable, _, _ = select.select([ready], [], [], timeout)
+            if not readable:
+                sys.stderr.write("Not ready after %ds\n" % timeout)
+                return 1
+            if not ready.read(1):
+                sys.stderr.write("Failed to start\n")
+                return 1
+        self.log("Ready")
+        return 0
+
+    def notify_ready(self):
+        """
+        Reports that we are serving: to start() (or the daemon we replace),
+        through the pidfile if we are a replacement, and to systemd (or
+        anything else speaking its protocol) if NOTIFY_SOCKET is set.
+        """
+        if self.replacing:
+            # we're the one to stop from now on
+            self._write_pid()
+        if self.ready_fd is not None:
+            try:
+                os.write(self.ready_fd, b'R')
+            except OSError:
+                pass  # nobody is waiting any more
+            os.close(self.ready_fd)
+            self.ready_fd = None
+        notify_socket = os.environ.get('NOTIFY_SOCKET')
+        if notify_socket:
+            if notify_socket.startswith('@'):
+                notify_socket = '\0' + notify_socket[1:]
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            with closing(sock):
+                try:
+                    sock.sendto(b'READY=1\nMAINPID=%d' % os.getpid(),
+                                notify_socket)
+                except OSError as err:
+                    self.log("Failed to notify %s: %s" % (notify_socket, err))
+
+    def inherited_socket(self, family, type):
+        """
+        The listening socket handed to us by the daemon we replace, if any.
+        """
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if fd is None:
+            return None
+        os.set_inheritable(int(fd), False)
+        return socket.socket(family, type, 0, int(fd))
+
+    def start_replacement(self, sock):
+        """
+        Starts a new copy of the daemon that takes over the listening socket
+        `sock` as it is, so connections keep being accepted. Returns a file
+        descriptor that turns readable once it is ready or has failed, see
+        replacement_ready().
+        """
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(sock.fileno())
+        env[READY_FD_ENV] = str(ready_w)
+        os.set_inheritable(sock.fileno(), True)
+        os.set_inheritable(ready_w, True)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.execve(self.command[0], self.command, env)
+                finally:
+                    os._exit(127)
+        finally:
+            os.close(ready_w)
+            os.set_inheritable(sock.fileno(), False)
+        os.set_blocking(ready_r, False)
+        self.replacement = (pid, ready_r)
+        self.log("Started replacement (pid %d)" % pid)
+        return ready_r
+
+    def replacement_ready(self):
+        """
+        True once the replacement is ready, False if it has failed, None
+        while it is starting.
+        """
+        pid, ready_r = self.replacement
+        try:
+            ready = os.read(ready_r, 1)
+        except (BlockingIOError, InterruptedError):
+            return None
+        os.close(ready_r)
+        self.replacement = None
+        if ready:
+            self.log("Replacement (pid %d) is ready" % pid)
+            return True
+        self.log("Replacement (pid %d) failed to start" % pid)
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+        return False
 
     def delpid(self):
         try:
@@ -150,23 +344,27 @@ class Daemon:
 
         self.log("Starting...")
 
-        # Check for a pidfile to see if the daemon already runs
-        try:
-            pf = open(self.pidfile, 'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
-        except SystemExit:
-            pid = None
+        if READY_FD_ENV in os.environ:
+            # we're replacing a running daemon, so we already are one; the
+            # pidfile is ours once we're ready
+            self.ready_fd = int(os.environ.pop(READY_FD_ENV))
+            os.set_inheritable(self.ready_fd, False)
+            self.replacing = True
+            self._install_signal_handlers()
+            atexit.register(self.delpid)
+        else:
+            # Check for a pidfile to see if the daemon already runs
+            pid = self.get_pid()
 
-        if pid:
-            message = "pidfile %s already exists. Is it already running?\n"
-            sys.stderr.write(message % self.pidfile)
-            sys.exit(1)
+            if pid:
+                message = "pidfile %s already exists. Is it already running?\n"
+                sys.stderr.write(message % self.pidfile)
+                sys.exit(1)
 
-        # Start the daemon
-        self.daemonize()
+            # Start the daemon
+            self.daemonize()
+        if not self.reports_ready:
+            self.notify_ready()
         self.run(*args, **kwargs)
 
     def stop(self):
@@ -191,22 +389,30 @@ class Daemon:
 
             return  # Not an error in a restart
 
-        # Try killing the daemon process
+        # Try killing the daemon process, giving it time to drain
         try:
-            i = 0
-            while 1:
-                os.kill(pid, signal.SIGTERM)
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + STOP_TIMEOUT
+            killed = False
+            while not has_exited(pid):
                 time.sleep(0.1)
-                i = i + 1
-                if i % 10 == 0:
-                    os.kill(pid, signal.SIGHUP)
+                if time.monotonic() < deadline:
+                    continue
+                if killed:
+                    sys.stderr.write("pid %d still running after SIGKILL\n"
+                                     % pid)
+                    sys.exit(1)
+                self.log("Still running after %ds; killing it" %
+                         STOP_TIMEOUT)
+                os.kill(pid, signal.SIGKILL)
+                killed = True
+                deadline = time.monotonic() + KILL_TIMEOUT
         except OSError as err:
-            if err.errno == errno.ESRCH:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
+            if err.errno != errno.ESRCH:
                 print(str(err))
                 sys.exit(1)
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
 
         self.log("Stopped")
 
@@ -214,15 +420,56 @@ class Daemon:
         """
         Restart the daemon
         """
+        if self.hands_off:
+            self.replace()
+            return
         self.stop()
         self.start()
 
+    def replace(self, timeout=START_TIMEOUT):
+        """
+        Has the running daemon start its replacement, returning once that is
+        ready (and the old one draining), or starts one if none is running.
+        If it dies instead, or no replacement is ready in time, a new one is
+        started the plain way.
+        """
+        pid = self.get_pid()
+        if not pid or has_exited(pid):
+            self._start_afresh()
+            return
+
+        self.log("Replacing pid %d..." % pid)
+        os.kill(pid, signal.SIGUSR2)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            # before the pidfile, which its replacement writes first
+            exited = has_exited(pid)
+            new_pid = self.get_pid()
+            if new_pid and new_pid != pid:
+                self.log("Replaced by pid %d" % new_pid)
+                return
+            if exited:
+                # e.g. one from before SIGUSR2 handed off, which it kills
+                sys.stderr.write("pid %d exited without a replacement\n"
+                                 % pid)
+                self._start_afresh()
+                return
+        sys.stderr.write("pid %d was not replaced; restarting it\n" % pid)
+        self.stop()
+        self.start()
+
+    def _start_afresh(self):
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
+        self.start()
+
     def get_pid(self):
         try:
             pf = open(self.pidfile, 'r')
             pid = int(pf.read().strip())
             pf.close()
-        except IOError:
+        except (IOError, ValueError):
             pid = None
         except SystemExit:
             pid = None
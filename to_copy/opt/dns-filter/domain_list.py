@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Normalizes and merges domain names into the `*.domains.blacklist` files.
+
+Names are read a line at a time, lowercased, IDNA encoded (a list may name
+`bücher.example`; resolvers ask for `xn--bcher-kva.example`), stripped of
+their trailing dot and validated. A name already on the list, or whose parent
+domain is, is dropped: the daemon blocks every subdomain of a listed domain
+anyway, so it would only take up memory.
+
+To find those, names are sorted by their labels in reverse, joined by a space
+(which sorts before any character a label may hold), so that every domain is
+directly followed by its subdomains.
+"""
+
+import io
+import os
+import sys
+
+from index import MAX_LISTS
+from ip_filter import parse_network
+from journal import DOMAIN_RE, LIST_NAME_RE, has_room_for, lock_lists
+
+
+FILTERS_DIR = "/etc/encryptme/filters"
+LIST_SUFFIX = '.domains.blacklist'
+MAX_NAME_LENGTH = 253
+MAX_LABEL_LENGTH = 63
+
+
+class Counts:
+    """
+    What became of the names read.
+    """
+    def __init__(self):
+        self.read = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.covered = 0
+
+    def __str__(self):
+        return "%d names read, %d invalid, %d duplicates, %d covered by " \
+            "a parent domain" % (
+                self.read, self.invalid, self.duplicates, self.covered)
+
+
+def normalize(name):
+    """
+    The name as the lists store it, or None if it isn't a valid one.
+    """
+    name = name.lower().rstrip('.')
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        try:
+            name = name.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+    if len(name) > MAX_NAME_LENGTH or not DOMAIN_RE.match(name):
+        return None
+    if len(name) > MAX_LABEL_LENGTH:
+        for label in name.split('.'):
+            if len(label) > MAX_LABEL_LENGTH:
+                return None
+    return name
+
+
+def _key(name):
+    return ' '.join(reversed(name.split('.')))
+
+
+def _name(key):
+    return '.'.join(reversed(key.split(' ')))
+
+
+def read_keys(lines, counts, keys=None):
+    """
+    Normalizes the names, one per line, appending their sort keys to `keys`
+    (a new list by default), which is returned. IPv4 networks are skipped
+    without being counted, as lists mix both.
+    """
+    if keys is None:
+        keys = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name = normalize(line)
+        if name is None:
+            if parse_network(line) is None:
+                counts.read += 1
+                counts.invalid += 1
+            continue
+        counts.read += 1
+        keys.append(_key(name))
+    return keys
+
+
+def collapse(keys, counts):
+    """
+    Returns the names left once duplicates and names covered by a parent
+    domain are dropped, sorted. Sorts `keys` in place.
+    """
+    keys.sort()
+    kept = []
+    last = subdomains = None
+    for key in keys:
+        if key == last:
+            counts.duplicates += 1
+        elif subdomains is not None and key.startswith(subdomains):
+            counts.covered += 1
+        else:
+            kept.append(key)
+            last, subdomains = key, key + ' '
+    return sorted(_name(key) for key in kept)
+
+
+def list_path(filters_dir, list_name):
+    return os.path.join(filters_dir, list_name + LIST_SUFFIX)
+
+
+def write_list(path, names):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as list_file:
+            for name in names:
+                list_file.write(name + '\n')
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def add(filters_dir, list_name, lines):
+    """
+    Merges the names into a list, rewriting it; returns the Counts of the
+    names read and the list's size before and after.
+    """
+    path = list_path(filters_dir, list_name)
+    counts = Counts()
+    # before taking the lock, as reading them (from stdin) may be slow
+    new_keys = read_keys(lines, counts)
+    # so a compaction of the journal doesn't rewrite it at the same time
+    with lock_lists(filters_dir):
+        keys = []
+        try:
+            with _open(path) as list_file:
+                # counted apart, so the counts describe what was read in
+                read_keys(list_file, Counts(), keys)
+        except FileNotFoundError:
+            pass
+        before = len(keys)
+        keys.extend(new_keys)
+        names = collapse(keys, counts)
+        write_list(path, names)
+    return counts, before, len(names)
+
+
+def _open(path):
+    # whatever the locale, so IDNs come through; anything else is invalid
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def _stdin():
+    return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8',
+                            errors='replace')
+
+
+def _lines(paths):
+    for path in paths:
+        if path == '-':
+            for line in _stdin():
+                yield line
+            continue
+        with _open(path) as list_file:
+            for line in list_file:
+                yield line
+
+
+def main(args):
+    command = args[0] if args else None
+    if command == 'add':
+        if len(args) < 2:
+            command = None
+        elif not LIST_NAME_RE.match(args[1]):
+            sys.stderr.write("Invalid list name: %s\n" % args[1])
+            return 2
+    elif len(args) != 1:
+        command = None
+    if command not in ('add', 'normalize'):
+        sys.stderr.write("usage: %s add LIST [FILE...]|normalize\n"
+                         % sys.argv[0])
+        return 2
+    try:
+        if command == 'add':
+            if not has_room_for(FILTERS_DIR, args[1]):
+                sys.stderr.write("Too many lists (at most %d), not adding %s\n"
+                                 % (MAX_LISTS, args[1]))
+                return 1
+            if not os.path.isdir(FILTERS_DIR):
+                os.makedirs(FILTERS_DIR)
+            # FILEs, or stdin
+            counts, before, after = add(
+                FILTERS_DIR, args[1], _lines(args[2:] or ['-']))
+            print("%s: %d names, was %d (%s)" % (
+                args[1], after, before, counts))
+        else:
+            # stdin to stdout, for deltas; stdout is for the names
+            counts = Counts()
+            for name in collapse(read_keys(_stdin(), counts), counts):
+                sys.stdout.write(name + '\n')
+            sys.stderr.write("Normalized: %s\n" % counts)
+    except OSError as err:
+        sys.stderr.write("%s\n" % err)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
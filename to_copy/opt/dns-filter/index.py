@@ -0,0 +1,293 @@
+"""
+Domain indexes used by FilterList.
+
+Both answer "which lists is this name, or any of its parent domains, on?" (the
+bare TLD is never matched). Every entry carries a bitmask of the lists it came
+from, bit i standing for `index.lists[i]`, and lookups return the union of the
+masks of every matching suffix, or 0 for no match.
+
+DomainSet keeps a Python set of strings, as FilterList always did. It is fast
+but every entry is a full `str` object plus a set slot, which adds up to
+gigabytes of RSS with multi-million entry threat lists.
+
+DomainIndex stores all names back to back in a single byte pool, each as a
+length byte, the name and its list mask (u64, little endian), and indexes them
+with an open-addressing table of packed 64-bit slots:
+
+    slot = (pool offset + 1) << 32 | crc32(name)
+
+Lookups walk the label boundaries of the encoded name and probe with a
+memoryview of each suffix, so no substrings are created, and candidates are
+verified against the pool so there are no false positives.
+
+A DomainIndex can be saved as a snapshot file and later mapped back in with
+mmap and queried in place, so start-up costs no parsing or hashing and every
+process using the snapshot shares the same pages. Snapshots are written in
+native byte order, so they are only meant for the machine that built them:
+
+    +-----------------+--------------------+-----------------+------------+
+    | SNAPSHOT_HEADER | table: slots x u64 | pool: pool_size | list names |
+    +-----------------+--------------------+-----------------+------------+
+
+The list names are newline separated, lists_size bytes in all.
+"""
+
+from array import array
+from zlib import crc32
+import mmap
+import os
+import struct
+
+
+MAX_LOAD_FACTOR = 0.5  # keeps probe chains short for the (common) misses
+MAX_NAME_LENGTH = 255  # pool entries are length-prefixed with one byte
+MAX_LISTS = 64  # bits in an entry's list mask
+MASK_SIZE = 8
+
+SNAPSHOT_MAGIC = b'EMEDOMS\x00'
+SNAPSHOT_VERSION = 2
+# magic, version, lists_size, count, slots, pool_size, source digest
+SNAPSHOT_HEADER = struct.Struct('=8sIIQQQ16s')  # 8 byte aligned
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _table_size(count):
+    size = 8
+    while size * MAX_LOAD_FACTOR < count:
+        size <<= 1
+    return size
+
+
+class DomainSet:
+    """
+    Dict-of-strings index.
+    """
+    def __init__(self):
+        self.names = {}
+        self.lists = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, mask=1):
+        self.names[name] = self.names.get(name, 0) | mask
+
+    def encoded_names(self):
+        for name in self.names:
+            yield name.encode('utf-8')
+
+    def contains(self, name):
+        """
+        The list mask of exactly this name.
+        """
+        return self.names.get(name, 0)
+
+    def match(self, name):
+        mask = 0
+        while '.' in name:
+            mask |= self.names.get(name, 0)
+            name = name[name.find('.') + 1:]
+        return mask
+
+
+class DomainIndex:
+    """
+    Compact hash table over a byte pool of names.
+    """
+    def __init__(self):
+        self.count = 0
+        self.pool = bytearray()
+        self.table = array('Q', bytes(8 * _table_size(0)))
+        self.limit = int(len(self.table) * MAX_LOAD_FACTOR)
+        self.lists = []
+        self.mapping = None  # set for read-only indexes mapped from snapshots
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def open_snapshot(cls, path, source_digest=None):
+        """
+        Maps a snapshot written by save_snapshot(). If `source_digest` is
+        given the snapshot must have been built from those sources.
+        """
+        with open(path, 'rb') as snapshot_file:
+            try:
+                mapping = mmap.mmap(
+                    snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError("Empty snapshot: %s" % path)
+        try:
+            index = cls._from_mapping(mapping, source_digest)
+        except SnapshotError:
+            mapping.close()
+            raise
+        return index
+
+    @classmethod
+    def _from_mapping(cls, mapping, source_digest):
+        if len(mapping) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("Truncated snapshot header")
+        magic, version, lists_size, count, slots, pool_size, digest = \
+            SNAPSHOT_HEADER.unpack_from(mapping)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise SnapshotError("Unsupported snapshot (version %d)" % version)
+        if source_digest is not None and digest != source_digest:
+            raise SnapshotError("Snapshot is out of date")
+        table_start = SNAPSHOT_HEADER.size
+        pool_start = table_start + slots * 8
+        lists_start = pool_start + pool_size
+        if len(mapping) != lists_start + lists_size or slots & (slots - 1):
+            raise SnapshotError("Corrupt snapshot")
+        view = memoryview(mapping)
+        index = cls.__new__(cls)
+        index.count = count
+        index.table = view[table_start:pool_start].cast('Q')
+        index.pool = view[pool_start:lists_start]
+        index.limit = count
+        lists = mapping[lists_start:].decode('utf-8')
+        index.lists = lists.split('\n') if lists else []
+        index.mapping = mapping
+        return index
+
+    def save_snapshot(self, path, source_digest=b''):
+        """
+        Atomically writes the index to `path` for open_snapshot().
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        lists = '\n'.join(self.lists).encode('utf-8')
+        try:
+            with open(tmp_path, 'wb') as snapshot_file:
+                snapshot_file.write(SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(lists), self.count,
+                    len(self.table), len(self.pool), source_digest,
+                ))
+                snapshot_file.write(self.table)
+                snapshot_file.write(self.pool)
+                snapshot_file.write(lists)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        if self.mapping is not None:
+            self.table.release()
+            self.pool.release()
+            self.mapping.close()
+
+    def encoded_names(self):
+        pool = self.pool
+        offset = 0
+        end = len(pool)
+        while offset < end:
+            length = pool[offset]
+            yield bytes(pool[offset + 1:offset + 1 + length])
+            offset += 1 + length + MASK_SIZE
+
+    def add(self, name, mask=1):
+        if self.mapping is not None:
+            raise ValueError("Snapshot indexes are read-only")
+        encoded = name.encode('utf-8')
+        length = len(encoded)
+        if not length or length > MAX_NAME_LENGTH:
+            return
+        if self.count >= self.limit:
+            self._grow()
+        crc = crc32(encoded)
+        table = self.table
+        table_mask = len(table) - 1
+        slot = crc & table_mask
+        value = table[slot]
+        while value:
+            offset = (value >> 32) - 1
+            if value & 0xffffffff == crc and \
+                    self._equals(offset, encoded, length):
+                # already have it; it's on this list as well now
+                start = offset + 1 + length
+                self.pool[start:start + MASK_SIZE] = (
+                    self._mask(offset, length) | mask
+                ).to_bytes(MASK_SIZE, 'little')
+                return
+            slot = (slot + 1) & table_mask
+            value = table[slot]
+        offset = len(self.pool)
+        self.pool.append(length)
+        self.pool += encoded
+        self.pool += mask.to_bytes(MASK_SIZE, 'little')
+        table[slot] = (offset + 1) << 32 | crc
+        self.count += 1
+
+    def contains(self, name):
+        """
+        The list mask of exactly this name.
+        """
+        encoded = name.encode('utf-8')
+        length = len(encoded)
+        crc = crc32(encoded)
+        table = self.table
+        table_mask = len(table) - 1
+        slot = crc & table_mask
+        value = table[slot]
+        while value:
+            offset = (value >> 32) - 1
+            if value & 0xffffffff == crc and \
+                    self._equals(offset, encoded, length):
+                return self._mask(offset, length)
+            slot = (slot + 1) & table_mask
+            value = table[slot]
+        return 0
+
+    def match(self, name):
+        encoded = name.encode('utf-8')
+        view = memoryview(encoded)
+        table = self.table
+        table_mask = len(table) - 1
+        mask = 0
+        start = 0
+        dot = encoded.find(b'.')
+        # walk up the label boundaries, collecting the lists of every match
+        while dot != -1:
+            candidate = view[start:]
+            length = len(candidate)
+            crc = crc32(candidate)
+            slot = crc & table_mask
+            value = table[slot]
+            while value:
+                offset = (value >> 32) - 1
+                if value & 0xffffffff == crc and \
+                        self._equals(offset, candidate, length):
+                    mask |= self._mask(offset, length)
+                    break
+                slot = (slot + 1) & table_mask
+                value = table[slot]
+            start = dot + 1
+            dot = encoded.find(b'.', start)
+        return mask
+
+    def _mask(self, offset, length):
+        start = offset + 1 + length
+        return int.from_bytes(self.pool[start:start + MASK_SIZE], 'little')
+
+    def _equals(self, offset, candidate, length):
+        pool = self.pool
+        return pool[offset] == length and \
+            memoryview(pool)[offset + 1:offset + 1 + length] == candidate
+
+    def _grow(self):
+        old = self.table
+        table = self.table = array('Q', bytes(8 * len(old) * 2))
+        self.limit = int(len(table) * MAX_LOAD_FACTOR)
+        mask = len(table) - 1
+        for value in old:
+            if value:
+                slot = value & mask
+                while table[slot]:
+                    slot = (slot + 1) & mask
+                table[slot] = value
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Loads the `*.ips.blacklist` files into the sets traffic to them is dropped by.
+
+There are two backends, picked by $IP_FILTER_BACKEND:
+
+ipset (the default): every list gets one hash:net set, `<list>.00` (the name of the first of the
+65000-entry pieces pep-filter.sh used to split lists into, so its rules keep
+working), sized for what goes into it. A list is loaded into a shadow set,
+`<list>.new`, and swapped with the live one; until then iptables goes on
+matching the old contents, so a reload never leaves traffic unfiltered.
+
+nftables: every list gets an interval set, `list_<list>`, in a table of our
+own, `ip encryptme_blocklists`, behind one rule in a chain both input and
+forward traffic jump to (just ahead of iptables and its ENCRYPTME chain). An
+interval set is looked up in logarithmic time, however many ranges it holds,
+and needn't be split up. Each change, down to a whole reload, is applied as
+one `nft -f` transaction, so rules and sets are never seen half updated.
+
+Lists are read a line at a time. Anything that isn't an IPv4 address or CIDR
+is skipped, and overlapping or adjacent networks are merged, so a set holds
+as few entries as will cover them.
+"""
+
+from array import array
+from itertools import chain
+from subprocess import Popen, PIPE
+import fcntl
+import os
+import re
+import sys
+
+from index import MAX_LISTS
+from journal import LIST_NAME_RE, has_room_for
+
+
+FILTERS_DIR = "/etc/encryptme/filters"
+LIST_SUFFIX = '.ips.blacklist'
+LOCK_PATH = '/tmp/ip_filter.lock'
+
+IPSET = '/sbin/ipset'
+IPTABLES = '/sbin/iptables'
+IPTABLES_SAVE = '/sbin/iptables-save'
+CHAIN = 'ENCRYPTME'
+RULE_POSITION = '2'  # after the loopback rule
+
+LIVE_SUFFIX = '.00'
+SHADOW_SUFFIX = '.new'
+# ours: the live set, a shadow one, or more pieces of a list split up by
+# older versions of pep-filter.sh
+SET_NAME_RE = re.compile(r'^([A-Za-z0-9_-]+)\.(\d{2}|new)$')
+RULE_RE = re.compile(r'^-A %s .*--match-set (\S+) dst -j DROP' % CHAIN)
+
+IPV4_CIDR_RE = re.compile(
+    r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})(?:/(\d{1,2}))?$')
+# set sizes: kernel defaults as the minimum, and hash buckets for about two
+# entries each so loading a set never has to grow it
+MIN_HASHSIZE = 1024
+MIN_MAXELEM = 65536
+ENTRIES_PER_BUCKET = 2
+RESTORE_BATCH = 4096  # lines per write to `ipset restore`
+
+NFT = '/usr/sbin/nft'
+NFT_TABLE = 'ip encryptme_blocklists'
+NFT_CHAIN = 'blocklists'
+NFT_SET_PREFIX = 'list_'  # set names must start with a letter
+# just ahead of iptables' filter table, as the ipset rules are ahead of the
+# ENCRYPTME chain's own
+NFT_PRIORITY = -1
+NFT_ELEMENTS_BATCH = 4096  # elements per `add element`
+
+
+class IPFilterError(Exception):
+    pass
+
+
+def parse_network(line):
+    """
+    (first, last) address of an IPv4 address or CIDR, as integers; None if
+    it is neither. Host bits are ignored, as ipset does.
+    """
+    match = IPV4_CIDR_RE.match(line)
+    if not match:
+        return None
+    a, b, c, d, prefix = match.groups()
+    a, b, c, d = int(a), int(b), int(c), int(d)
+    if a > 255 or b > 255 or c > 255 or d > 255:
+        return None
+    prefix = 32 if prefix is None else int(prefix)
+    if prefix > 32:
+        return None
+    host_mask = (1 << (32 - prefix)) - 1
+    address = (a << 24) | (b << 16) | (c << 8) | d
+    return address & ~host_mask & 0xffffffff, address | host_mask
+
+
+def read_networks(lines):
+    """
+    Parses and merges networks, one per line. Returns two sorted arrays, of
+    the first and last addresses of the merged ranges, and the number of
+    lines that were skipped as invalid.
+    """
+    packed = array('Q')  # first << 32 | last, to sort them in one go
+    invalid = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        network = parse_network(line)
+        if network is None:
+            invalid += 1
+            continue
+        packed.append(network[0] << 32 | network[1])
+    firsts, lasts = array('I'), array('I')
+    current_first = current_last = None
+    for value in sorted(packed):
+        first, last = value >> 32, value & 0xffffffff
+        if current_last is not None and first <= current_last + 1:
+            if last > current_last:
+                current_last = last
+            continue
+        if current_last is not None:
+            firsts.append(current_first)
+            lasts.append(current_last)
+        current_first, current_last = first, last
+    if current_last is not None:
+        firsts.append(current_first)
+        lasts.append(current_last)
+    return firsts, lasts, invalid
+
+
+def cidr_blocks(firsts, lasts):
+    """
+    Yields (address, prefix length) of the fewest CIDRs that exactly cover
+    the ranges.
+    """
+    for first, last in zip(firsts, lasts):
+        while first <= last:
+            # the largest block aligned at `first` that doesn't overshoot
+            size = (first & -first) or 1 << 32
+            while size > last - first + 1:
+                size >>= 1
+            yield first, 33 - size.bit_length()
+            first += size
+
+
+def format_cidr(address, prefix):
+    address = '%d.%d.%d.%d' % (
+        address >> 24, address >> 16 & 255, address >> 8 & 255, address & 255)
+    return address if prefix == 32 else '%s/%d' % (address, prefix)
+
+
+def format_range(first, last):
+    if first == last:
+        return format_cidr(first, 32)
+    return '%s-%s' % (format_cidr(first, 32), format_cidr(last, 32))
+
+
+def list_path(filters_dir, list_name):
+    return os.path.join(filters_dir, list_name + LIST_SUFFIX)
+
+
+def write_list(path, firsts, lasts):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as list_file:
+        for address, prefix in cidr_blocks(firsts, lasts):
+            list_file.write(format_cidr(address, prefix) + '\n')
+    os.rename(tmp_path, path)
+
+
+def _run(cmd, lines=()):
+    """
+    Runs a command, streaming `lines` to its stdin; returns its output.
+    """
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    try:
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= RESTORE_BATCH:
+                proc.stdin.write(('\n'.join(batch) + '\n').encode('ascii'))
+                batch = []
+        if batch:
+            proc.stdin.write(('\n'.join(batch) + '\n').encode('ascii'))
+    except BrokenPipeError:
+        pass  # it gave up; its stderr says why
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise IPFilterError("%s failed: %s" % (
+            ' '.join(cmd[:2]), stderr.decode('utf-8', 'replace').strip()))
+    return stdout.decode('utf-8', 'replace')
+
+
+def _set_size(count):
+    hashsize = MIN_HASHSIZE
+    while hashsize * ENTRIES_PER_BUCKET < count:
+        hashsize <<= 1
+    return hashsize, max(MIN_MAXELEM, count)
+
+
+class IPFilter:
+    """
+    What the backends share: finding the lists and reading them in.
+    """
+    def __init__(self, filters_dir=FILTERS_DIR, log=print):
+        self.filters_dir = filters_dir
+        self.log = log
+
+    def set_name(self, list_name):
+        raise NotImplementedError()
+
+    def load(self, list_name, firsts, lasts):
+        raise NotImplementedError()
+
+    def list_names(self):
+        list_names = []
+        if os.path.isdir(self.filters_dir):
+            for filename in sorted(os.listdir(self.filters_dir)):
+                if filename.endswith(LIST_SUFFIX):
+                    list_names.append(filename[:-len(LIST_SUFFIX)])
+        return list_names
+
+    def read_list(self, list_name, extra_paths=()):
+        """
+        A list's merged networks, as read_networks() returns them; with
+        `extra_paths`, merges their networks into it first (and rewrites it,
+        merged).
+        """
+        path = list_path(self.filters_dir, list_name)
+        paths = [path] if os.path.exists(path) else []
+        paths.extend(extra_paths)
+        firsts, lasts, invalid = read_networks(_lines(paths))
+        if extra_paths:
+            write_list(path, firsts, lasts)
+        return firsts, lasts, invalid
+
+    def log_loaded(self, list_name, count, invalid):
+        self.log("Loaded %d networks into %s%s" % (
+            count, self.set_name(list_name),
+            " (skipped %d invalid lines)" % invalid if invalid else ""))
+
+    def load_file(self, list_name, extra_paths=()):
+        """
+        Loads a list from its file, merging in `extra_paths` (see
+        read_list()).
+        """
+        firsts, lasts, invalid = self.read_list(list_name, extra_paths)
+        self.log_loaded(list_name, self.load(list_name, firsts, lasts), invalid)
+
+
+class IpsetFilter(IPFilter):
+    """
+    The ipsets and iptables rules of the lists, as found when created.
+    """
+    def __init__(self, filters_dir=FILTERS_DIR, log=print):
+        super().__init__(filters_dir, log)
+        self.sets = set(_run([IPSET, '-n', 'list']).split())
+        self.rules = set()
+        for line in _run([IPTABLES_SAVE, '-t', 'filter']).splitlines():
+            match = RULE_RE.match(line)
+            if match:
+                self.rules.add(match.group(1))
+
+    def set_name(self, list_name):
+        return list_name + LIVE_SUFFIX
+
+    def list_sets(self, list_name):
+        names = []
+        for name in sorted(self.sets):
+            match = SET_NAME_RE.match(name)
+            if match and match.group(1) == list_name:
+                names.append(name)
+        return names
+
+    def load(self, list_name, firsts, lasts):
+        """
+        Atomically replaces the contents of the list's set, creating it (and
+        its rule) if need be.
+        """
+        live = self.set_name(list_name)
+        shadow = list_name + SHADOW_SUFFIX
+        # address << 8 | prefix length
+        blocks = array('Q', (
+            address << 8 | prefix
+            for address, prefix in cidr_blocks(firsts, lasts)
+        ))
+        hashsize, maxelem = _set_size(len(blocks))
+        if shadow in self.sets:
+            self._destroy(shadow)
+        create = 'create %s hash:net family inet hashsize %d maxelem %d' % (
+            shadow, hashsize, maxelem)
+        _run([IPSET, 'restore'], self._restore_lines(create, shadow, blocks))
+        self.sets.add(shadow)
+        if live in self.sets:
+            _run([IPSET, 'swap', shadow, live])
+            self._destroy(shadow)
+        else:
+            _run([IPSET, 'rename', shadow, live])
+            self.sets.discard(shadow)
+            self.sets.add(live)
+        if live not in self.rules:
+            _run([IPTABLES, '-I', CHAIN, RULE_POSITION, '-m', 'set',
+                  '--match-set', live, 'dst', '-j', 'DROP'])
+            self.rules.add(live)
+        # pieces of the list from before it was a single set
+        for name in self.list_sets(list_name):
+            if name != live:
+                self._drop(name)
+        return len(blocks)
+
+    @staticmethod
+    def _restore_lines(create, name, blocks):
+        yield create
+        for block in blocks:
+            yield 'add %s %s' % (name, format_cidr(block >> 8, block & 255))
+
+    def remove(self, list_name):
+        for name in self.list_sets(list_name):
+            self._drop(name)
+
+    def reset(self):
+        """
+        Drops every set (not just the lists'), as pep-filter.sh always has.
+        """
+        for name in sorted(self.sets):
+            self._drop(name)
+
+    def _drop(self, name):
+        if name in self.rules:
+            _run([IPTABLES, '-D', CHAIN, '-m', 'set', '--match-set', name,
+                  'dst', '-j', 'DROP'])
+            self.rules.discard(name)
+        self._destroy(name)
+
+    def _destroy(self, name):
+        _run([IPSET, 'destroy', name])
+        self.sets.discard(name)
+
+    def reload(self):
+        """
+        Loads every list, and drops the sets of lists that are gone.
+        """
+        list_names = self.list_names()
+        for list_name in list_names:
+            self.load_file(list_name)
+        for name in sorted(self.sets):
+            match = SET_NAME_RE.match(name)
+            if match and match.group(1) not in list_names:
+                self._drop(name)
+
+
+class NftFilter(IPFilter):
+    """
+    The lists' interval sets in our nftables table. Every transaction
+    (re)declares the table and chains and rewrites the rules, so it needn't
+    know what is already there.
+    """
+    def set_name(self, list_name):
+        return NFT_SET_PREFIX + list_name
+
+    def _add_set(self, list_name):
+        return 'add set %s %s { type ipv4_addr; flags interval; }' % (
+            NFT_TABLE, self.set_name(list_name))
+
+    def _element_lines(self, list_name, firsts, lasts):
+        name = self.set_name(list_name)
+        for start in range(0, len(firsts), NFT_ELEMENTS_BATCH):
+            yield 'add element %s %s { %s }' % (NFT_TABLE, name, ', '.join(
+                format_range(first, last) for first, last in zip(
+                    firsts[start:start + NFT_ELEMENTS_BATCH],
+                    lasts[start:start + NFT_ELEMENTS_BATCH])))
+
+    def _chain_lines(self, list_names):
+        """
+        The chains, with a rule for each of `list_names`
+        (whose sets must exist by then).
+        """
+        yield 'add chain %s %s' % (NFT_TABLE, NFT_CHAIN)
+        for hook in ('input', 'forward'):
+            yield ('add chain %s %s { type filter hook %s priority %d; '
+                   'policy accept; }' % (NFT_TABLE, hook, hook, NFT_PRIORITY))
+            yield 'flush chain %s %s' % (NFT_TABLE, hook)
+        # ENCRYPTME lets loopback traffic through before anything else
+        yield 'add rule %s input iifname "lo" return' % NFT_TABLE
+        for hook in ('input', 'forward'):
+            yield 'add rule %s %s jump %s' % (NFT_TABLE, hook, NFT_CHAIN)
+        yield 'flush chain %s %s' % (NFT_TABLE, NFT_CHAIN)
+        for list_name in list_names:
+            yield 'add rule %s %s ip daddr @%s counter drop' % (
+                NFT_TABLE, NFT_CHAIN, self.set_name(list_name))
+
+    def load(self, list_name, firsts, lasts):
+        """
+        Atomically replaces the contents of the list's set, creating it (and
+        its rule) if need be.
+        """
+        list_names = sorted(set(self.list_names()) | {list_name})
+        # any other list without a set yet gets an empty one, for its rule
+        _run([NFT, '-f', '-'], chain(
+            ['add table %s' % NFT_TABLE],
+            [self._add_set(name) for name in list_names],
+            ['flush set %s %s' % (NFT_TABLE, self.set_name(list_name))],
+            self._element_lines(list_name, firsts, lasts),
+            self._chain_lines(list_names),
+        ))
+        return len(firsts)
+
+    def remove(self, list_name):
+        list_names = [name for name in self.list_names() if name != list_name]
+        _run([NFT, '-f', '-'], chain(
+            ['add table %s' % NFT_TABLE],
+            [self._add_set(name) for name in list_names],
+            self._chain_lines(list_names),
+            # declared first, so it needn't exist
+            [self._add_set(list_name),
+             'delete set %s %s' % (NFT_TABLE, self.set_name(list_name))],
+        ))
+
+    def reset(self):
+        _run([NFT, '-f', '-'], [
+            'add table %s' % NFT_TABLE,
+            'delete table %s' % NFT_TABLE,
+        ])
+
+    def reload(self):
+        """
+        Rebuilds the table from every list, dropping the sets of lists that
+        are gone, in one transaction. Lists are read one at a time, as it is
+        streamed to nft.
+        """
+        list_names = self.list_names()
+        _run([NFT, '-f', '-'], chain(
+            ['add table %s' % NFT_TABLE, 'delete table %s' % NFT_TABLE,
+             'add table %s' % NFT_TABLE],
+            chain.from_iterable(
+                self._reload_lines(name) for name in list_names),
+            self._chain_lines(list_names),
+        ))
+
+    def _reload_lines(self, list_name):
+        yield self._add_set(list_name)
+        firsts, lasts, invalid = self.read_list(list_name)
+        for line in self._element_lines(list_name, firsts, lasts):
+            yield line
+        self.log_loaded(list_name, len(firsts), invalid)
+
+
+BACKENDS = {
+    'ipset': IpsetFilter,
+    'nftables': NftFilter,
+}
+
+
+def _lines(paths):
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                yield line
+            continue
+        with open(path) as list_file:
+            for line in list_file:
+                yield line
+
+
+def main(args):
+    command = args[0] if args else None
+    if command in ('add', 'remove'):
+        if len(args) < 2 or (command == 'remove' and len(args) > 2):
+            command = None
+        elif not LIST_NAME_RE.match(args[1]):
+            sys.stderr.write("Invalid list name: %s\n" % args[1])
+            return 2
+    elif len(args) != 1:
+        command = None
+    if command not in ('add', 'remove', 'reload', 'reset'):
+        sys.stderr.write("usage: %s add LIST [FILE...]|remove LIST|reload|reset\n"
+                         % sys.argv[0])
+        return 2
+    backend = os.environ.get('IP_FILTER_BACKEND') or 'ipset'
+    if backend not in BACKENDS:
+        sys.stderr.write("Invalid IP_FILTER_BACKEND: %s (one of %s)\n" % (
+            backend, ', '.join(sorted(BACKENDS))))
+        return 2
+    # one at a time, as they share the shadow sets (and the nftables rules)
+    with open(LOCK_PATH, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            ip_filter = BACKENDS[backend]()
+            if command == 'add':
+                if not has_room_for(ip_filter.filters_dir, args[1]):
+                    sys.stderr.write("Too many lists (at most %d), not adding "
+                                     "%s\n" % (MAX_LISTS, args[1]))
+                    return 1
+                if not os.path.isdir(ip_filter.filters_dir):
+                    os.makedirs(ip_filter.filters_dir)
+                # FILEs, or stdin
+                ip_filter.load_file(args[1], args[2:] or ['-'])
+            elif command == 'remove':
+                ip_filter.remove(args[1])
+            elif command == 'reload':
+                ip_filter.reload()
+            else:
+                ip_filter.reset()
+        except (IPFilterError, OSError) as err:
+            sys.stderr.write("%s\n" % err)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
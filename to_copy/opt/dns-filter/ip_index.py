@@ -0,0 +1,117 @@
+"""
+The IP lists (`*.ips.blacklist`), for checking the addresses in answers.
+
+Each list is merged into ranges, as ip_filter.py merges them for the kernel,
+and the ranges of all the lists are cut into disjoint segments, each carrying
+the mask of the lists it is on (with the same bits as the domain index). A
+segment is a start address and a mask in two flat arrays, twelve bytes in
+all, and a lookup is one binary search of the starts, however many networks
+the lists hold.
+"""
+
+from array import array
+from bisect import bisect_right
+import hashlib
+import os
+
+from ip_filter import LIST_SUFFIX, read_networks
+
+
+ADDRESS_SPACE_END = 1 << 32
+BIT_BITS = 6  # enough for a list bit index
+# events are address << EVENT_SHIFT | list bit index << 1 | 1 if a range ends
+EVENT_SHIFT = BIT_BITS + 1
+
+
+class IPIndex:
+    def __init__(self):
+        # segment i runs from starts[i] up to starts[i + 1]; the first
+        # starts wherever the first list's first range does
+        self.starts = array('I')
+        self.masks = array('Q')
+        self.ranges = 0
+
+    def __len__(self):
+        return self.ranges
+
+    @staticmethod
+    def list_name(path):
+        return os.path.basename(path)[:-len(LIST_SUFFIX)]
+
+    @staticmethod
+    def _list_paths(filters_dir):
+        return sorted(
+            os.path.join(filters_dir, name)
+            for name in os.listdir(filters_dir)
+            if name.endswith(LIST_SUFFIX)
+        )
+
+    @classmethod
+    def source_digest(cls, filters_dir):
+        """
+        Fingerprints the list files by name, size and mtime.
+        """
+        digest = hashlib.sha1()
+        if os.path.isdir(filters_dir):
+            for path in cls._list_paths(filters_dir):
+                stat = os.stat(path)
+                digest.update(('%s\0%d\0%d\n' % (
+                    path, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        return digest.digest()[:16]
+
+    @classmethod
+    def load(cls, filters_dir, list_bit):
+        """
+        Reads every list in `filters_dir`; `list_bit` maps a list name to
+        its bit in the masks.
+        """
+        index = cls()
+        if not os.path.isdir(filters_dir):
+            return index
+        # a range sets its list's bit at its start and clears it just past
+        # its end; lists past the 63rd share a bit, so their ranges may
+        # overlap, and the bit is only cleared once none of them is open
+        events = array('Q')
+        for path in cls._list_paths(filters_dir):
+            bit_index = list_bit(cls.list_name(path)).bit_length() - 1
+            with open(path) as list_file:
+                firsts, lasts, _ = read_networks(list_file)
+            for first, last in zip(firsts, lasts):
+                events.append(first << EVENT_SHIFT | bit_index << 1)
+                events.append((last + 1) << EVENT_SHIFT | bit_index << 1 | 1)
+            index.ranges += len(firsts)
+        index._build(sorted(events))
+        return index
+
+    def _build(self, events):
+        starts, masks = self.starts, self.masks
+        # ranges open per bit
+        open_ranges = [0] * (1 << BIT_BITS)
+        mask = 0
+        position = 0
+        while position < len(events):
+            address = events[position] >> EVENT_SHIFT
+            while position < len(events) and \
+                    events[position] >> EVENT_SHIFT == address:
+                event = events[position]
+                bit_index = (event >> 1) & ((1 << BIT_BITS) - 1)
+                if event & 1:
+                    open_ranges[bit_index] -= 1
+                    if not open_ranges[bit_index]:
+                        mask &= ~(1 << bit_index)
+                else:
+                    open_ranges[bit_index] += 1
+                    mask |= 1 << bit_index
+                position += 1
+            if address >= ADDRESS_SPACE_END:
+                break
+            if (masks[-1] if masks else 0) != mask:
+                starts.append(address)
+                masks.append(mask)
+
+    def match(self, address):
+        """
+        Returns the mask of the lists the address (an integer) is on.
+        """
+        position = bisect_right(self.starts, address) - 1
+        return self.masks[position] if position >= 0 else 0
@@ -0,0 +1,210 @@
+"""
+Append-only journal of list changes made through the dns-filter socket.
+
+Deltas are applied to the live index straight away and recorded here, one per
+line (`+` or `-`, list name and domain, tab separated). They are compacted
+into the `*.domains.blacklist` files later on, so a small update costs time in
+proportion to its size rather than to the size of the list.
+
+Compaction first moves the journal aside under a lock, so the daemon starts a
+fresh one without ever blocking on the rewrite. Once the lists are rewritten it
+is kept, as `.compacted`, until the next compaction: a list loaded before the
+rewrite still has to replay those changes until its reload lands. Replaying is
+idempotent: the last change for a domain wins no matter how often the same
+journal is applied.
+"""
+
+import fcntl
+import os
+import re
+
+from index import MAX_LISTS
+
+
+ADD = '+'
+REMOVE = '-'
+
+# file times come from a clock up to a tick behind time.time()
+COMPACTED_MARGIN = 0.05  # seconds
+
+LIST_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+# as domain_list.py lets through: IDNs are punycode, TLDs included
+DOMAIN_RE = re.compile(r'^([A-Za-z0-9-]+\.)+([A-Za-z]{2,}|xn--[A-Za-z0-9-]+)$')
+# the domain and IP lists of a name share its bit in the daemon's masks
+LIST_SUFFIXES = ('.domains.blacklist', '.ips.blacklist')
+LISTS_LOCK = '.lists.lock'
+
+
+def lock_lists(filters_dir):
+    """
+    Returns the lock file, locked, that whatever rewrites the domain list
+    files in `filters_dir` (compaction, domain_list.py add) holds, so none
+    of them drops another's changes. Closing it unlocks it.
+    """
+    lock_file = open(os.path.join(filters_dir, LISTS_LOCK), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def has_room_for(filters_dir, list_name):
+    """
+    Whether `list_name` is already a list in `filters_dir`, or there are
+    fewer than MAX_LISTS and it can become one. The daemon only filters
+    lists past that for clients without a profile.
+    """
+    list_names = set()
+    if os.path.isdir(filters_dir):
+        for name in os.listdir(filters_dir):
+            for suffix in LIST_SUFFIXES:
+                if name.endswith(suffix):
+                    list_names.add(name[:-len(suffix)])
+    return list_name in list_names or len(list_names) < MAX_LISTS
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.compacting_path = path + '.compacting'
+        self.compacted_path = path + '.compacted'
+
+    def append(self, op, list_name, domains):
+        """
+        Durably records changes to one list.
+        """
+        data = ''.join(
+            '%s\t%s\t%s\n' % (op, list_name, domain) for domain in domains
+        ).encode('utf-8')
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # compaction may have moved the file away while we waited
+                if not self._is_current(fd):
+                    continue
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+                return
+            finally:
+                os.close(fd)
+
+    def _is_current(self, fd):
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def replay(self, loaded_at=None):
+        """
+        Yields (op, list name, domain) for every change not yet compacted
+        into the list files, oldest first, as of lists loaded at `loaded_at`
+        (a UNIX time): those last compacted after then are included, as are
+        they without one.
+        """
+        paths = [self.compacting_path, self.path]
+        if loaded_at is None or self._compacted_since(loaded_at):
+            paths.insert(0, self.compacted_path)
+        for path in paths:
+            for change in self._read(path):
+                yield change
+
+    def _compacted_since(self, loaded_at):
+        try:
+            # set by the rename that ends a compaction
+            compacted = os.stat(self.compacted_path).st_ctime
+        except FileNotFoundError:
+            return False
+        return compacted > loaded_at - COMPACTED_MARGIN
+
+    @staticmethod
+    def _read(path):
+        try:
+            journal_file = open(path)
+        except FileNotFoundError:
+            return
+        with journal_file:
+            for line in journal_file:
+                change = line.rstrip('\n').split('\t')
+                # a torn last line is simply skipped
+                if len(change) == 3 and change[0] in (ADD, REMOVE):
+                    yield tuple(change)
+
+    def rotate(self):
+        """
+        Moves the journal aside for compaction; returns False if there is
+        nothing to compact.
+        """
+        if os.path.exists(self.compacting_path):
+            return True  # left over from an interrupted compaction
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.rename(self.path, self.compacting_path)
+        finally:
+            os.close(fd)
+        return True
+
+    def compact(self, filters_dir):
+        """
+        Folds journaled changes into the list files; returns the number of
+        lists rewritten.
+        """
+        if not self.rotate():
+            return 0
+        changes = {}  # list name -> {domain: added?}
+        for op, list_name, domain in self._read(self.compacting_path):
+            changes.setdefault(list_name, {})[domain] = op == ADD
+        with lock_lists(filters_dir):
+            for list_name, domains in changes.items():
+                self._rewrite_list(
+                    os.path.join(filters_dir,
+                                 '%s.domains.blacklist' % list_name),
+                    domains,
+                )
+            # on disk before the journal, the only other copy, can go
+            fsync_dir(filters_dir)
+        os.rename(self.compacting_path, self.compacted_path)
+        return len(changes)
+
+    @staticmethod
+    def _rewrite_list(path, changes):
+        try:
+            with open(path) as list_file:
+                domains = set(line.strip() for line in list_file)
+        except FileNotFoundError:
+            domains = set()
+        domains.discard('')
+        for domain, added in changes.items():
+            if added:
+                domains.add(domain)
+            else:
+                domains.discard(domain)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as list_file:
+                for domain in sorted(domains):
+                    list_file.write(domain + '\n')
+                list_file.flush()
+                os.fsync(list_file.fileno())
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
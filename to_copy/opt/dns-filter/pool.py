@@ -0,0 +1,235 @@
+"""
+Pre-fork worker pool for the dns-filter daemon.
+
+The supervisor forks `size` workers that inherit everything set up before the
+fork: the listening socket and the (read-only, or memory-mapped) filter index,
+so they share a single copy of it. Each worker writes a heartbeat byte to its
+own pipe; workers that exit, or stop sending heartbeats, are replaced.
+
+Signals meant for the workers (FORWARDED_SIGNALS) are sent to the supervisor,
+which passes them on. They stay blocked in a new worker until it calls
+unblock_signals(), so none are lost before it has installed its handlers.
+"""
+
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+HEARTBEAT_INTERVAL = 1  # seconds
+HEARTBEAT_TIMEOUT = 10  # ... before a silent worker is killed off
+RESTART_DELAY = 1  # minimum time between restarts of the same worker
+SHUTDOWN_TIMEOUT = 10  # workers may take daemon.DRAIN_TIMEOUT to drain
+
+FORWARDED_SIGNALS = (signal.SIGHUP, signal.SIGUSR1)
+
+
+def unblock_signals():
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, FORWARDED_SIGNALS)
+
+
+class Worker:
+    def __init__(self, slot):
+        self.slot = slot
+        self.pid = None
+        self.heartbeat = None  # read end of the worker's heartbeat pipe
+        self.last_seen = 0
+        self.started = 0
+
+
+class WorkerPool:
+    """
+    Runs `serve(slot, heartbeat_fd)` in each worker process, `slot` being
+    its number in 0 .. size - 1; a replacement worker takes over the slot.
+
+    The supervisor calls `on_reload()` on SIGHUP (or reload()) and then
+    passes the signal on to the workers; SIGUSR1 from any worker is passed
+    on to all of them. `on_tick()` is called on every pass of its loop.
+    """
+    def __init__(self, size, serve, on_reload=None, on_tick=None, log=print):
+        self.workers = [Worker(slot) for slot in range(size)]
+        self.serve = serve
+        self.on_reload = on_reload
+        self.on_tick = on_tick
+        self.log = log
+        self.selector = None
+        self.wakeup_r = self.wakeup_w = None
+        self.pending = set()  # signals to act on
+
+    def run(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        signal.set_wakeup_fd(self.wakeup_w.fileno())
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM,
+                       signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+        try:
+            self._spawn_missing()
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    def _on_signal(self, signum, frame):
+        self.pending.add(signum)
+
+    def _supervise(self):
+        while True:
+            for key, _ in self.selector.select(HEARTBEAT_INTERVAL):
+                if key.fileobj is self.wakeup_r:
+                    self._drain(self.wakeup_r)
+                else:
+                    self._on_heartbeat(key.data)
+            # before anything slow, so heartbeats that queued up while we
+            # were busy are counted first
+            self._reap()
+            self._check_health()
+            self._spawn_missing()
+            pending, self.pending = self.pending, set()
+            if pending & {signal.SIGTERM, signal.SIGINT}:
+                return
+            if signal.SIGHUP in pending:
+                self.reload()
+            if signal.SIGUSR1 in pending:
+                self._signal_workers(signal.SIGUSR1)
+            if self.on_tick is not None:
+                self.on_tick()
+
+    def stop(self):
+        """
+        Has the supervisor shut the workers down and return, as on SIGTERM.
+        """
+        self.pending.add(signal.SIGTERM)
+
+    def reload(self):
+        if self.on_reload is not None:
+            self.on_reload()
+        self._signal_workers(signal.SIGHUP)
+
+    @staticmethod
+    def _drain(sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _on_heartbeat(self, worker):
+        try:
+            data = os.read(worker.heartbeat, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if data:
+            worker.last_seen = time.monotonic()
+        else:
+            # it has exited; reaping it will take care of the rest
+            self._close_heartbeat(worker)
+
+    def _signal_workers(self, signum):
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    self.log("Worker %d (pid %d) exited with status %d" % (
+                        worker.slot, pid, status))
+                    worker.pid = None
+                    self._close_heartbeat(worker)
+
+    def _check_health(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.pid and now - worker.last_seen > HEARTBEAT_TIMEOUT:
+                self.log("Worker %d (pid %d) is unresponsive; killing it" % (
+                    worker.slot, worker.pid))
+                try:
+                    os.kill(worker.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # don't kill it again while we wait to reap it
+                worker.last_seen = now
+
+    def _spawn_missing(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            # don't spin on workers that die straight away
+            if worker.pid is None and now - worker.started >= RESTART_DELAY:
+                self._spawn(worker)
+
+    def _spawn(self, worker):
+        read_fd, write_fd = os.pipe()
+        signal.pthread_sigmask(signal.SIG_BLOCK, FORWARDED_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_worker(worker.slot, write_fd)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, FORWARDED_SIGNALS)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        worker.pid = pid
+        worker.heartbeat = read_fd
+        worker.started = worker.last_seen = time.monotonic()
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+
+    def _run_worker(self, slot, heartbeat_fd):
+        # undo the supervisor's plumbing before handing over
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit())
+        for worker in self.workers:
+            if worker.heartbeat is not None:
+                os.close(worker.heartbeat)
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        code = 0
+        try:
+            self.serve(slot, heartbeat_fd)
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            # never fall back into the supervisor's code (or its atexit hooks)
+            os._exit(code)
+
+    def _close_heartbeat(self, worker):
+        if worker.heartbeat is not None:
+            self.selector.unregister(worker.heartbeat)
+            os.close(worker.heartbeat)
+            worker.heartbeat = None
+
+    def _shutdown(self):
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while any(worker.pid for worker in self.workers):
+            self._reap()
+            if time.monotonic() > deadline:
+                self._signal_workers(signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.05)
+        signal.set_wakeup_fd(-1)
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
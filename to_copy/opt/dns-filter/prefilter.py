@@ -0,0 +1,148 @@
+"""
+Bloom filter over the blocked domains, published for the unbound module.
+
+Most names looked up are on no list. The unbound module
+(/usr/local/unbound-1.7/sbin/filter_client.py) maps the published file and
+checks every suffix of a name against it first; only a possible hit costs a
+round trip to the daemon. It runs under Python 2.7 and has its own reader,
+so keep the format and hashing in sync with it:
+
+    +--------+---------+-------+------------+--------+------+---------------+
+    | magic  | version | flags | generation | hashes | bits | source digest |
+    |   8s   |   u32   |  u32  |    u32     |  u32   | u64  |      16s      |
+    +--------+---------+-------+------------+--------+------+---------------+
+
+followed by the bit array, in native byte order. A name sets bits
+(h1 + i * h2) % bits for i in 0 .. hashes - 1, h1 and h2 being the two
+halves of its MD5 digest (little endian u64, h2 forced odd).
+
+The generation is that of the filter list the filter was built from. Deltas
+add their domains in place and move the generation along; a client that gets
+a different generation from the daemon than the filter carries knows the
+filter is stale and stops trusting it until it has been republished.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+
+MAGIC = b'EMEBLOOM'
+VERSION = 1
+HEADER = struct.Struct('=8sIIIIQ16s')
+GENERATION_OFFSET = 16
+FLAGS_OFFSET = 12
+FLAG_DISABLE_DOH = 0x01
+
+BITS_PER_ENTRY = 12
+HASHES = 8  # ~0.3% false positives per suffix probed
+
+DIGEST = struct.Struct('<QQ')
+
+
+class PrefilterError(Exception):
+    pass
+
+
+def _positions(encoded, hashes, bits):
+    h1, h2 = DIGEST.unpack(hashlib.md5(encoded).digest())
+    h2 |= 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class Prefilter:
+    def __init__(self, count, hashes=HASHES):
+        # a whole number of u64 words, for anyone reading it as those
+        self.bits = max(64, (count * BITS_PER_ENTRY + 63) // 64 * 64)
+        self.hashes = hashes
+        self.array = bytearray(self.bits // 8)
+
+    @classmethod
+    def build(cls, names, count):
+        """
+        A filter over `names` (encoded), of which there are about `count`.
+        """
+        prefilter = cls(count)
+        for encoded in names:
+            prefilter.add(encoded)
+        return prefilter
+
+    @classmethod
+    def load(cls, path, source_digest):
+        """
+        Reads a filter saved by save() from the given sources.
+        """
+        with open(path, 'rb') as prefilter_file:
+            header = prefilter_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise PrefilterError("Truncated prefilter: %s" % path)
+            magic, version, _, _, hashes, bits, digest = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise PrefilterError("Unsupported prefilter: %s" % path)
+            if digest != source_digest:
+                raise PrefilterError("Prefilter is out of date: %s" % path)
+            prefilter = cls.__new__(cls)
+            prefilter.bits = bits
+            prefilter.hashes = hashes
+            prefilter.array = bytearray(prefilter_file.read())
+        if len(prefilter.array) * 8 != bits:
+            raise PrefilterError("Corrupt prefilter: %s" % path)
+        return prefilter
+
+    def add(self, encoded):
+        array = self.array
+        for position in _positions(encoded, self.hashes, self.bits):
+            array[position >> 3] |= 1 << (position & 7)
+
+    def save(self, path, generation=0, disable_doh=False, source_digest=b''):
+        """
+        Atomically (re)places the filter at `path`; readers notice by its
+        inode changing.
+        """
+        flags = FLAG_DISABLE_DOH if disable_doh else 0
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as prefilter_file:
+                prefilter_file.write(HEADER.pack(
+                    MAGIC, VERSION, flags, generation, self.hashes, self.bits,
+                    source_digest,
+                ))
+                prefilter_file.write(self.array)
+            os.chmod(tmp_path, 0o644)  # the unbound user reads it
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+def update(path, names, generation, disable_doh):
+    """
+    Adds `names` (encoded) to a published filter in place and stamps it
+    with the new generation, bits first so readers never see the new
+    generation without them. Workers may do this concurrently, hence the
+    lock.
+    """
+    with open(path, 'r+b') as prefilter_file:
+        fcntl.flock(prefilter_file, fcntl.LOCK_EX)
+        mapping = mmap.mmap(prefilter_file.fileno(), 0)
+        try:
+            if len(mapping) < HEADER.size:
+                raise PrefilterError("Truncated prefilter: %s" % path)
+            magic, version, flags, _, hashes, bits, _ = \
+                HEADER.unpack_from(mapping)
+            if magic != MAGIC or version != VERSION or \
+                    len(mapping) != HEADER.size + bits // 8:
+                raise PrefilterError("Unsupported prefilter: %s" % path)
+            for encoded in names:
+                for position in _positions(encoded, hashes, bits):
+                    offset = HEADER.size + (position >> 3)
+                    mapping[offset] |= 1 << (position & 7)
+            if disable_doh:
+                flags |= FLAG_DISABLE_DOH
+            struct.pack_into('=I', mapping, FLAGS_OFFSET, flags)
+            struct.pack_into('=I', mapping, GENERATION_OFFSET, generation)
+        finally:
+            mapping.close()
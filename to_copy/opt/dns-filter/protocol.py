@@ -0,0 +1,106 @@
+"""
+Wire format spoken between the dns-filter daemon and its clients.
+
+The unbound module (/usr/local/unbound-1.7/sbin/filter_client.py) runs under
+unbound's embedded Python 2.7 and keeps its own copy of these constants; keep
+the two in sync.
+
+Clients either send a single JSON object and read a JSON reply, one query per
+connection (the original protocol, still supported for older clients), or open
+the connection with PROTOCOL_MAGIC and then exchange length-prefixed frames
+over a long-lived connection:
+
+    +---------+------------+----+---------+
+    | length  | request id | op | payload |
+    |  u16    |    u32     | u8 |         |
+    +---------+------------+----+---------+
+
+Requests may be pipelined. Every response echoes the request id and op of the
+request it answers, or carries OP_ERROR and a UTF-8 message.
+"""
+
+import struct
+
+
+PROTOCOL_MAGIC = b'\xfeEF\x01'
+FRAME_HEADER = struct.Struct('!HIB')
+MAX_PAYLOAD = 0xffff
+
+# payload: domain name, optionally followed by a newline and the lists to
+# block by (comma separated; all of them by default); reply: QUERY_REPLY
+OP_QUERY = 0x01
+# payload: IP_CHECK_HEADER, that many IPv4 addresses (4 bytes each, network
+# order), then optionally the lists to block by; reply: QUERY_REPLY, blocked
+# if any of the addresses is
+OP_CHECK_IPS = 0x02
+OP_ADD = 0x10  # payload: list name, then domains, newline separated
+OP_REMOVE = 0x11  # as OP_ADD; reply to both: DELTA_REPLY
+OP_STATS = 0x20  # no payload; reply: JSON object of counters
+OP_ERROR = 0xff  # payload: error message
+
+# flags, then the generation of the filter list that answered; it changes
+# whenever the lists are (re)loaded so clients know to drop cached verdicts
+QUERY_REPLY = struct.Struct('!BI')
+FLAG_BLOCKED = 0x01
+FLAG_DISABLE_DOH = 0x02
+FLAG_CHECK_IPS = 0x04  # there are IP lists, so answers are worth checking
+
+IP_CHECK_HEADER = struct.Struct('!B')  # the number of addresses
+MAX_IP_CHECK = 255
+
+# the number of domains applied
+DELTA_REPLY = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(request_id, op, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("Frame payload too large: %d bytes" % len(payload))
+    return FRAME_HEADER.pack(len(payload), request_id, op) + payload
+
+
+def decode_frames(buf):
+    """
+    Returns a list of (request_id, op, payload) for every complete frame at
+    the start of the bytearray `buf`, removing them from it.
+    """
+    frames = []
+    offset = 0
+    while len(buf) - offset >= FRAME_HEADER.size:
+        length, request_id, op = FRAME_HEADER.unpack_from(buf, offset)
+        end = offset + FRAME_HEADER.size + length
+        if len(buf) < end:
+            break
+        frames.append((request_id, op, bytes(buf[offset + FRAME_HEADER.size:end])))
+        offset = end
+    del buf[:offset]
+    return frames
+
+
+def encode_ip_check(addresses, profile=''):
+    """
+    An OP_CHECK_IPS payload for `addresses`, packed 4-byte strings.
+    """
+    if len(addresses) > MAX_IP_CHECK:
+        raise ProtocolError("Too many addresses: %d" % len(addresses))
+    return IP_CHECK_HEADER.pack(len(addresses)) + b''.join(addresses) + \
+        profile.encode('utf-8')
+
+
+def decode_ip_check(payload):
+    """
+    Returns the addresses (as integers) and the profile of an OP_CHECK_IPS
+    payload.
+    """
+    if len(payload) < IP_CHECK_HEADER.size:
+        raise ProtocolError("Empty address check")
+    count, = IP_CHECK_HEADER.unpack_from(payload)
+    end = IP_CHECK_HEADER.size + 4 * count
+    if len(payload) < end:
+        raise ProtocolError("Truncated address check")
+    addresses = struct.unpack_from('!%dI' % count, payload,
+                                   IP_CHECK_HEADER.size)
+    return addresses, payload[end:].decode('utf-8')
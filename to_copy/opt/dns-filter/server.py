@@ -1,20 +1,53 @@
 #!/usr/bin/env python3
 
 from contextlib import closing
+from zlib import crc32
+import hashlib
+import selectors
 import socket
 import os
 import sys
 import grp
 import pwd
 import json
+import signal
+import threading
+import time
 
 import daemon
+import pool
+import prefilter
+import protocol
+import stats
+from index import DomainIndex, SnapshotError, MAX_LISTS
+from ip_index import IPIndex
+from journal import Journal, ADD, REMOVE, LIST_NAME_RE, DOMAIN_RE
 
 
 # daemon configuration
 FILTERS_DIR = "/etc/encryptme/filters"
 SOCKET_PATH = "/usr/local/unbound-1.7/etc/unbound/dns_filter.sock"
 PID_FILE    = "/usr/local/unbound-1.7/etc/unbound/dns-filter.pid"
+SNAPSHOT_PATH = FILTERS_DIR + "/domains.snapshot"
+JOURNAL_PATH = FILTERS_DIR + "/domains.journal"
+PREFILTER_PATH = "/usr/local/unbound-1.7/etc/unbound/dns_filter.bloom"
+LISTEN_BACKLOG = 1024  # every unbound thread may be connecting at once
+FILTERS_POLL_INTERVAL = 5  # seconds between checks for changed list files
+
+# JSON requests are one small object; anything bigger is garbage
+MAX_REQUEST_SIZE = 2048
+RECV_SIZE = 65536
+
+ALL_LISTS = (1 << MAX_LISTS) - 1
+# lists past the first MAX_LISTS - 1 share the last bit, which then only the
+# empty profile (every list) matches
+OVERFLOW_BIT = 1 << (MAX_LISTS - 1)
+MAX_PROFILES = 256
+
+
+def prefilter_base_path(snapshot_path):
+    # compiled alongside the snapshot, before any deltas
+    return snapshot_path + '.bloom'
 
 
 def delete_socket_path(socket_path):
@@ -26,13 +59,34 @@ def delete_socket_path(socket_path):
 
 
 class FilterList:
-    def __init__(self, filters_dir):
+    def __init__(self, filters_dir, index_class=DomainIndex,
+                 snapshot_path=None, journal=None, log=print):
         """
-        Build entries from file.
+        Build entries from file, or map them from a compiled snapshot if one
+        is given and still matches the list files. Changes in the journal
+        that have yet to be compacted into the files are then replayed.
         """
+        self.log = log
         self.disable_doh = False
-        self.blacklist = set()
-        self.load(filters_dir)
+        self.index = index_class()
+        # the IP lists, for checking answers; their bits are allocated
+        # after the domain lists'
+        self.ips = IPIndex()
+        self.generation = 0
+        self.loaded_digest = None
+        self.loaded_ip_digest = None
+        self.loaded_at = None
+        # domain -> [mask of lists added to, mask of lists removed from] for
+        # changes made since the lists were written; the index itself is
+        # never modified in place
+        self.delta = {}
+        # profile (comma separated list names) -> mask of those lists
+        self.profiles = {}
+        started = time.monotonic()
+        self.load(filters_dir, snapshot_path)
+        if journal is not None:
+            self.replay(journal)
+        self.load_seconds = time.monotonic() - started
 
     @staticmethod
     def _yield_lines(path):
@@ -40,73 +94,958 @@ class FilterList:
             for item in list_file:
                 yield item.strip()
 
-    def load(self, filters_dir):
+    @staticmethod
+    def list_name(path):
+        return os.path.basename(path)[:-len('.domains.blacklist')]
+
+    @staticmethod
+    def _list_paths(filters_dir):
+        return sorted(
+            os.path.join(filters_dir, name)
+            for name in os.listdir(filters_dir)
+            if name.endswith('.domains.blacklist')
+        )
+
+    @classmethod
+    def source_digest(cls, filters_dir):
+        """
+        Fingerprints the list files by name, size and mtime, so we can tell
+        whether a snapshot was compiled from what is on disk now.
+        """
+        digest = hashlib.sha1()
+        if os.path.isdir(filters_dir):
+            for path in cls._list_paths(filters_dir):
+                stat = os.stat(path)
+                digest.update(('%s\0%d\0%d\n' % (
+                    path, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        return digest.digest()[:16]
+
+    @classmethod
+    def files_digest(cls, filters_dir):
+        """
+        Fingerprints the domain and IP list files, to poll them for changes.
+        """
+        return cls.source_digest(filters_dir) + \
+            IPIndex.source_digest(filters_dir)
+
+    def load(self, filters_dir, snapshot_path=None):
+        # before the files are read, so compactions after then are replayed
+        self.loaded_at = time.time()
+        self.loaded_ip_digest = IPIndex.source_digest(filters_dir)
+        self._load_domains(filters_dir, snapshot_path)
+        if os.path.isdir(filters_dir):
+            self.ips = IPIndex.load(filters_dir, self._list_bit)
+        overflow = self.index.lists[MAX_LISTS - 1:]
+        if len(overflow) > 1:
+            self.log("Too many lists (at most %d); only clients without a "
+                     "profile are filtered by %s" % (
+                         MAX_LISTS, ', '.join(overflow)))
+
+    def _load_domains(self, filters_dir, snapshot_path=None):
+        self.loaded_digest = self.source_digest(filters_dir)
+        # derived from the content, so every worker serving the same lists
+        # and changes agrees on it, and each change moves it along
+        self.generation = crc32(self.loaded_digest)
         if not os.path.isdir(filters_dir):
             return
-        for name in os.listdir(filters_dir):
-            if not name.endswith('.domains.blacklist'):
-                continue
-            for domain in self._yield_lines(os.path.join(filters_dir, name)):
-                self.blacklist.add(domain)
-        self.disable_doh = bool(self.blacklist)
+        if snapshot_path is not None:
+            try:
+                self.index = DomainIndex.open_snapshot(
+                    snapshot_path, self.loaded_digest)
+            except (OSError, SnapshotError):
+                pass  # missing or stale; fall back to the list files
+            else:
+                self.disable_doh = bool(len(self.index))
+                return
+        for path in self._list_paths(filters_dir):
+            list_bit = self._list_bit(self.list_name(path))
+            for domain in self._yield_lines(path):
+                self.index.add(domain, list_bit)
+        self.disable_doh = bool(len(self.index))
+
+    def save_snapshot(self, snapshot_path, source_digest):
+        self.index.save_snapshot(snapshot_path, source_digest)
+
+    def build_prefilter(self, base_path=None):
+        """
+        A prefilter over every domain blocked by this list, starting from
+        the one compiled with the snapshot if it is still current.
+        """
+        try:
+            bloom = prefilter.Prefilter.load(base_path, self.loaded_digest)
+        except (TypeError, OSError, prefilter.PrefilterError):
+            bloom = prefilter.Prefilter.build(
+                self.index.encoded_names(), len(self.index))
+        for domain, change in self.delta.items():
+            if change[0]:
+                bloom.add(domain.encode('utf-8'))
+        return bloom
+
+    def _list_bit(self, list_name):
+        lists = self.index.lists
+        if list_name not in lists:
+            lists.append(list_name)
+            self.profiles.clear()
+        return min(1 << lists.index(list_name), OVERFLOW_BIT)
+
+    def has_room_for(self, list_name):
+        """
+        Whether changes to `list_name` can be applied: it is one of ours, or
+        there is a bit left for it.
+        """
+        lists = self.index.lists
+        return list_name in lists or len(lists) < MAX_LISTS
+
+    def profile_mask(self, profile):
+        """
+        The mask of the lists named in `profile`, comma separated; lists we
+        don't have, or that overflowed, are ignored. An empty profile means
+        every list.
+        """
+        if not profile:
+            return ALL_LISTS
+        mask = self.profiles.get(profile)
+        if mask is None:
+            lists = self.index.lists
+            mask = 0
+            for list_name in profile.split(','):
+                list_name = list_name.strip()
+                if list_name in lists:
+                    bit = 1 << lists.index(list_name)
+                    # unless it is the last list's alone
+                    if bit < OVERFLOW_BIT or len(lists) == MAX_LISTS:
+                        mask |= bit
+            # clients each send one profile, so this stays tiny
+            if len(self.profiles) >= MAX_PROFILES:
+                self.profiles.clear()
+            self.profiles[profile] = mask
+        return mask
+
+    def apply_delta(self, op, list_name, domains):
+        added = op == ADD
+        list_bit = self._list_bit(list_name)
+        generation = self.generation
+        for domain in domains:
+            change = self.delta.get(domain)
+            if change is None:
+                change = self.delta[domain] = [0, 0]
+            if added:
+                change[0] |= list_bit
+                change[1] &= ~list_bit
+            else:
+                change[0] &= ~list_bit
+                change[1] |= list_bit
+            generation = crc32(('%s\t%s\t%s' % (
+                op, list_name, domain)).encode('utf-8'), generation)
+        self.generation = generation
+        if added and domains:
+            self.disable_doh = True
+
+    def replay(self, journal):
+        """
+        Rebuilds the changes made since the lists were written from the
+        journal, e.g. after another worker has recorded some.
+        """
+        self.delta = {}
+        self.generation = crc32(self.loaded_digest)
+        self.disable_doh = bool(len(self.index))
+        skipped = {}
+        for op, list_name, domain in journal.replay(self.loaded_at):
+            try:
+                self.apply_delta(op, list_name, [domain])
+            except ValueError as err:
+                # one bad change mustn't keep the rest, or the daemon, down
+                key = (list_name, str(err))
+                skipped[key] = skipped.get(key, 0) + 1
+        for (list_name, err), count in sorted(skipped.items()):
+            self.log("Skipped %d journalled changes to %s: %s" % (
+                count, list_name, err))
+
+    def match(self, domain):
+        """
+        Returns the mask of the lists this domain, or any parent domain of
+        it, is on.
+        """
+        if not self.delta:
+            return self.index.match(domain)
+        mask = 0
+        name = domain
+        while '.' in name:
+            found = self.index.contains(name)
+            change = self.delta.get(name)
+            if change is not None:
+                found = (found | change[0]) & ~change[1]
+            mask |= found
+            name = name[name.find('.') + 1:]
+        return mask
 
-    def is_blocked(self, domain):
+    def is_blocked(self, domain, profile=None):
         '''
         Returns whether this domain is blocked or is a sub-domain of a blocked
-        domain.
+        domain, by any list in the profile if one is given.
         '''
-        name = domain
-        while '.' in name:
-            if name in self.blacklist:
+        return bool(self.match(domain) & self.profile_mask(profile))
+
+    def blocks_address(self, addresses, profile=None):
+        """
+        Returns whether any of the addresses (integers) is on an IP list in
+        the profile, if one is given, or on any of them.
+        """
+        mask = self.profile_mask(profile)
+        for address in addresses:
+            if self.ips.match(address) & mask:
                 return True
-            name = name[name.find('.') + 1:]
         return False
 
 
+class Connection:
+    """
+    A non-blocking client connection. Requests are buffered until complete
+    and responses until the socket takes them, so one slow client can't stall
+    anyone else.
+
+    The first bytes sent pick the protocol: a JSON object gets one JSON answer
+    and the connection is closed, while PROTOCOL_MAGIC opens a long-lived
+    connection of pipelined binary frames (see protocol.py).
+    """
+    MODE_JSON = 'json'
+    MODE_BINARY = 'binary'
+
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.events = selectors.EVENT_READ
+        self.mode = None
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.hangup = False
+        self.ops = {
+            protocol.OP_QUERY: self._op_query,
+            protocol.OP_CHECK_IPS: self._op_check_ips,
+            protocol.OP_ADD: self._op_add,
+            protocol.OP_REMOVE: self._op_remove,
+            protocol.OP_STATS: self._op_stats,
+        }
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def on_readable(self):
+        """
+        Reads and answers whatever the client sent. Returns False once the
+        connection should be closed.
+        """
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        self.inbuf += data
+        if not self._process():
+            return False
+        # on EOF we only stick around long enough to flush our answers
+        return bool(data) or bool(self.outbuf)
+
+    def on_writable(self):
+        """
+        Flushes pending output. Returns False once the connection should be
+        closed.
+        """
+        try:
+            sent = self.sock.send(self.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        del self.outbuf[:sent]
+        return bool(self.outbuf) or not self.hangup
+
+    def _process(self):
+        """
+        Answers any requests that have fully arrived. Returns False if the
+        client sent something invalid.
+        """
+        if self.mode is None:
+            if self.inbuf[:1] == b'{':
+                self.mode = self.MODE_JSON
+            elif self.inbuf[:len(protocol.PROTOCOL_MAGIC)] == \
+                    protocol.PROTOCOL_MAGIC:
+                self.mode = self.MODE_BINARY
+                del self.inbuf[:len(protocol.PROTOCOL_MAGIC)]
+            elif len(self.inbuf) >= len(protocol.PROTOCOL_MAGIC):
+                return False
+            else:
+                return True
+        if self.mode == self.MODE_JSON:
+            return self._process_json()
+        return self._process_frames()
+
+    def _process_json(self):
+        if self.hangup:
+            return True
+        try:
+            request = json.loads(self.inbuf.decode('utf-8'))
+        except ValueError:
+            # most likely we just don't have all of it yet
+            return len(self.inbuf) <= MAX_REQUEST_SIZE
+        try:
+            domain = request['domain'].strip()
+            profile = request.get('lists') or ''
+            if not isinstance(profile, str):
+                profile = ','.join(profile)
+        except (TypeError, KeyError, AttributeError):
+            return False
+        filter_list = self.server.filter_list
+        response = [self._lookup(filter_list, domain, profile),
+                    filter_list.disable_doh]
+        self.outbuf += json.dumps(response).encode('utf-8')
+        self.inbuf.clear()
+        # one answer per connection, after which we hang up
+        self.hangup = True
+        return True
+
+    def _process_frames(self):
+        frames = protocol.decode_frames(self.inbuf)
+        if frames:
+            self.server.stats.observe_depth(len(frames))
+        for request_id, op, payload in frames:
+            handler = self.ops.get(op)
+            if handler is None:
+                self._reply_error(request_id, "Unknown op: %d" % op)
+                continue
+            try:
+                reply = handler(payload)
+            except (ValueError, protocol.ProtocolError) as err:
+                self._reply_error(request_id, str(err))
+                continue
+            self.outbuf += protocol.encode_frame(request_id, op, reply)
+        return True
+
+    def _reply_error(self, request_id, message):
+        self.server.stats.incr(stats.ERRORS)
+        self.outbuf += protocol.encode_frame(
+            request_id, protocol.OP_ERROR, message.encode('utf-8'))
+
+    def _op_query(self, payload):
+        # the list may be swapped by a reload at any time; stick to one
+        filter_list = self.server.filter_list
+        flags = 0
+        domain, _, profile = payload.decode('utf-8').partition('\n')
+        if self._lookup(filter_list, domain.strip(), profile):
+            flags |= protocol.FLAG_BLOCKED
+        if filter_list.disable_doh:
+            flags |= protocol.FLAG_DISABLE_DOH
+        if len(filter_list.ips):
+            flags |= protocol.FLAG_CHECK_IPS
+        return protocol.QUERY_REPLY.pack(flags, filter_list.generation)
+
+    def _op_check_ips(self, payload):
+        filter_list = self.server.filter_list
+        addresses, profile = protocol.decode_ip_check(payload)
+        flags = protocol.FLAG_CHECK_IPS if len(filter_list.ips) else 0
+        self.server.stats.incr(stats.IP_CHECKS)
+        if filter_list.blocks_address(addresses, profile):
+            flags |= protocol.FLAG_BLOCKED
+            self.server.stats.incr(stats.IP_BLOCKED)
+        return protocol.QUERY_REPLY.pack(flags, filter_list.generation)
+
+    def _lookup(self, filter_list, domain, profile):
+        server_stats = self.server.stats
+        if server_stats.count_request():
+            started = time.perf_counter()
+            blocked = filter_list.is_blocked(domain, profile)
+            server_stats.observe_lookup(time.perf_counter() - started)
+        else:
+            blocked = filter_list.is_blocked(domain, profile)
+        if blocked:
+            server_stats.incr(stats.BLOCKED)
+        return blocked
+
+    def _op_stats(self, payload):
+        return json.dumps(self.server.stats_report()).encode('utf-8')
+
+    def _op_add(self, payload):
+        return self._delta(ADD, payload)
+
+    def _op_remove(self, payload):
+        return self._delta(REMOVE, payload)
+
+    def _delta(self, op, payload):
+        lines = payload.decode('utf-8').split('\n')
+        list_name = lines[0].strip()
+        if not LIST_NAME_RE.match(list_name):
+            raise ValueError("Invalid list name: %r" % list_name)
+        domains = [
+            line.strip() for line in lines[1:]
+            if DOMAIN_RE.match(line.strip())
+        ]
+        self.server.apply_delta(op, list_name, domains)
+        return protocol.DELTA_REPLY.pack(len(domains))
+
+
+def _request(socket_path, op, payloads):
+    """
+    Pipelines one request per payload to a running daemon and returns the
+    reply payloads, in order.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(sock):
+        sock.connect(socket_path)
+        sock.sendall(protocol.PROTOCOL_MAGIC + b''.join(
+            protocol.encode_frame(request_id, op, payload)
+            for request_id, payload in enumerate(payloads)
+        ))
+        buf = bytearray()
+        replies = []
+        while len(replies) < len(payloads):
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                raise protocol.ProtocolError("Connection closed by daemon")
+            buf += data
+            replies.extend(protocol.decode_frames(buf))
+    for _, reply_op, payload in replies:
+        if reply_op == protocol.OP_ERROR:
+            raise protocol.ProtocolError(payload.decode('utf-8'))
+    return [payload for _, _, payload in sorted(replies)]
+
+
+def send_delta(socket_path, op, list_name, domains):
+    """
+    Has a running daemon add or remove domains from a list; returns the
+    number of domains it accepted.
+    """
+    request_op = protocol.OP_ADD if op == ADD else protocol.OP_REMOVE
+    header = (list_name + '\n').encode('utf-8')
+    frames = []
+    payload = bytearray(header)
+    for domain in domains:
+        line = (domain.strip() + '\n').encode('utf-8')
+        if len(payload) + len(line) > protocol.MAX_PAYLOAD:
+            frames.append(bytes(payload))
+            payload = bytearray(header)
+        payload += line
+    frames.append(bytes(payload))
+    return sum(
+        protocol.DELTA_REPLY.unpack(reply)[0]
+        for reply in _request(socket_path, request_op, frames)
+    )
+
+
+def request_stats(socket_path):
+    """
+    Fetches the counters of a running daemon (see FilterDaemon.stats_report).
+    """
+    reply, = _request(socket_path, protocol.OP_STATS, [b''])
+    return json.loads(reply.decode('utf-8'))
+
+
+def compile_snapshot(filters_dir, snapshot_path):
+    """
+    Compiles the list files into a snapshot the daemon can map at start-up.
+    """
+    # fingerprint first: if the lists change while we read them the snapshot
+    # will simply be seen as stale
+    source_digest = FilterList.source_digest(filters_dir)
+    filter_list = FilterList(filters_dir)
+    filter_list.save_snapshot(snapshot_path, source_digest)
+    filter_list.build_prefilter().save(
+        prefilter_base_path(snapshot_path), source_digest=source_digest)
+    return filter_list
+
+
 class FilterDaemon(daemon.Daemon):
-    def __init__(self, socket_path, filters_dir, **kwargs):
+    """
+    Serves lookups against a FilterList. The list is rebuilt in the
+    background on SIGHUP or when the list files change, and swapped in once
+    ready; until then the old one keeps answering.
+
+    With more than one worker, a supervisor loads the list (mapped from the
+    snapshot where possible) and then forks workers that share it and the
+    listening socket. The supervisor watches the list files and passes
+    SIGHUP on; a worker that takes a delta journals it and has the others
+    replay the journal.
+
+    It reports ready once the list is loaded and the socket is listening. On
+    SIGTERM it stops accepting and closes each connection once it has no
+    request in flight; unbound's module retries on a fresh one. On SIGUSR2
+    (`restart`) it hands the listening socket to a new copy of itself, and
+    drains once that is ready, so no connection is refused in between.
+    """
+    reports_ready = True
+    drains = True
+    hands_off = True
+
+    def __init__(self, socket_path, filters_dir, snapshot_path=None,
+                 journal_path=None, prefilter_path=None, workers=1, **kwargs):
         self.socket_path = socket_path
+        self.prefilter_path = prefilter_path
         self.filters_dir = filters_dir
+        self.snapshot_path = snapshot_path
+        self.journal = Journal(journal_path) if journal_path else None
+        self.workers = workers
+        # shared by the workers, so it has to exist before they are forked
+        self.stats = stats.Stats(max(workers, 1))
+        self.started = time.time()
+        self.pool = None
+        self.heartbeat = None  # set in worker processes
+        self.next_heartbeat = 0
+        self.filter_list = None
+        self.reload_requested = False
+        self.replay_requested = False
+        self.reload_thread = None
+        # set by the thread once it is done; it may still be alive when
+        # its wakeup arrives
+        self.reload_done = threading.Event()
+        self.reloaded_list = None
+        # deltas made while a reload is in progress, to carry over to the
+        # new list in case its journal replay missed them
+        self.reload_deltas = []
+        self.polled_digest = None
+        self.next_poll = 0
+        self.wakeup = None
+        self.sock = None
         super(FilterDaemon, self).__init__(**kwargs)
 
+    def _load_filter_list(self):
+        return FilterList(self.filters_dir, snapshot_path=self.snapshot_path,
+                          journal=self.journal, log=self.log)
+
+    def _load_shared_filter_list(self):
+        """
+        Loads the list for the workers to share, compiling the snapshot
+        first if it is stale so they all map the same pages.
+        """
+        filter_list = self._load_filter_list()
+        if self.snapshot_path is None or filter_list.index.mapping is not None \
+                or not len(filter_list.index):
+            return filter_list
+        try:
+            filter_list.save_snapshot(
+                self.snapshot_path, filter_list.loaded_digest)
+        except OSError as err:
+            # the workers still share it copy-on-write
+            self.log("Failed to compile filter lists: %s" % err)
+            return filter_list
+        return self._load_filter_list()
+
+    def _publish_prefilter(self, filter_list):
+        if self.prefilter_path is None:
+            return
+        base_path = None
+        if self.snapshot_path is not None:
+            base_path = prefilter_base_path(self.snapshot_path)
+        try:
+            filter_list.build_prefilter(base_path).save(
+                self.prefilter_path, filter_list.generation,
+                filter_list.disable_doh)
+        except OSError as err:
+            # clients see the old one's generation is stale and ignore it
+            self.log("Failed to publish prefilter: %s" % err)
+
+    def _update_prefilter(self, domains=()):
+        """
+        Adds domains to the published prefilter and stamps it with the
+        generation we now serve.
+        """
+        if self.prefilter_path is None:
+            return
+        try:
+            prefilter.update(
+                self.prefilter_path,
+                [domain.encode('utf-8') for domain in domains],
+                self.filter_list.generation, self.filter_list.disable_doh)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, prefilter.PrefilterError) as err:
+            self.log("Failed to update prefilter: %s" % err)
+
+    def _catch_up_prefilter(self):
+        # deltas a worker made while we were building it went into the
+        # file it replaced; the journal has them all
+        if self.journal is not None:
+            self._update_prefilter(
+                domain for op, _, domain in self.journal.replay()
+                if op == ADD)
+
+    def apply_delta(self, op, list_name, domains):
+        # checked before journalling: a change that can't be applied would
+        # fail every replay of the journal after it
+        if not self.filter_list.has_room_for(list_name):
+            raise ValueError("Too many lists (at most %d)" % MAX_LISTS)
+        if self.journal is not None:
+            self.journal.append(op, list_name, domains)
+        self.filter_list.apply_delta(op, list_name, domains)
+        self._update_prefilter(domains if op == ADD else ())
+        self.stats.incr(stats.DELTAS, len(domains))
+        if self.reload_thread is not None:
+            self.reload_deltas.append((op, list_name, domains))
+        if self.heartbeat is not None and self.journal is not None:
+            # the supervisor passes this on to every worker
+            os.kill(os.getppid(), signal.SIGUSR1)
+
     def run(self):
-        filter_list = FilterList(self.filters_dir)
+        if self.workers > 1:
+            self.filter_list = self._load_shared_filter_list()
+        else:
+            self.filter_list = self._load_filter_list()
+        self._publish_prefilter(self.filter_list)
 
-        delete_socket_path(self.socket_path)
+        # from the daemon we replace, already bound and listening
+        sock = self.inherited_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if sock is None:
+            delete_socket_path(self.socket_path)
 
-        #create the socket
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        with closing(sock):
+            #create the socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             sock.bind(self.socket_path)
-            sock.listen(1)
+            sock.listen(LISTEN_BACKLOG)
+        self.sock = sock
+        with closing(sock):
+            sock.setblocking(False)
             if not os.path.exists(self.filters_dir):
                 os.makedirs(self.filters_dir)
             uid = pwd.getpwnam("unbound").pw_uid
             gid = grp.getgrnam("unbound").gr_gid
             os.chown(self.socket_path, uid, gid)
-            self._run_loop(sock, filter_list)
+            self.notify_ready()
+            if self.workers > 1:
+                self.pool = pool.WorkerPool(
+                    self.workers,
+                    serve=lambda slot, heartbeat: self._serve_worker(
+                        sock, slot, heartbeat),
+                    on_reload=self._reload_shared,
+                    on_tick=self._poll_shared,
+                    log=self.log,
+                )
+                self.pool.run()
+            else:
+                self._run_loop(sock)
+
+    def _serve_worker(self, sock, slot, heartbeat):
+        self.stats.use_slot(slot)
+        self.heartbeat = heartbeat
+        # drain like a lone daemon would, rather than exit
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        os.set_blocking(heartbeat, False)
+        # pick up any deltas made since the supervisor loaded the list
+        self.replay_requested = True
+        self._run_loop(sock)
+
+    def _poll_shared(self):
+        if self.handoff_requested:
+            self._start_replacement()
+        if self.replacement is not None:
+            self._check_replacement()
+            if not self.daemon_alive:
+                # the workers drain, the replacement's take over
+                self.pool.stop()
+                return
+        if self._filters_changed():
+            self.pool.reload()
+
+    def _reload_shared(self):
+        started = time.monotonic()
+        try:
+            self.filter_list = self._load_shared_filter_list()
+        except Exception as err:
+            self.stats.incr(stats.RELOAD_FAILURES)
+            self.log("Failed to reload filter lists: %s" % err)
+        else:
+            # counted here, once, rather than by every worker reloading too;
+            # none of them touches these fields of the slot we share
+            self.stats.incr(stats.RELOADS)
+            self._publish_prefilter(self.filter_list)
+            self._catch_up_prefilter()
+            self.log("Reloaded %d domains and %d IP ranges in %.2fs" % (
+                len(self.filter_list.index), len(self.filter_list.ips),
+                time.monotonic() - started))
+
+    def _run_loop(self, sock):
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        # signals write to this pipe so they wake us from select() promptly
+        wakeup_r, wakeup_w = socket.socketpair()
+        wakeup_r.setblocking(False)
+        wakeup_w.setblocking(False)
+        self.wakeup = wakeup_w
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        signal.set_wakeup_fd(wakeup_w.fileno())
+        signal.signal(signal.SIGHUP, self._on_sighup)
+        signal.signal(signal.SIGUSR1, self._on_sigusr1)
+        pool.unblock_signals()
+        timeout = FILTERS_POLL_INTERVAL
+        if self.heartbeat is not None:
+            timeout = pool.HEARTBEAT_INTERVAL
+        with closing(selector), closing(wakeup_r), closing(wakeup_w):
+            while True:
+                wait = timeout
+                if not self.daemon_alive:
+                    if self._drain_clients(selector, sock) or \
+                            self.drain_expired():
+                        return
+                    wait = min(timeout, self.drain_deadline - time.monotonic())
+                for key, events in selector.select(wait):
+                    if key.fileobj is sock:
+                        self._accept(selector, sock)
+                    elif key.fileobj is wakeup_r:
+                        self._drain(wakeup_r)
+                    elif self.replacement is not None and \
+                            key.fileobj == self.replacement[1]:
+                        self._check_replacement(selector)
+                    else:
+                        self._service(selector, key.fileobj, events)
+                if self.heartbeat is not None:
+                    self._send_heartbeat()
+                elif self.handoff_requested:
+                    # the supervisor does this for workers
+                    self._start_replacement(selector)
+                self._check_reload()
+
+    def _start_replacement(self, selector=None):
+        self.handoff_requested = False
+        if self.replacement is not None or not self.daemon_alive:
+            return  # one is on its way already, or we're going anyway
+        try:
+            ready_r = self.start_replacement(self.sock)
+        except OSError as err:
+            self.log("Failed to start a replacement: %s" % err)
+            return
+        if selector is not None:
+            selector.register(ready_r, selectors.EVENT_READ)
+
+    def _check_replacement(self, selector=None):
+        ready_r = self.replacement[1]
+        ready = self.replacement_ready()
+        if ready is None:
+            return
+        if selector is not None:
+            selector.unregister(ready_r)
+        if ready:
+            self.stop_serving()
 
-    def _run_loop(self, sock, filter_list):
+    def _drain_clients(self, selector, sock):
+        """
+        Stops accepting connections, and closes those with no request or
+        answer in flight; True once they are all closed.
+        """
+        if sock in selector.get_map():
+            selector.unregister(sock)
+            self.log("Draining connections")
+        draining = False
+        for key in list(selector.get_map().values()):
+            conn = key.fileobj
+            if not isinstance(conn, Connection):
+                continue
+            if not (conn.inbuf or conn.outbuf):
+                # answer whatever has just come in, rather than reset a
+                # client that has sent a request
+                self._service(selector, conn, selectors.EVENT_READ)
+                if conn.fileno() < 0:
+                    continue  # closed
+            if conn.inbuf or conn.outbuf:
+                draining = True
+                continue
+            selector.unregister(conn)
+            conn.close()
+            self.stats.incr(stats.CLOSED)
+        return not draining
+
+    def _send_heartbeat(self):
+        # from the event loop itself, so a wedged worker stops sending them
+        now = time.monotonic()
+        if now < self.next_heartbeat:
+            return
+        self.next_heartbeat = now + pool.HEARTBEAT_INTERVAL
+        try:
+            os.write(self.heartbeat, b'.')
+        except BlockingIOError:
+            pass  # the supervisor is busy; it has plenty of them queued
+
+    def _on_sighup(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_sigusr1(self, signum, frame):
+        self.replay_requested = True
+
+    def _filters_changed(self):
+        """
+        Polls the list files; True once they have settled after changing.
+        """
+        now = time.monotonic()
+        if now < self.next_poll:
+            return False
+        self.next_poll = now + FILTERS_POLL_INTERVAL
+        digest = FilterList.files_digest(self.filters_dir)
+        # wait for a second identical poll so we don't load half-written
+        # lists; pep-filter.sh sends a SIGHUP when done with domain lists
+        loaded = self.filter_list.loaded_digest + \
+            self.filter_list.loaded_ip_digest
+        changed = digest != loaded and digest == self.polled_digest
+        self.polled_digest = digest
+        return changed
+
+    def _check_reload(self):
+        """
+        Starts a background reload if one was asked for or the list files
+        have settled after changing.
+        """
+        # workers leave watching the files to the supervisor
+        if self.heartbeat is None and self._filters_changed():
+            self.reload_requested = True
+        if self.reload_thread is not None and self.reload_done.is_set():
+            self._finish_reload()
+        if self.replay_requested and self.journal is not None:
+            self.replay_requested = False
+            self.filter_list.replay(self.journal)
+            self._update_prefilter()
+        if not self.reload_requested or self.reload_thread is not None:
+            return  # nothing to do, or we'll get to it once this one is done
+        self.reload_requested = False
+        self.reload_deltas = []
+        self.reload_done.clear()
+        self.reload_thread = threading.Thread(
+            target=self._reload, name='reload', daemon=True)
+        self.reload_thread.start()
+
+    def _reload(self):
+        started = time.monotonic()
+        try:
+            self.reloaded_list = self._load_filter_list()
+            if self.heartbeat is None:
+                # workers leave this to the supervisor
+                self._publish_prefilter(self.reloaded_list)
+        except Exception as err:
+            if self.heartbeat is None:
+                # the supervisor counts the workers' reloads
+                self.stats.incr(stats.RELOAD_FAILURES)
+            self.log("Failed to reload filter lists: %s" % err)
+        else:
+            if self.heartbeat is None:
+                self.stats.incr(stats.RELOADS)
+            self.log("Reloaded %d domains and %d IP ranges in %.2fs" % (
+                len(self.reloaded_list.index), len(self.reloaded_list.ips),
+                time.monotonic() - started))
+        # let the main loop swap it in right away
+        self.reload_done.set()
+        try:
+            self.wakeup.send(b'\0')
+        except OSError:
+            pass
+
+    def _finish_reload(self):
+        filter_list = self.reloaded_list
+        self.reload_thread = None
+        self.reloaded_list = None
+        if filter_list is None:
+            return  # failed; the old list stays
+        for op, list_name, domains in self.reload_deltas:
+            if filter_list.has_room_for(list_name):
+                filter_list.apply_delta(op, list_name, domains)
+            else:
+                self.log("Dropped changes to %s: too many lists" % list_name)
+        if self.heartbeat is not None:
+            # other workers' deltas may have come in while it loaded
+            self.replay_requested = True
+        # a plain attribute swap; requests pick up the new list from here on
+        self.filter_list = filter_list
+        if self.heartbeat is None:
+            self._update_prefilter(
+                domain for op, _, domains in self.reload_deltas if op == ADD
+                for domain in domains)
+        self.reload_deltas = []
+
+    def stats_report(self):
+        """
+        The counters of every worker, plus the state of the list this
+        process is serving, for `server.py stats` and encryptme-stats.
+        """
+        filter_list = self.filter_list
+        report = self.stats.report()
+        report.update({
+            'pid': os.getpid(),
+            'workers': self.workers,
+            'uptime': time.time() - self.started,
+            'domains': len(filter_list.index),
+            'ip_ranges': len(filter_list.ips),
+            'lists': filter_list.index.lists,
+            'delta_pending': len(filter_list.delta),
+            'generation': filter_list.generation,
+            'snapshot_mapped': filter_list.index.mapping is not None,
+            'load_seconds': filter_list.load_seconds,
+            'reloading': self.reload_thread is not None,
+        })
+        return report
+
+    @staticmethod
+    def _drain(wakeup_r):
+        try:
+            while wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _accept(self, selector, sock):
+        # drain the backlog, there may be plenty of clients waiting
         while True:
-            connection, address = sock.accept()
-            with closing(connection):
-                data = connection.recv(2048)
-                if data:
-                    request = json.loads(data)
-                    response = [
-                        filter_list.is_blocked(request['domain'].strip()),
-                        filter_list.disable_doh,
-                    ]
-                    connection.sendall(json.dumps(response).encode('utf-8'))
+            try:
+                client, _ = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. out of file descriptors; we'll retry on the next event
+                return
+            client.setblocking(False)
+            self.stats.incr(stats.ACCEPTED)
+            conn = Connection(client, self)
+            selector.register(conn, conn.events)
+
+    @staticmethod
+    def _service(selector, conn, events):
+        alive = True
+        if events & selectors.EVENT_READ:
+            alive = conn.on_readable()
+        if alive and conn.outbuf:
+            # answers are tiny, so they usually go out right away
+            alive = conn.on_writable()
+        if not alive:
+            selector.unregister(conn)
+            conn.close()
+            conn.server.stats.incr(stats.CLOSED)
+            return
+        wanted = selectors.EVENT_READ
+        if conn.outbuf:
+            wanted |= selectors.EVENT_WRITE
+        if wanted != conn.events:
+            conn.events = wanted
+            selector.modify(conn, wanted)
 
 
 if __name__ == "__main__":
     daemon = FilterDaemon(
         socket_path=SOCKET_PATH,
         filters_dir=FILTERS_DIR,
+        snapshot_path=SNAPSHOT_PATH,
+        journal_path=JOURNAL_PATH,
+        prefilter_path=PREFILTER_PATH,
+        workers=int(os.environ.get('DNS_FILTER_WORKERS', 1)),
         pidfile=PID_FILE
     )
 
+    if len(sys.argv) == 3 and sys.argv[1] in ('add', 'remove'):
+        # small updates go straight to the running daemon
+        op = ADD if sys.argv[1] == 'add' else REMOVE
+        try:
+            applied = send_delta(SOCKET_PATH, op, sys.argv[2], sys.stdin)
+        except (OSError, protocol.ProtocolError) as err:
+            sys.stderr.write("Failed to update '%s': %s\n" % (sys.argv[2], err))
+            sys.exit(1)
+        print("Applied %d domains to '%s'" % (applied, sys.argv[2]))
+        sys.exit(0)
+
     if len(sys.argv) != 2:
         print("Unknown command")
         sys.exit(2)
@@ -119,9 +1058,43 @@ if __name__ == "__main__":
         delete_socket_path(SOCKET_PATH)
     
     elif 'restart' == sys.argv[1]:
-        daemon.stop()
-        delete_socket_path(SOCKET_PATH)
-        daemon.start()
+        # the running daemon hands its socket over, see FilterDaemon
+        daemon.restart()
+
+    elif 'reload' == sys.argv[1]:
+        # have a running daemon swap in the new lists, or start one
+        pid = daemon.get_pid()
+        if pid and os.path.exists('/proc/%d' % pid):
+            os.kill(pid, signal.SIGHUP)
+        else:
+            if os.path.exists(PID_FILE):
+                os.remove(PID_FILE)
+            delete_socket_path(SOCKET_PATH)
+            daemon.start()
+
+    elif 'compile' == sys.argv[1]:
+        if not os.path.isdir(FILTERS_DIR):
+            os.makedirs(FILTERS_DIR)
+        filter_list = compile_snapshot(FILTERS_DIR, SNAPSHOT_PATH)
+        print('Compiled %d domains to %s' % (
+            len(filter_list.index), SNAPSHOT_PATH))
+
+    elif 'compact' == sys.argv[1]:
+        # fold journaled changes into the list files and pick them up
+        if Journal(JOURNAL_PATH).compact(FILTERS_DIR):
+            compile_snapshot(FILTERS_DIR, SNAPSHOT_PATH)
+            pid = daemon.get_pid()
+            if pid and os.path.exists('/proc/%d' % pid):
+                os.kill(pid, signal.SIGHUP)
+
+    elif 'stats' == sys.argv[1]:
+        # one JSON object, for encryptme-stats to collect
+        try:
+            report = request_stats(SOCKET_PATH)
+        except (OSError, protocol.ProtocolError) as err:
+            sys.stderr.write("Failed to get stats: %s\n" % err)
+            sys.exit(1)
+        print(json.dumps(report, sort_keys=True))
 
     elif 'status' == sys.argv[1]:
         try:
@@ -137,5 +1110,6 @@ if __name__ == "__main__":
         else:
             print('dns-filter is not running.')
     else:
-        print("usage: %s start|stop|restart|status" % sys.argv[0])
+        print("usage: %s start|stop|restart|reload|status|stats|compile|compact\n"
+              "       %s add|remove LIST < domains" % (sys.argv[0], sys.argv[0]))
         sys.exit(2)
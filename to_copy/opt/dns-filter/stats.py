@@ -0,0 +1,119 @@
+"""
+Counters and histograms for the dns-filter daemon.
+
+They live in an anonymous shared mapping created before the daemon forks, one
+row of u64 fields per worker, so updating one is a plain array store with no
+locking or IPC, and whichever worker answers a stats request can add up the
+rows of all of them.
+
+Histograms use power-of-two buckets: bucket 0 counts values below 1, bucket i
+values below 2**i, and the last one everything above that.
+"""
+
+import mmap
+
+
+# fields of a row
+REQUESTS = 0
+BLOCKED = 1
+ERRORS = 2
+ACCEPTED = 3
+CLOSED = 4
+DELTAS = 5
+RELOADS = 6
+RELOAD_FAILURES = 7
+LOOKUPS_TIMED = 8
+LOOKUP_NS = 9  # total time of the timed lookups
+IP_CHECKS = 10  # answers checked against the IP lists
+IP_BLOCKED = 11
+LATENCY_BUCKETS = 16  # microseconds, up to 16ms and more
+LATENCY = 12
+DEPTH_BUCKETS = 8  # requests per read, up to 64 and more
+DEPTH = LATENCY + LATENCY_BUCKETS
+ROW_SIZE = DEPTH + DEPTH_BUCKETS
+
+COUNTERS = (
+    ('requests', REQUESTS),
+    ('blocked', BLOCKED),
+    ('errors', ERRORS),
+    ('connections_accepted', ACCEPTED),
+    ('connections_closed', CLOSED),
+    ('delta_domains', DELTAS),
+    ('reloads', RELOADS),
+    ('reload_failures', RELOAD_FAILURES),
+    ('ip_checks', IP_CHECKS),
+    ('ip_blocked', IP_BLOCKED),
+)
+
+# timing every lookup would cost as much as a cache hit in the client
+LATENCY_SAMPLE = 16
+
+
+def _bucket(value, buckets):
+    return min(int(value).bit_length(), buckets - 1)
+
+
+def _histogram(values):
+    # keyed by the (exclusive) upper bound of each bucket
+    bounds = ['%d' % (1 << i) for i in range(len(values) - 1)] + ['+Inf']
+    return dict(zip(bounds, values))
+
+
+class Stats:
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.mapping = mmap.mmap(-1, slots * ROW_SIZE * 8)
+        self.rows = memoryview(self.mapping).cast('Q')
+        self.base = 0  # offset of this process' row
+
+    def use_slot(self, slot):
+        self.base = slot * ROW_SIZE
+
+    def count_request(self):
+        """
+        Counts a request; True if its lookup should be timed.
+        """
+        rows = self.rows
+        requests = rows[self.base + REQUESTS] + 1
+        rows[self.base + REQUESTS] = requests
+        return not requests % LATENCY_SAMPLE
+
+    def incr(self, field, count=1):
+        self.rows[self.base + field] += count
+
+    def observe_lookup(self, seconds):
+        rows = self.rows
+        base = self.base
+        nanoseconds = int(seconds * 1e9)
+        rows[base + LOOKUPS_TIMED] += 1
+        rows[base + LOOKUP_NS] += nanoseconds
+        rows[base + LATENCY + _bucket(nanoseconds // 1000,
+                                      LATENCY_BUCKETS)] += 1
+
+    def observe_depth(self, requests):
+        self.rows[self.base + DEPTH + _bucket(requests, DEPTH_BUCKETS)] += 1
+
+    def totals(self):
+        rows = self.rows
+        return [
+            sum(rows[slot * ROW_SIZE + field] for slot in range(self.slots))
+            for field in range(ROW_SIZE)
+        ]
+
+    def report(self):
+        """
+        Sums up every worker's row.
+        """
+        totals = self.totals()
+        report = dict((name, totals[field]) for name, field in COUNTERS)
+        report['connections_open'] = totals[ACCEPTED] - totals[CLOSED]
+        timed = totals[LOOKUPS_TIMED]
+        report['lookup_us'] = {
+            'sampled': timed,
+            'mean': totals[LOOKUP_NS] / timed / 1000 if timed else 0,
+            'buckets': _histogram(totals[LATENCY:LATENCY + LATENCY_BUCKETS]),
+        }
+        report['queue_depth'] = {
+            'buckets': _histogram(totals[DEPTH:DEPTH + DEPTH_BUCKETS]),
+        }
+        return report
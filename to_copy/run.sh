@@ -40,8 +40,8 @@ ENCRYPTME_TUNE_NETWORK=${ENCRYPTME_TUNE_NETWORK:-}
 # misc opts
 VERBOSE=${ENCRYPTME_VERBOSE:-0}
 DNS_FILTER_PID_FILE="/usr/local/unbound-1.7/etc/unbound/dns-filter.pid"
-CERT_SESSION_MAP="${ENCRYPTME_DATA_DIR}/cert_session_map"
 WG_IFACE=${WG_IFACE:-wg0}
+WG_SYNC_INTERVAL=${WG_SYNC_INTERVAL:-60}
 
 
 # helpers
@@ -176,7 +176,7 @@ fi
 cmd mkdir -p "$ENCRYPTME_DATA_DIR" \
     || fail "Failed to create Encrypt.me data dir '$ENCRYPTME_DATA_DIR'" 5
 
-touch $CERT_SESSION_MAP || fail "Failed to create cert_session_map"
+/usr/bin/cert_sessions.py init || fail "Failed to create the cert session store"
 
 # Inside the container creates /etc/sysctl.d/encryptme.conf with sysctl.conf tuning params.
 if [ "$ENCRYPTME_TUNE_NETWORK" = 1 ]; then
@@ -265,10 +265,8 @@ else
     rem "Requesting approval for PKI certs"
     encryptme_server pki --force --out "$ENCRYPTME_PKI_DIR" --wait
     rem "Downloading PKI certs"
-    encryptme_server crls --infile "$ENCRYPTME_PKI_DIR/crl_urls.txt" \
-        --out "$ENCRYPTME_PKI_DIR/crls" \
-        --format pem \
-        --post-hook "cat '$ENCRYPTME_PKI_DIR'/crls/*.pem > '$ENCRYPTME_PKI_DIR/crls.pem'"
+    # strongSwan isn't up yet to reread them
+    /usr/bin/crl_cache.py refresh --no-reload --pki-dir "$ENCRYPTME_PKI_DIR"
 fi
 
 
@@ -457,13 +455,76 @@ sysctl -w net.ipv4.ip_forward=1
 #        modprobe $mod;
 #done
 
+# one line of template.py options per template, shell quoted
+template_job() {
+    printf '%q ' "$@"
+    echo
+}
+
+get_openvpn_conf() {
+    out=$(cat "$ENCRYPTME_DATA_DIR/server.json" | jq ".target.openvpn[$1]")
+    if [ "$out" = null ]; then
+        echo ""
+    else
+        echo "$out"
+    fi
+}
+
+OPENVPN_LOGLEVEL=0
+OPENVPN_LOG_OPT=""  # Disabled in template
+[ "${ENCRYPTME_LOGGING:-}" = 1 ] && OPENVPN_LOGLEVEL=2 &&
+                                    OPENVPN_LOG_OPT="--syslog"
+STRONGSWAN_LOGLEVEL=-1
+[ "${ENCRYPTME_LOGGING:-}" = 1 ] && STRONGSWAN_LOGLEVEL=2
+
+# render every config template in one go, so the IP is looked up and each
+# template compiled just once; unchanged configs aren't rewritten
+rem "Rendering configuration templates"
+TEMPLATE_MANIFEST="$ENCRYPTME_DATA_DIR/templates.manifest"
+OPENVPN_INSTANCES=0
+{
+    template_job \
+        -d "$ENCRYPTME_DATA_DIR/server.json" \
+        -s /etc/iptables.eme.rules.j2 \
+        -o "$ENCRYPTME_DIR/iptables.eme.rules" \
+        -v ipaddress=$DNS
+
+    conf="$(get_openvpn_conf $OPENVPN_INSTANCES)"
+    while [ ! -z "$conf" ]; do
+        n=$OPENVPN_INSTANCES
+        echo "$conf" > "$ENCRYPTME_DATA_DIR/openvpn.$n.json"
+        template_job \
+            -d "$ENCRYPTME_DATA_DIR/openvpn.$n.json" \
+            -x "$ENCRYPTME_DATA_DIR/server.json" \
+            -s /etc/openvpn/openvpn.conf.j2 \
+            -o /etc/openvpn/server-$n.conf \
+            -v logging=$ENCRYPTME_LOGGING
+        OPENVPN_INSTANCES=$[ $n + 1 ]
+        conf="$(get_openvpn_conf $OPENVPN_INSTANCES)"
+    done
+
+    template_job \
+        -d "$ENCRYPTME_DATA_DIR/server.json" \
+        -s /etc/strongswan/ipsec.conf.j2 \
+        -o /etc/strongswan/ipsec.conf \
+        -v letsencrypt=$LETSENCRYPT
+
+    template_job \
+        -d "$ENCRYPTME_DATA_DIR/server.json" \
+        -s /etc/strongswan/ipsec.secrets.j2 \
+        -o /etc/strongswan/ipsec.secrets \
+        -v letsencrypt=$LETSENCRYPT
+
+    template_job \
+        -d "$ENCRYPTME_DATA_DIR/server.json" \
+        -s /etc/strongswan/strongswan.conf.j2 \
+        -o /etc/strongswan/strongswan.conf \
+        -v loglevel=$STRONGSWAN_LOGLEVEL
+} > "$TEMPLATE_MANIFEST"
+/bin/template.py --manifest "$TEMPLATE_MANIFEST"
+
 # generate IP tables rules
 rem "Configuring IPTables, as needed"
-/bin/template.py \
-    -d "$ENCRYPTME_DATA_DIR/server.json" \
-    -s /etc/iptables.eme.rules.j2 \
-    -o "$ENCRYPTME_DIR/iptables.eme.rules" \
-    -v ipaddress=$DNS
 
 # play nicely with existing rules: if our chain is already present do nothing
 /sbin/iptables -L ENCRYPTME &>/dev/null || {
@@ -478,30 +539,9 @@ rem "Configuring IPTables, as needed"
 }
 
 
-rem "Configuring and launching OpenVPN"
-OPENVPN_LOGLEVEL=0
-OPENVPN_LOG_OPT=""  # Disabled in template
-[ "${ENCRYPTME_LOGGING:-}" = 1 ] && OPENVPN_LOGLEVEL=2 &&
-                                    OPENVPN_LOG_OPT="--syslog"
-
-get_openvpn_conf() {
-    out=$(cat "$ENCRYPTME_DATA_DIR/server.json" | jq ".target.openvpn[$1]")
-    if [ "$out" = null ]; then
-        echo ""
-    else
-        echo "$out"
-    fi
-}
+rem "Launching OpenVPN"
 n=0
-conf="$(get_openvpn_conf $n)"
-while [ ! -z "$conf" ]; do
-    echo "$conf" > "$ENCRYPTME_DATA_DIR/openvpn.$n.json"
-    /bin/template.py \
-        -d "$ENCRYPTME_DATA_DIR/openvpn.$n.json" \
-        -x "$ENCRYPTME_DATA_DIR/server.json" \
-        -s /etc/openvpn/openvpn.conf.j2 \
-        -o /etc/openvpn/server-$n.conf \
-        -v logging=$ENCRYPTME_LOGGING
+while [ $n -lt $OPENVPN_INSTANCES ]; do
     rem "Started OpenVPN instance #$n"
     mkdir -p /var/run/openvpn
     test -e /var/run/openvpn/server-0.sock || \
@@ -518,32 +558,10 @@ while [ ! -z "$conf" ]; do
          --verb $OPENVPN_LOGLEVEL \
          &
     n=$[ $n + 1 ]
-    conf="$(get_openvpn_conf $n)"
 done
 
 
-STRONGSWAN_LOGLEVEL=-1
-[ "${ENCRYPTME_LOGGING:-}" = 1 ] && STRONGSWAN_LOGLEVEL=2
-
-rem "Configuring and starting strongSwan"
-
-/bin/template.py \
-    -d "$ENCRYPTME_DATA_DIR/server.json" \
-    -s /etc/strongswan/ipsec.conf.j2 \
-    -o /etc/strongswan/ipsec.conf \
-    -v letsencrypt=$LETSENCRYPT
-
-/bin/template.py \
-    -d "$ENCRYPTME_DATA_DIR/server.json" \
-    -s /etc/strongswan/ipsec.secrets.j2 \
-    -o /etc/strongswan/ipsec.secrets \
-    -v letsencrypt=$LETSENCRYPT
-
-/bin/template.py \
-    -d "$ENCRYPTME_DATA_DIR/server.json" \
-    -s /etc/strongswan/strongswan.conf.j2 \
-    -o /etc/strongswan/strongswan.conf \
-    -v loglevel=$STRONGSWAN_LOGLEVEL
+rem "Starting strongSwan"
 
 # Windows now requires some extra certs due to changes Let's Encrypt is making
 # or ipsec connections fail :(
@@ -641,6 +659,14 @@ fi
 }
 
 
+# keep WireGuard peers in sync; the hourly cron job is just a fallback now
+ip link show "$WG_IFACE" &>/dev/null && {
+    rem "Starting WireGuard peer sync every ${WG_SYNC_INTERVAL}s"
+    refresh-wireguard.py "wg_iface=$WG_IFACE" daemon=1 \
+        "interval=$WG_SYNC_INTERVAL" &
+}
+
+
 # the DNS filter must be running before unbound
 [ -f "$DNS_FILTER_PID_FILE" ] && rm "$DNS_FILTER_PID_FILE"
 rem "Restoring content-type filters and starting filter server"
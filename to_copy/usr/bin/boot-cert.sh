@@ -1,5 +1,8 @@
 #!/bin/bash -u
 
+# Boots the IPsec and OpenVPN sessions of the given subjects/common names,
+# looking up each service's sessions just once however many there are
+
 PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
 export PATH
 
@@ -9,21 +12,42 @@ fail() {
     exit ${2:-1}
 }
 
-               
-for socket in "/var/run/openvpn/*.sock"; do
-    OPENVPN_CONNECTION=$(echo status | socat - UNIX-CONNECT:/var/run/openvpn/server-0.sock | grep "$1")
-    [ -n "$OPENVPN_CONNECTION" ] && break
-done
 
-IPSEC_CONNECTION=$(ipsec status | grep "$1" | sed -r 's/.*cloak\[([[:digit:]]+)\].+/\1/g')
+[ $# -gt 0 ] || fail "usage: $0 NAME [NAME...]" 2
 
-if [ -n "$IPSEC_CONNECTION" ]; then
-        echo "killing ipsec connection $1"
-        ipsec down cloak[$IPSEC_CONNECTION] || fail "Could not kill ipsec connection" "1"
-fi
+failed=0
+
+IPSEC_STATUS=$(ipsec status) || {
+    echo "Could not get the ipsec connections" >&2
+    failed=1
+}
+for name in "$@"; do
+    for IPSEC_CONNECTION in $(echo "$IPSEC_STATUS" | grep -F -- "$name" \
+            | sed -rn 's/.*cloak\[([[:digit:]]+)\].+/\1/p' | sort -u); do
+        echo "killing ipsec connection $name"
+        ipsec down "cloak[$IPSEC_CONNECTION]" || {
+            echo "Could not kill ipsec connection $name" >&2
+            failed=1
+        }
+    done
+done
+
+for socket in /var/run/openvpn/*.sock; do
+    [ -e "$socket" ] || continue
+    OPENVPN_STATUS=$(echo status | socat - "UNIX-CONNECT:$socket") || {
+        echo "Could not get the openvpn connections of $socket" >&2
+        failed=1
+        continue
+    }
+    for name in "$@"; do
+        OPENVPN_CONNECTION=$(echo "$OPENVPN_STATUS" | grep -F -- "$name")
+        [ -n "$OPENVPN_CONNECTION" ] || continue
+        echo "Killing openvpn connection $name ($OPENVPN_CONNECTION)"
+        echo "kill '$name'" | socat - "UNIX-CONNECT:$socket" || {
+            echo "Could not kill openvpn connection $name" >&2
+            failed=1
+        }
+    done
+done
 
-if [ -n "$OPENVPN_CONNECTION" ]; then
-        echo "Killing openvpn connection $1 ($OPENVPN_CONNECTION)"
-        echo "kill '$1'" | socat - UNIX-CONNECT:/var/run/openvpn/server-0.sock \
-        	|| fail "Could not kill openvpn connection" "1"
-fi
\ No newline at end of file
+exit $failed
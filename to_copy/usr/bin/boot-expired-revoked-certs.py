@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Boots the IPsec and OpenVPN sessions of clients whose certificates have
+expired or been revoked.
+
+The serials revoked by the CRLs, as crl_cache.py last found them, are read
+into a set that every certificate in `ipsec listcerts` (read in one pass) is
+then checked against; OpenVPN sessions come from cert_sessions.py, and are
+still booted if `ipsec listcerts` fails. Every session found is booted by one
+run of boot-cert.sh.
+
+usage: boot-expired-revoked-certs.py [-n]   (-n: only print the sessions)
+"""
+
+from subprocess import PIPE, Popen
+import sqlite3
+import sys
+
+from cert_sessions import DB_PATH, SessionStore, normalize_serial
+from crl_cache import PKI_DIR, CRLCache
+
+
+BOOT_CERT = '/usr/bin/boot-cert.sh'
+CLIENT_FLAGS = ['clientAuth']  # as `ipsec listcerts` shows client certs
+EXPIRED = 'EXPIRED'
+REVOKED = 'REVOKED'
+
+
+class IPsecCert:
+    def __init__(self, subject):
+        self.subject = subject
+        self.expired = False
+        self.serial = ''
+        self.flags = []
+
+
+def run(cmd):
+    """
+    Runs a command, returning its output, or raising an OSError if it failed.
+    """
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise OSError("%s failed: %s" % (
+            cmd[0], err.decode('utf-8', 'replace').strip()))
+    return out.decode('utf-8', 'replace')
+
+
+def revoked_serials(pki_dir):
+    """
+    The serials revoked by the CRLs. Without any, expired certificates are
+    still booted.
+    """
+    try:
+        return CRLCache(pki_dir).serials()
+    except OSError as err:
+        sys.stderr.write("No revoked serials: %s\n" % err)
+        return set()
+
+
+def parse_listcerts(output):
+    """
+    The certificates in `ipsec listcerts` output.
+    """
+    certs = []
+    cert = None
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(':')
+        value = value.strip()
+        if key == 'subject':
+            cert = IPsecCert(value.strip('"'))
+            certs.append(cert)
+        elif cert is None:
+            continue
+        elif 'not after' in line:
+            cert.expired = 'expired' in line
+        elif key == 'serial':
+            cert.serial = normalize_serial(value)
+        elif key == 'flags':
+            cert.flags = value.split()
+    return certs
+
+
+def ipsec_sessions(certs, revoked):
+    """
+    Maps each subject to boot to why: those all of whose client certificates
+    have expired or been revoked, so a client that has been issued a new one
+    keeps its session.
+    """
+    reasons = {}
+    valid = set()
+    for cert in certs:
+        if cert.flags != CLIENT_FLAGS:
+            continue
+        if cert.expired:
+            reasons.setdefault(cert.subject, EXPIRED)
+        elif cert.serial in revoked:
+            reasons.setdefault(cert.subject, REVOKED)
+        else:
+            valid.add(cert.subject)
+    return {subject: reason for subject, reason in reasons.items()
+            if subject not in valid}
+
+
+def openvpn_sessions(store, revoked):
+    """
+    Maps the common name of each session to boot to why.
+    """
+    reasons = dict.fromkeys(store.with_serials(revoked), REVOKED)
+    reasons.update(dict.fromkeys(store.expired(), EXPIRED))
+    return reasons
+
+
+def main(args):
+    if args not in ([], ['-n']):
+        sys.stderr.write(__doc__[__doc__.index('usage:'):])
+        return 2
+    dryrun = args == ['-n']
+    status = 0
+    try:
+        revoked = revoked_serials(PKI_DIR)
+        try:
+            to_boot = ipsec_sessions(
+                parse_listcerts(run(['ipsec', 'listcerts'])), revoked)
+        except OSError as err:
+            # the OpenVPN sessions are still checked
+            sys.stderr.write("Skipping IPsec sessions: %s\n" % err)
+            to_boot = {}
+            status = 1
+        store = SessionStore(DB_PATH)
+        try:
+            openvpn = openvpn_sessions(store, revoked)
+            to_boot.update(openvpn)
+            for name in sorted(to_boot):
+                print("%s: %s" % (to_boot[name], name))
+            if dryrun or not to_boot:
+                return status
+            if Popen([BOOT_CERT] + sorted(to_boot)).wait() != 0:
+                # they stay on record, to be tried again next time
+                sys.stderr.write("Could not kill every session\n")
+                return 1
+            store.remove(openvpn)
+        finally:
+            store.close()
+    except (OSError, sqlite3.Error) as err:
+        sys.stderr.write("%s\n" % err)
+        return 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+The certificates of OpenVPN clients, for booting expired and revoked ones.
+
+OpenVPN's tls-verify hook (obtain-cert-end-date.sh) records each client
+certificate it sees as pending; when the client connects, its client-connect
+hook (openvpn-on-connect.sh) turns that into the client's session, keyed by
+common name. boot-expired-revoked-certs.py then asks which sessions have
+expired, or carry a revoked serial anywhere in their chain.
+
+They are kept in SQLite, in WAL mode, so that a hook only touches the rows it
+changes and readers never wait for writers; writers take turns on SQLite's
+own lock, waiting up to BUSY_TIMEOUT for it.
+
+usage: cert_sessions.py init
+       cert_sessions.py verify COMMON_NAME SERIAL EMAIL END_DATE
+       cert_sessions.py connect COMMON_NAME SERIAL_0 [SERIAL_1 [SERIAL_2]]
+       cert_sessions.py remove COMMON_NAME
+       cert_sessions.py expired          (prints common names)
+       cert_sessions.py revoked < SERIALS (prints common names)
+       cert_sessions.py list             (CSV, as cert_session_map was)
+"""
+
+from contextlib import contextmanager
+import calendar
+import sqlite3
+import sys
+import time
+
+
+DB_PATH = '/etc/encryptme/data/cert_sessions.db'
+BUSY_TIMEOUT = 30  # seconds; a whole connect storm's worth
+END_DATE_FORMAT = '%b %d %H:%M:%S %Y %Z'  # as `openssl x509 -enddate` has it
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    serial TEXT PRIMARY KEY,
+    common_name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    not_after INTEGER
+);
+CREATE INDEX IF NOT EXISTS pending_common_name ON pending (common_name);
+CREATE TABLE IF NOT EXISTS sessions (
+    common_name TEXT PRIMARY KEY,
+    serial_0 TEXT NOT NULL,
+    serial_1 TEXT NOT NULL,
+    serial_2 TEXT NOT NULL,
+    email TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    not_after INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_serial_0 ON sessions (serial_0);
+CREATE INDEX IF NOT EXISTS sessions_serial_1 ON sessions (serial_1);
+CREATE INDEX IF NOT EXISTS sessions_serial_2 ON sessions (serial_2);
+CREATE INDEX IF NOT EXISTS sessions_not_after ON sessions (not_after);
+"""
+
+
+def normalize_serial(serial):
+    """
+    Serials as `openssl` prints them: upper case hex, no colons.
+    """
+    return serial.replace(':', '').strip().upper()
+
+
+def parse_end_date(end_date):
+    """
+    The end date as a UNIX time, or None if we can't make it out.
+    """
+    try:
+        return calendar.timegm(
+            time.strptime(end_date.strip(), END_DATE_FORMAT))
+    except ValueError:
+        return None
+
+
+class SessionStore:
+    def __init__(self, path=DB_PATH):
+        # transactions are begun explicitly, see _transaction()
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # a lost session is just one fewer to boot; no need to fsync each
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A write transaction, taking the write lock up front so it can't fail
+        half way for want of it.
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def verify(self, common_name, serial, email, end_date):
+        """
+        Records a certificate presented by a client that is connecting.
+        """
+        with self._transaction() as db:
+            db.execute('DELETE FROM pending WHERE common_name = ?',
+                       (common_name,))
+            db.execute(
+                'INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?, ?)', (
+                    normalize_serial(serial), common_name, email, end_date,
+                    parse_end_date(end_date)))
+
+    def connect(self, common_name, serials):
+        """
+        Records the session of a client, replacing any it had before, with
+        the email and end date of its certificate (serials[0]) if verify()
+        saw it.
+        """
+        serials = [normalize_serial(serial) for serial in serials]
+        serials = (serials + ['', '', ''])[:3]
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT email, end_date, not_after FROM pending'
+                ' WHERE serial = ?', (serials[0],)).fetchone()
+            email, end_date, not_after = row or ('', '', None)
+            db.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [common_name] + serials + [email, end_date, not_after])
+            db.execute('DELETE FROM pending WHERE serial = ?', (serials[0],))
+
+    def remove(self, common_names):
+        with self._transaction() as db:
+            db.executemany('DELETE FROM sessions WHERE common_name = ?',
+                           ((common_name,) for common_name in common_names))
+
+    def expired(self, now=None):
+        """
+        The common names of sessions whose certificates have expired.
+        """
+        if now is None:
+            now = time.time()
+        return [row[0] for row in self.db.execute(
+            'SELECT common_name FROM sessions WHERE not_after < ?'
+            ' ORDER BY common_name', (int(now),))]
+
+    def with_serials(self, serials):
+        """
+        The common names of sessions with any of the serials in their
+        certificate chains.
+        """
+        serials = set(normalize_serial(serial) for serial in serials)
+        serials.discard('')
+        if not serials:
+            return []
+        self.db.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS wanted (serial TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM wanted')
+        self.db.executemany('INSERT INTO wanted VALUES (?)',
+                            ((serial,) for serial in serials))
+        # one indexed lookup per serial and column
+        return [row[0] for row in self.db.execute(
+            'SELECT common_name FROM sessions WHERE serial_0 IN wanted'
+            ' UNION SELECT common_name FROM sessions WHERE serial_1 IN wanted'
+            ' UNION SELECT common_name FROM sessions WHERE serial_2 IN wanted'
+            ' ORDER BY common_name')]
+
+    def sessions(self):
+        return self.db.execute(
+            'SELECT common_name, serial_0, serial_1, serial_2, email, end_date'
+            ' FROM sessions ORDER BY common_name').fetchall()
+
+
+USAGE = __doc__[__doc__.index('usage:'):]
+
+COMMANDS = {
+    # name: (min args, max args)
+    'init': (0, 0),
+    'verify': (4, 4),
+    'connect': (2, 4),
+    'remove': (1, 1),
+    'expired': (0, 0),
+    'revoked': (0, 0),
+    'list': (0, 0),
+}
+
+
+def main(args):
+    command = args[0] if args else None
+    if command not in COMMANDS or \
+            not COMMANDS[command][0] <= len(args) - 1 <= COMMANDS[command][1]:
+        sys.stderr.write(USAGE)
+        return 2
+    args = args[1:]
+    try:
+        store = SessionStore(DB_PATH)
+        try:
+            if command == 'verify':
+                store.verify(*args)
+            elif command == 'connect':
+                store.connect(args[0], args[1:])
+            elif command == 'remove':
+                store.remove(args)
+            elif command in ('expired', 'revoked'):
+                if command == 'expired':
+                    common_names = store.expired()
+                else:
+                    common_names = store.with_serials(sys.stdin)
+                for common_name in common_names:
+                    print(common_name)
+            elif command == 'list':
+                for session in store.sessions():
+                    print(','.join(session))
+        finally:
+            store.close()
+    except sqlite3.Error as err:
+        sys.stderr.write("%s: %s\n" % (DB_PATH, err))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
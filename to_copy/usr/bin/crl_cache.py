@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Keeps the CRLs listed in crl_urls.txt, for strongSwan and OpenVPN (crls.pem)
+and for boot-expired-revoked-certs.py (revoked-serials, one per line).
+
+The CRLs are fetched concurrently. One whose nextUpdate is still to come is
+not fetched again for up to MAX_AGE seconds; after that it is asked for with
+If-None-Match/If-Modified-Since, so an unchanged one isn't sent again. Each
+is kept in the cache dir as its PEM and a JSON record of its validators,
+nextUpdate and revoked serials, and one that can't be fetched is kept as it
+was. crls.pem and revoked-serials are only rewritten, and strongSwan only
+told to reread its CRLs, when what they hold has changed, and only once there
+is a CRL for every URL: until then those already there (e.g. from
+`cloak-server crls`) stay.
+
+usage: crl_cache.py refresh [-v] [--no-reload] [--pki-dir DIR]
+       crl_cache.py serials [--pki-dir DIR]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, Popen
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from cert_sessions import normalize_serial, parse_end_date
+
+
+PKI_DIR = '/etc/encryptme/pki'
+URL_FILE = 'crl_urls.txt'
+CACHE_DIR = 'crl-cache'
+CRLS_PEM = 'crls.pem'
+SERIALS_FILE = 'revoked-serials'
+FETCH_TIMEOUT = 30  # seconds, per CRL
+MAX_WORKERS = 8
+# a CA may well publish a CRL before the last one's nextUpdate; this bounds
+# how long a revocation can go unseen
+MAX_AGE = int(os.environ.get('CRL_MAX_AGE', 900))
+PEM_BEGIN = '-----BEGIN X509 CRL-----'
+RELOAD_COMMANDS = [['ipsec', 'rereadcrls'], ['ipsec', 'purgecrls']]
+
+# what became of a CRL in a refresh
+FRESH = 'fresh'
+NOT_MODIFIED = 'not modified'
+FETCHED = 'fetched'
+UNCHANGED = 'unchanged'
+CHANGED = 'changed'
+FAILED = 'failed'
+
+
+class CRL:
+    """
+    A cached CRL: where it came from, the validators it was served with,
+    its nextUpdate (a UNIX time, or None), when it was last checked and the
+    serials it revokes. The PEM itself is kept beside it.
+    """
+    FIELDS = ('url', 'etag', 'last_modified', 'next_update', 'checked',
+              'digest', 'serials')
+
+    def __init__(self, url, etag=None, last_modified=None, next_update=None,
+                 checked=0, digest=None, serials=()):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.next_update = next_update
+        self.checked = checked
+        self.digest = digest
+        self.serials = list(serials)
+        self.pem = None
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def is_fresh(self, now):
+        return self.next_update is not None and \
+            now < min(self.next_update, self.checked + MAX_AGE)
+
+
+def parse_crl(data):
+    """
+    The PEM, nextUpdate and revoked serials of a CRL, PEM or DER, with one
+    run of `openssl`; raises an OSError if it can't be read.
+    """
+    inform = 'PEM' if data.lstrip().startswith(b'-----BEGIN') else 'DER'
+    proc = Popen(['openssl', 'crl', '-inform', inform, '-text',
+                  '-outform', 'PEM'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate(data)
+    out = out.decode('ascii', 'replace')
+    if proc.returncode != 0 or PEM_BEGIN not in out:
+        raise OSError("Invalid CRL: %s" % err.decode('utf-8', 'replace')
+                      .strip().split('\n')[0])
+    text, pem = out.split(PEM_BEGIN, 1)
+    next_update = None
+    serials = []
+    for line in text.splitlines():
+        key, _, value = line.strip().partition(':')
+        if key == 'Serial Number':
+            serials.append(normalize_serial(value))
+        elif key == 'Next Update':
+            next_update = parse_end_date(value)
+    return PEM_BEGIN + pem, next_update, serials
+
+
+class CRLCache:
+    def __init__(self, pki_dir=PKI_DIR):
+        self.pki_dir = pki_dir
+        self.cache_dir = os.path.join(pki_dir, CACHE_DIR)
+
+    def _path(self, url, ext):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key + ext)
+
+    def read_urls(self):
+        with open(os.path.join(self.pki_dir, URL_FILE)) as url_file:
+            return [line.strip() for line in url_file if line.strip()]
+
+    def load(self, url):
+        """
+        The cached CRL from `url`, or None.
+        """
+        try:
+            with open(self._path(url, '.json')) as json_file:
+                crl = CRL(**json.load(json_file))
+            with open(self._path(url, '.pem')) as pem_file:
+                crl.pem = pem_file.read()
+        except (OSError, ValueError, TypeError):
+            return None
+        return crl if crl.url == url else None
+
+    def save(self, crl):
+        _write(self._path(crl.url, '.pem'), crl.pem)
+        _write(self._path(crl.url, '.json'), json.dumps(crl.to_json()))
+
+    def prune(self, urls):
+        """
+        Drops the CRLs of URLs no longer listed.
+        """
+        keep = set()
+        for url in urls:
+            keep.add(os.path.basename(self._path(url, '.json')))
+            keep.add(os.path.basename(self._path(url, '.pem')))
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(('.json', '.pem')) and name not in keep:
+                os.unlink(os.path.join(self.cache_dir, name))
+
+    def serials(self):
+        """
+        The serials revoked by all the CRLs, as of the last refresh.
+        """
+        with open(os.path.join(self.pki_dir, SERIALS_FILE)) as serials_file:
+            return set(line.strip() for line in serials_file if line.strip())
+
+    def refresh(self, now=None):
+        """
+        Brings the cache up to date; returns whether crls.pem changed and
+        what became of each URL's CRL, as (url, FRESH|..., error) tuples.
+        crls.pem and revoked-serials are left alone if a URL has never had
+        its CRL fetched.
+        """
+        if now is None:
+            now = time.time()
+        urls = self.read_urls()
+        cached = [self.load(url) for url in urls]
+        # only the fetching is done in threads: parsing is quick, and
+        # strptime() isn't safe to first call from one
+        with ThreadPoolExecutor(max(1, min(MAX_WORKERS, len(urls)))) as pool:
+            fetched = list(pool.map(_fetch, urls, cached,
+                                    [now] * len(urls)))
+        outcomes = []
+        crls = []
+        for url, crl, (outcome, response, error) in zip(urls, cached, fetched):
+            if outcome == FETCHED:
+                try:
+                    outcome, crl = _update(url, crl, response, now)
+                except OSError as err:
+                    outcome, error = FAILED, err
+            if outcome in (NOT_MODIFIED, UNCHANGED, CHANGED):
+                self.save(crl)
+            outcomes.append((url, outcome, error))
+            if crl is not None:
+                crls.append(crl)
+        self.prune(urls)
+        if len(crls) < len(urls):
+            # leaving a CA's CRL out would unrevoke its certificates
+            return False, outcomes
+        serials = sorted(set().union(*(crl.serials for crl in crls)))
+        _write_if_changed(os.path.join(self.pki_dir, SERIALS_FILE),
+                          ''.join(serial + '\n' for serial in serials))
+        changed = _write_if_changed(os.path.join(self.pki_dir, CRLS_PEM),
+                                    ''.join(crl.pem for crl in crls))
+        return changed, outcomes
+
+
+def _fetch(url, crl, now):
+    """
+    Fetches a CRL unless the cached one, `crl`, is fresh. Returns the
+    outcome, the response (its body and headers) if FETCHED and the error if
+    it FAILED.
+    """
+    if crl is not None and crl.is_fresh(now):
+        return FRESH, None, None
+    request = urllib.request.Request(url)
+    if crl is not None:
+        if crl.etag:
+            request.add_header('If-None-Match', crl.etag)
+        if crl.last_modified:
+            request.add_header('If-Modified-Since', crl.last_modified)
+    try:
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as resp:
+            return FETCHED, (resp.read(), resp.headers), None
+    except urllib.error.HTTPError as err:
+        if err.code == 304 and crl is not None:
+            crl.checked = int(now)
+            return NOT_MODIFIED, None, None
+        return FAILED, None, err
+    except (OSError, ValueError) as err:
+        return FAILED, None, err
+
+
+def _update(url, crl, response, now):
+    """
+    The outcome and CRL for a fetched one, given the one cached.
+    """
+    data, headers = response
+    pem, next_update, serials = parse_crl(data)
+    digest = hashlib.sha1(pem.encode('ascii')).hexdigest()
+    new_crl = CRL(url, headers.get('ETag'), headers.get('Last-Modified'),
+                  next_update, int(now), digest, serials)
+    new_crl.pem = pem
+    if crl is not None and crl.digest == digest:
+        return UNCHANGED, new_crl
+    return CHANGED, new_crl
+
+
+def _write(path, content):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as out_file:
+            out_file.write(content)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _write_if_changed(path, content):
+    try:
+        with open(path) as in_file:
+            if in_file.read() == content:
+                return False
+    except OSError:
+        pass
+    _write(path, content)
+    return True
+
+
+def reload_crls():
+    for cmd in RELOAD_COMMANDS:
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            raise OSError("%s failed: %s" % (
+                ' '.join(cmd), err.decode('utf-8', 'replace').strip()))
+
+
+parser = argparse.ArgumentParser(
+    usage=__doc__[__doc__.index('usage:') + len('usage: '):])
+parser.add_argument('command', choices=['refresh', 'serials'])
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help="report on every CRL")
+parser.add_argument('--no-reload', action='store_true',
+                    help="don't have strongSwan reread the CRLs")
+parser.add_argument('--pki-dir', default=PKI_DIR)
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    cache = CRLCache(args.pki_dir)
+    try:
+        if args.command == 'serials':
+            for serial in sorted(cache.serials()):
+                print(serial)
+            return 0
+        if not os.path.isdir(cache.cache_dir):
+            os.makedirs(cache.cache_dir)
+        with open(os.path.join(cache.cache_dir, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                sys.stderr.write("%s: already refreshing\n" % parser.prog)
+                return 1
+            changed, outcomes = cache.refresh()
+            failed = 0
+            for url, outcome, error in outcomes:
+                if error is not None:
+                    failed += 1
+                    sys.stderr.write("%s: %s\n" % (url, error))
+                elif args.verbose:
+                    print("%s: %s" % (url, outcome))
+            if args.verbose:
+                print("%s %s" % (CRLS_PEM, 'changed' if changed else
+                                 'unchanged'))
+            if changed and not args.no_reload:
+                reload_crls()
+    except OSError as err:
+        sys.stderr.write("%s: %s\n" % (parser.prog, err))
+        return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,44 +5,18 @@
 # has been established, defined by "client-connect"
 
 
-LOCKFILE="/etc/encryptme/data/.cert_lock"
-SESSION_MAP="/etc/encryptme/data/cert_session_map"
-END_DATE_FILE="/etc/encryptme/data/cert_end_date"
+CERT_SESSIONS="/usr/bin/cert_sessions.py"
 
 
 fail() {
     echo "${1-command failed}" >&2
-    [ -f "$LOCKFILE" ] && rm $LOCKFILE 
     exit ${2:-1}
 }
 
 
-count=0
-while [ -f "$LOCKFILE" ]; do
-    sleep 1
-    ((count++))
-    ## If this took five seconds.. things are wrong
-    ##      start over.. maybe we lost something
-    [ $count -gt 5 ] && fail "Could not get a lock"
-done
-echo "$$" > $LOCKFILE
-
-# Prune old records with the same common name
-grep -v "$common_name" $SESSION_MAP > tmp
-mv -f tmp $SESSION_MAP
-
-serial_0=$(echo "$tls_serial_hex_0" |tr -d : | tr '[:lower:]' '[:upper:]')
-serial_1=$(echo "$tls_serial_hex_1" |tr -d : | tr '[:lower:]' '[:upper:]')
-serial_2=$(echo "$tls_serial_hex_2" |tr -d : | tr '[:lower:]' '[:upper:]')
-
-email=$(grep "$serial_0" $END_DATE_FILE | tail -1 | cut -d "," -f 3)
-end_date=$(grep "$serial_0" $END_DATE_FILE | tail -1 | cut -d "," -f 4)
-
-# Stores client certificate info 
-echo "$common_name,$serial_0,$serial_1,$serial_2,$email,$end_date" >> $SESSION_MAP
-
-grep -v "$serial_0" $END_DATE_FILE > tmp
-mv -f tmp $END_DATE_FILE
-
-
-rm $LOCKFILE
+# Stores client certificate info, replacing any older session with the same
+# common name, along with the email and end date obtain-cert-end-date.sh
+# found in its certificate
+"$CERT_SESSIONS" connect "$common_name" \
+    "$tls_serial_hex_0" "${tls_serial_hex_1:-}" "${tls_serial_hex_2:-}" \
+    || fail "Failed to record the session of '$common_name'"
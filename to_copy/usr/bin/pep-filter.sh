@@ -4,8 +4,14 @@ BASE_DIR=$(cd $(dirname "$0") && pwd -P)
 SCRIPT_NAME=$(basename "$0")
 
 FILTERS_DIR="/etc/encryptme/filters"
-DOMAIN_RE="^([A-Za-z0-9-]+\.)+[A-Za-z]{2,}$"
 CIDR_RE="^([0-9]{1,3}\.){3}[0-9]{1,3}(\/[0-9]{1,3})?$"
+# appends up to this size are sent to the running dns-filter as a delta
+DELTA_MAX_DOMAINS=10000
+# loads the IP lists into ipsets (or, with IP_FILTER_BACKEND=nftables, into
+# nftables interval sets)
+IP_FILTER="/opt/dns-filter/ip_filter.py"
+# normalizes domain names and merges them into the lists
+DOMAIN_LIST="/opt/dns-filter/domain_list.py"
 TMP_DIR="/tmp/$SCRIPT_NAME.$$" && mkdir -p "$TMP_DIR" \
     || fail "Failed to create temporary directory '$TMP_DIR'"
 
@@ -58,117 +64,48 @@ fail() {
 
 reload_domains() {
     local cmd="/opt/dns-filter/server.py"
-    "$cmd" stop
-    "$cmd" start
+    # compile first so the daemon maps a snapshot rather than parsing the
+    # raw lists; a running daemon keeps answering until it has swapped it in
+    "$cmd" compile || fail "Failed to compile domain lists"
+    "$cmd" reload
 }
 
 
 reload_ips() {
-    local split_dir="$TMP_DIR/split"
-    local cmds list_name OLDIFS
-
-    mkdir -p "$split_dir" \
-        || fail "Failed to create temporary directory '$split_dir'"
-
-    reset_ips
-
-    ls "$FILTERS_DIR" | grep "\.ips\.blacklist$" | while read list; do
-        list_name="$(echo $list | cut -d'.' -f1)" 
-
-        cat "$FILTERS_DIR/$list" \
-            | split -d -l 65000 - "$split_dir/$list_name."
-
-        ls "$split_dir" | grep -E "$list_name\.[0-9]{2}" | while read sublist; do
-            cmds=()
-            cmds+=("create $sublist hash:net family inet hashsize 1024 maxelem 65536")
-
-            while read cidr; do
-                cmds+=("add $sublist $cidr")
-            done < "$split_dir/$sublist"
-
-            OLDIFS="$IFS"; IFS=$'\n'
-                echo "${cmds[*]}" | ipset restore
-            IFS="$OLDIFS"
-
-            /sbin/iptables-save | grep -Eq -- "--match-set \<$sublist\>" || {     
-                /usr/sbin/iptables -I ENCRYPTME 2 -m set --match-set "$sublist" dst -j DROP \
-                || fail "Failed to insert iptables rule $sublist"
-            }
-        done
-
-    done
+    # each list is loaded beside the one in use and swapped in, so
+    # filtering carries on throughout
+    "$IP_FILTER" reload || fail "Failed to reload IP lists"
 }
 
 
 add_ips() {
     local list_name="$1"
     local new_ip_file="$2"
-    local tmp_old_ip_file="$TMP_DIR/$list_name.cidr.old"
-    local split_dir="$TMP_DIR/split"
-    local ip_file="$FILTERS_DIR/$list_name.ips.blacklist"
-    local cmds OLDIFS
-
-    touch "$tmp_old_ip_file" || fail "Failed to create temp old ip file"
-
-    mkdir -p "$split_dir" \
-        || fail "Failed to create temporary directory '$split_dir'"
 
     mkdir -p "$FILTERS_DIR" || fail "Failed to create blacklists directory"
 
-    /sbin/ipset -n list | grep -E "$list_name\.[0-9]{2}" | while read sublist; do
-        ipset list "$sublist" \
-            | grep -Eo "$CIDR_RE" >> "$tmp_old_ip_file" \
-            || fail "Failed to get IP list for '$sublist'"
-        /sbin/iptables-save | grep -Eq -- "--match-set \<$sublist\>" && {            
-            /sbin/iptables -D ENCRYPTME -m set --match-set "$sublist" dst -j DROP \
-               || fail "Failed to delete iptables rule for the list $sublist"
-        }
-        /sbin/ipset destroy "$sublist" \
-           || fail "Failed to delete ipset $sublist"
-    done
-
-    # Save IPs to file to be used when container restarts (e.g. reboot)
-    cat "$tmp_old_ip_file" "$new_ip_file" > "$ip_file"
-
-    cat "$ip_file" \
-        | sort -u \
-        | split -d -l 65000 - "$split_dir/$list_name."
-
-    ls "$split_dir" | grep -E "$list_name\.[0-9]{2}" | while read list; do
-        cmds=()
-        cmds+=("create $list hash:net family inet hashsize 1024 maxelem 65536")
-
-        while read cidr; do
-            cmds+=("add $list $cidr")
-        done < "$split_dir/$list"
-
-        OLDIFS="$IFS"; IFS=$'\n'
-            echo "${cmds[*]}" | ipset restore
-        IFS="$OLDIFS"
-
-        /sbin/iptables-save | grep -Eq -- "--match-set \<$list\>" || {     
-            /usr/sbin/iptables -I ENCRYPTME 2 -m set --match-set "$list" dst -j DROP \
-            || fail "Failed to insert iptables rule $list"
-        }
-    done
+    # merges them into the saved list (used when the container restarts,
+    # e.g. on reboot) and reloads it
+    "$IP_FILTER" add "$list_name" "$new_ip_file" \
+        || fail "Failed to add IPs to '$list_name'"
 }
 
 
 add_domains() {
     local list_name="$1"
     local new_domain_file="$2"
-    local tmp_domain_file="$TMP_DIR/domains.old"
-    local domain_file="$FILTERS_DIR/$list_name.domains.blacklist"
 
-    touch "$tmp_domain_file" || fail "Failed to create temp domain file"
     mkdir -p "$FILTERS_DIR" || fail "Failed to create blacklists directory"
 
-    # keep things clean add keep dupes scrubbed out as we update the domain list
-    [ -s "$domain_file" ] && \
-        cat "$domain_file" | sort -u > "$tmp_domain_file"
+    # small updates are journaled by the running daemon and compacted into
+    # the list file later, so we needn't rewrite and reload the whole list
+    [ $(wc -l < "$new_domain_file") -le $DELTA_MAX_DOMAINS ] \
+        && /opt/dns-filter/server.py add "$list_name" < "$new_domain_file" \
+        && return 0
 
-    cat "$tmp_domain_file" "$new_domain_file" | sort -u > "$domain_file" \
-        || fail "Failed to write $domain_file"
+    # merged into the list, leaving out names it (or a parent domain) has
+    "$DOMAIN_LIST" add "$list_name" "$new_domain_file" \
+        || fail "Failed to add domains to '$list_name'"
 
     reload_domains \
        || fail "Failed to reload dns-filter"
@@ -180,15 +117,13 @@ prune_list() {
     local domain_file="$FILTERS_DIR/$list_name.domains.blacklist"
     local ip_file="$FILTERS_DIR/$list_name.ips.blacklist"
 
-    # delete the IP table rule and ipset list
-    /sbin/ipset -n list | grep -E "$list_name\.[0-9]{2}" | while read sublist; do
-        /sbin/iptables-save | grep -Eq -- "--match-set \<$sublist\>" && {     
-            /sbin/iptables -D ENCRYPTME -m set --match-set "$sublist" dst -j DROP \
-               || fail "Failed to delete iptables rule for the list $sublist"
-        }
-        /sbin/ipset destroy "$sublist" \
-           || fail "Failed to delete ipset $sublist"
-    done
+    # fold in any journaled changes first, so none of them outlive the list
+    /opt/dns-filter/server.py compact \
+        || fail "Failed to compact domain list changes"
+
+    # delete the list's IP set and its rule
+    "$IP_FILTER" remove "$list_name" \
+        || fail "Failed to delete the ipsets of '$list_name'"
 
     # Delete a Domain blacklist file
     [ -f "$domain_file" ] && {
@@ -205,15 +140,8 @@ prune_list() {
 
 
 reset_ips() {
-    # delete all ipset lists and iptables rules
-    /sbin/ipset -n list | while read list_name; do
-        /sbin/iptables-save | grep -Eq -- "--match-set \<$list_name\>" && {     
-            /sbin/iptables -D ENCRYPTME -m set --match-set "$list_name" dst -j DROP \
-               || fail "Failed to delete iptables rule for the list $list_name"
-        }
-        /sbin/ipset destroy "$list_name" \
-           || fail "Failed to delete ipset $list_name"
-    done
+    # delete all IP sets and their rules
+    "$IP_FILTER" reset || fail "Failed to delete ipsets"
 }
 
 
@@ -234,7 +162,9 @@ append_list() {
 
     cat > "$stdin"
     cat "$stdin" | grep -E "$CIDR_RE" > "$cidr_file"
-    cat "$stdin" | grep -E "$DOMAIN_RE" > "$domain_file"
+    # lowercased, IDNA encoded and deduplicated; the rest is skipped
+    "$DOMAIN_LIST" normalize < "$stdin" > "$domain_file" \
+        || fail "Failed to read domains"
 
     [ -s "$cidr_file" ] &&  add_ips "$list_name" "$cidr_file"
     [ -s "$domain_file" ] &&  add_domains "$list_name" "$domain_file"
@@ -3,10 +3,6 @@
 PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
 export PATH
 
-cd /etc/encryptme/pki
-
 sleep $(($RANDOM % 300))
-cloak-server --config /etc/encryptme/encryptme.conf --quiet crls \
-    --infile crl_urls.txt \
-    --out crls \
-    --post-hook "cat crls/*.pem > new-crls.pem; mv new-crls.pem crls.pem; /usr/sbin/ipsec rereadcrls; /usr/sbin/ipsec purgecrls"
+# rewrites crls.pem, and has strongSwan reread it, only if a CRL changed
+exec /usr/bin/crl_cache.py refresh
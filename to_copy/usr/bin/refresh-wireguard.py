@@ -1,53 +1,331 @@
 #!/usr/bin/env python3
 
-from collections import namedtuple
 from subprocess import Popen, PIPE
+import base64
+import hashlib
+import ipaddress
 import json
 import os
+import random
 import re
+import select
+import signal
+import socket
+import struct
 import sys
+import time
 
 import pidfile
 
 
-WGPeer = namedtuple('WGPeer', [
-    'public_key', 'preshared_key', 'endpoint', 'allowed_ips',
-    'lastest_handshake', 'bytes_up', 'bytes_down', 'keep_alives'
-])
-
 EME_DIR = os.environ.get('EME_DIR', '/etc/encryptme/wireguard')
 PEERS_FILE = EME_DIR + '/peers.json'
+# what the last successful run applied, so the next one can skip the work or
+# only diff against it; see sync() and save_state()
+STATE_FILE = EME_DIR + '/sync-state'
+# how often the live interface is still compared against (to catch any
+# manual `wg` changes), in seconds
+DRIFT_CHECK_INTERVAL = 24 * 3600
+PID_FILE = '/tmp/refresh-wireguard.pid'
+# daemon=1: seconds between syncs, how much to vary that by, and the longest
+# to wait between failing ones
+DAEMON_INTERVAL = 60
+DAEMON_JITTER = 0.2
+DAEMON_BACKOFF_MAX = 900
+
+WG_KEY_RE = re.compile(r'^[A-Za-z0-9+/]{42}[AEIMQUYcgkosw480]=$')
+IPV4_NET_RE = re.compile(r'^(\d+\.\d+\.\d+\.\d+)/(\d+)$')
+JSON_WS_RE = re.compile(r'[ \t\n\r]*')
+# a peer in a PeerTable: raw public key, IPv4 address, prefix length
+PEER_RECORD = struct.Struct('32s4sB')
+CHUNK_SIZE = 64 * 1024
+IP_BATCH_FAILED_RE = re.compile(r'^Command failed .*:(\d+)$')
+# peers per `wg set`; keeps its command line well below ARG_MAX
+WG_SET_BATCH = 1000
 
 
 def rem(msg, color='33'):
     sys.stdout.write(f'\033[1;{color}m#\033[0;{color}m {msg}\033[0m\n')
 
 
-def run(cmd, dryrun=False, verbose=False):
+class CommandError(RuntimeError):
+    def __init__(self, message, stderr=''):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+def run(cmd, dryrun=False, verbose=False, input=None, stdout=PIPE):
     """
-    Run a shell command, raising a RunTime exception if it failed. Returns
-    (stdout, stderr). If dryrun=True prints the command and returns (None,
-    None) instead. Always prints the command if verbose=True.
+    Run a shell command, raising a CommandError (a RuntimeError) if it
+    failed. Returns (stdout, stderr). If dryrun=True prints the command and
+    returns (None, None) instead. Always prints the command if verbose=True.
+    `input` (a str) is fed to the command's stdin, and printed along with it;
+    `stdout` may be a file to send the output to instead of returning it.
     """
     if dryrun or verbose:
         rem('%s' % (' '.join(cmd)), '32')
+        if input:
+            for line in input.splitlines():
+                rem('  %s' % line, '32')
     if dryrun:
         return None, None
-    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
+    proc = Popen(cmd, stdin=PIPE, stdout=stdout, stderr=PIPE)
+    out, stderr = proc.communicate(input.encode('utf-8') if input else None)
     if proc.returncode != 0:
-        raise RuntimeError("Failed to run %s: %s" % (
+        raise CommandError("Failed to run %s: %s" % (
             cmd[0],
             stderr
+        ), stderr.decode('utf-8', 'replace'))
+    return out.decode('utf-8') if out is not None else None, \
+        stderr.decode('utf-8')
+
+
+def _pack_peer(pubkey, allowed_ips):
+    """
+    A PEER_RECORD for the peer, or None if it doesn't come back out of one
+    exactly as it went in.
+    """
+    match = IPV4_NET_RE.match(allowed_ips)
+    if not match or not WG_KEY_RE.match(pubkey):
+        return None
+    try:
+        address = socket.inet_aton(match.group(1))
+    except OSError:
+        return None
+    prefix = int(match.group(2))
+    if prefix > 32:
+        return None
+    record = PEER_RECORD.pack(base64.b64decode(pubkey), address, prefix)
+    if _unpack_ips(record, 0) != allowed_ips:
+        return None
+    return record
+
+
+def _unpack_ips(records, offset):
+    return '%s/%d' % (socket.inet_ntoa(records[offset + 32:offset + 36]),
+                      records[offset + 36])
+
+
+def _pubkey(records, offset):
+    return base64.b64encode(records[offset:offset + 32]).decode('ascii')
+
+
+class PeerTable:
+    """
+    Maps public keys to allowed-ips, compactly enough for 100k+ peers: one
+    bytes string of PEER_RECORDs sorted by key rather than a dict of strings.
+    The odd peer that doesn't fit a record (no or several addresses, IPv6,
+    anything malformed) is kept as strings in `others`.
+    """
+    __slots__ = ('records', 'others')
+
+    def __init__(self, records=b'', others=None):
+        self.records = records
+        self.others = others if others is not None else {}
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Builds one from (public key, allowed-ips) pairs; the last pair for a
+        key wins.
+        """
+        size = PEER_RECORD.size
+        packed = []  # records with their position spliced in after the key
+        others = {}  # maps pubkey to (position, allowed-ips)
+        for position, (pubkey, allowed_ips) in enumerate(pairs):
+            record = _pack_peer(pubkey, allowed_ips)
+            if record is None:
+                others[pubkey] = (position, allowed_ips)
+            else:
+                packed.append(record[:32] + position.to_bytes(4, 'big')
+                              + record[32:])
+        packed.sort()
+        # keys of `others` that would otherwise be packed
+        packable = dict(
+            (base64.b64decode(pubkey), pubkey) for pubkey in others
+            if WG_KEY_RE.match(pubkey)
+        )
+        records = bytearray()
+        for index, record in enumerate(packed):
+            key = record[:32]
+            if index + 1 < len(packed) and packed[index + 1][:32] == key:
+                continue  # there's a later one
+            if key in packable:
+                position = int.from_bytes(record[32:36], 'big')
+                if others[packable[key]][0] > position:
+                    continue
+                del others[packable[key]]
+            records += key
+            records += record[36:]
+        return cls(bytes(records), dict(
+            (pubkey, allowed_ips) for pubkey, (_, allowed_ips) in others.items()
         ))
-    return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def __len__(self):
+        return len(self.records) // PEER_RECORD.size + len(self.others)
+
+    def get(self, pubkey):
+        """
+        The peer's allowed-ips; None if there is no such peer.
+        """
+        if pubkey in self.others:
+            return self.others[pubkey]
+        if not WG_KEY_RE.match(pubkey):
+            return None
+        key = base64.b64decode(pubkey)
+        records = self.records
+        size = PEER_RECORD.size
+        low, high = 0, len(records) // size
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * size
+            found = records[offset:offset + 32]
+            if found == key:
+                return _unpack_ips(records, offset)
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def diff(self, new):
+        """
+        Yields (public key, allowed-ips here, allowed-ips in `new`) for every
+        peer that differs, None standing for a missing peer. Both are walked
+        in step, so this needs no more memory than the differences do.
+        """
+        size = PEER_RECORD.size
+        old_records, new_records = self.records, new.records
+        old_end, new_end = len(old_records), len(new_records)
+        i = j = 0
+        while i < old_end or j < new_end:
+            old_key = old_records[i:i + 32] if i < old_end else None
+            new_key = new_records[j:j + 32] if j < new_end else None
+            if new_key is None or (old_key is not None and old_key < new_key):
+                pubkey = _pubkey(old_records, i)
+                if pubkey not in new.others:
+                    yield pubkey, _unpack_ips(old_records, i), None
+                i += size
+            elif old_key is None or new_key < old_key:
+                pubkey = _pubkey(new_records, j)
+                if pubkey not in self.others:
+                    yield pubkey, None, _unpack_ips(new_records, j)
+                j += size
+            else:
+                if old_records[i + 32:i + size] != new_records[j + 32:j + size]:
+                    yield (_pubkey(old_records, i), _unpack_ips(old_records, i),
+                           _unpack_ips(new_records, j))
+                i += size
+                j += size
+        for pubkey in sorted(set(self.others).union(new.others)):
+            old_ips, new_ips = self.get(pubkey), new.get(pubkey)
+            if old_ips != new_ips:
+                yield pubkey, old_ips, new_ips
+
+
+class _JSONStream:
+    """
+    Just enough of an incremental JSON reader to walk a large document
+    without holding all of it: objects are entered a key at a time, and only
+    the (small) values below them decoded whole.
+    """
+    __slots__ = ('stream', 'buffer', 'pos', 'eof', 'decoder')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.stream.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = JSON_WS_RE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def value(self):
+        """
+        Decodes the next value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # maybe just not all there yet
+                if not self._fill():
+                    raise
+                continue
+            # a number could go on in the next chunk
+            if end < len(self.buffer) or not self._fill():
+                self.pos = end
+                return value
+
+    def keys(self):
+        """
+        Enters an object, yielding each of its keys with the stream left at
+        its value, which has to be read (with value() or keys()) before the
+        next one.
+        """
+        if self._peek() != '{':
+            raise ValueError("Expected a JSON object")
+        self.pos += 1
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str) or self._peek() != ':':
+                raise ValueError("Expected a JSON object key")
+            self.pos += 1
+            yield key
+            separator = self._peek()
+            self.pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError("Expected ',' or '}' in JSON object")
 
 
-def fetch_eme_conf(base_url, config_file=None, verbose=False):
+def fetch_eme_data(path, base_url, config_file=None, verbose=False):
     """
-    Downloads Encrypt.me peer configuration information for valid users.
-    Returns a tuple of response data and a parse mapping of public key to
-    private IPv4 address.
+    Downloads Encrypt.me peer configuration information for valid users
+    into `path`, as returned. Returns its fingerprint.
+    """
+    cmd = [
+        'cloak-server',
+        '--base_url', base_url,
+    ]
+    if config_file:
+        cmd.append('--config')
+        cmd.append(config_file)
+    cmd.append('wireguard')
+    # a failure must not look like there being no peers (and remove them all)
+    with open(path, 'wb') as eme_file:
+        run(cmd, verbose=verbose, stdout=eme_file)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as eme_file:
+        for chunk in iter(lambda: eme_file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_eme_peers(eme_file):
+    """
+    Reads (public key, private IPv4 address) pairs from Encrypt.me peer
+    configuration information, a device at a time.
     """
     # e.g.:
     # {
@@ -61,117 +339,383 @@ def fetch_eme_conf(base_url, config_file=None, verbose=False):
     #     }
     #   }
     # }
-    cmd = [
-        'cloak-server',
-        '--base_url', base_url,
-    ]
-    if config_file:
-        cmd.append('--config')
-        cmd.append(config_file)
-    cmd.append('wireguard')
-    try:
-        stdout, stderr = run(cmd, verbose=verbose)
-    except RuntimeError:
-        stdout, eme_conf = '', {}
-    else:
-        eme_conf = {}  # maps pubkey to private IP
-        try:
-            eme_data = json.loads(stdout)
-        except (TypeError, ValueError):
-            eme_data = {}
-        for user in eme_data.get('wireguard_peers'):
-            user_data = eme_data['wireguard_peers'][user]
-            for device in user_data:
-                device_data = user_data[device]
-                eme_conf[device_data['public_key']] = device_data['private_ipv4_address']
-    return stdout, eme_conf
+    stream = _JSONStream(eme_file)
+    found = False
+    for key in stream.keys():
+        if key != 'wireguard_peers':
+            stream.value()
+            continue
+        found = True
+        for user in stream.keys():
+            for device in stream.keys():
+                device_data = stream.value()
+                yield device_data['public_key'], device_data['private_ipv4_address']
+    if not found:
+        raise ValueError("No wireguard_peers in Encrypt.me's response")
+
+
+def _iter_dump_peers(dump):
+    # first line is server interface info, so we skip it
+    dump.readline()
+    for line in dump:
+        fields = line.split(b'\t')
+        if len(fields) > 3:
+            yield fields[0].decode('ascii'), fields[3].decode('ascii')
 
 
 def fetch_wg_conf(wg_iface, verbose=False):
     """
-    Parses WireGuard dump info into named tuples.
+    Reads the interface's peers from its `wg show dump`, a line at a time,
+    into a PeerTable.
     """
-    stdout, stderr = run(['wg', 'show', wg_iface, 'dump'], verbose=verbose)
-    wg_conf = {}  # maps pubkey to WGPeer namedtuples
-    wg_re = re.compile('\s+')
-    # first line is server interface info, so we skip it
-    for line in stdout.strip().split('\n')[1:]:
-        clean_line = line.strip()
-        if not clean_line:
-            continue
-        wg_peer = WGPeer(*wg_re.split(line))
-        wg_conf[wg_peer.public_key] = wg_peer
+    cmd = ['wg', 'show', wg_iface, 'dump']
+    if verbose:
+        rem('%s' % (' '.join(cmd)), '32')
+    with Popen(cmd, stdout=PIPE, stderr=PIPE) as proc:
+        wg_conf = PeerTable.from_pairs(_iter_dump_peers(proc.stdout))
+        stderr = proc.stderr.read()
+    if proc.returncode != 0:
+        raise CommandError("Failed to run %s: %s" % (cmd[0], stderr),
+                           stderr.decode('utf-8', 'replace'))
     return wg_conf
 
 
-def wg_up(wg_iface, pubkey, allowed_ips, dryrun=False, verbose=False):
+def interface_index(wg_iface):
+    """
+    The interface's index, which changes whenever it is recreated (e.g. by
+    run.sh), dropping all of its peers; None if there is no such interface.
+    """
+    try:
+        with open('/sys/class/net/%s/ifindex' % wg_iface) as ifindex_file:
+            return int(ifindex_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def load_state(path=STATE_FILE):
+    """
+    Reads what the last successful run applied; None if there's nothing
+    (usable) to go by.
+    """
+    try:
+        with open(path, 'rb') as state_file:
+            state = json.loads(state_file.readline().decode('utf-8'))
+            records = state_file.read()
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get('others'), dict) \
+            or len(records) % PEER_RECORD.size:
+        return None
+    state['peers'] = PeerTable(records, state.pop('others'))
+    return state
+
+
+def save_state(state, path=STATE_FILE):
+    """
+    Writes the state as a line of JSON, followed by the peers' records.
+    """
+    header = dict(state)
+    peers = header.pop('peers')
+    header['others'] = peers.others
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as state_file:
+        state_file.write(json.dumps(header).encode('utf-8') + b'\n')
+        state_file.write(peers.records)
+    os.rename(tmp_path, path)
+
+
+def clear_state(path=STATE_FILE):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _route_ips(allowed_ips):
+    """
+    The addresses a peer's allowed-ips (as shown by `wg show dump`) route.
     """
-    Add a peer to WireGuard.
+    if allowed_ips in ('', '(none)'):
+        return []
+    return allowed_ips.split(',')
+
+
+def valid_peer(pubkey, allowed_ips):
     """
-    run(['ip', '-4', 'route', 'add', allowed_ips, 'dev', wg_iface], dryrun, verbose)
-    run(['wg', 'set', wg_iface, 'peer', pubkey, 'allowed-ips', allowed_ips], dryrun, verbose)
+    Returns why a peer from Encrypt.me can't be configured, or None if it
+    can. A bad one would fail the whole batch it is part of.
+    """
+    if not WG_KEY_RE.match(pubkey):
+        return "invalid public key"
+    try:
+        ipaddress.ip_network(allowed_ips)
+    except ValueError:
+        return "invalid address %r" % allowed_ips
+    return None
 
 
-def wg_down(wg_iface, wg_peer, dryrun=False, verbose=False):
+def apply_routes(route_cmds, dryrun=False, verbose=False):
     """
-    Remove a peer from a WireGuard interface.
+    Runs (pubkey, `ip route` command) pairs as a single `ip -batch` script,
+    carrying on past failures. Returns a mapping of the index of each failed
+    command to its error.
     """
-    run(['wg', 'set', wg_iface, 'peer', wg_peer.public_key, 'remove'], dryrun, verbose)
-    run(['ip', '-4', 'route', 'del', wg_peer.allowed_ips, 'dev', wg_iface], dryrun, verbose)
+    failures = {}
+    if not route_cmds:
+        return failures
+    script = ''.join('%s\n' % cmd for _, cmd in route_cmds)
+    try:
+        run(['ip', '-4', '-force', '-batch', '-'], dryrun, verbose,
+            input=script)
+    except CommandError as err:
+        # ip reports each failed line as its error message(s), then
+        # "Command failed -:<line number>"
+        messages = []
+        for line in err.stderr.splitlines():
+            match = IP_BATCH_FAILED_RE.match(line)
+            if not match:
+                messages.append(line.strip())
+                continue
+            number = int(match.group(1))
+            if 0 < number <= len(route_cmds):
+                failures[number - 1] = '; '.join(messages) or 'failed'
+            messages = []
+        if not failures:
+            # not something we can pin on any one peer
+            raise
+    return failures
+
+
+def apply_peers(wg_iface, peer_args, dryrun=False, verbose=False):
+    """
+    Applies (pubkey, `wg set` peer arguments) pairs with one `wg set` per
+    WG_SET_BATCH peers. Should a batch fail, its peers are retried one at a
+    time to find out which of them it was. Returns a mapping of public key to
+    the errors of its failed updates.
+    """
+    failures = {}
+    for start in range(0, len(peer_args), WG_SET_BATCH):
+        batch = peer_args[start:start + WG_SET_BATCH]
+        cmd = ['wg', 'set', wg_iface]
+        for _, args in batch:
+            cmd.extend(args)
+        try:
+            run(cmd, dryrun, verbose)
+            continue
+        except CommandError as err:
+            if len(batch) == 1:
+                pubkey, args = batch[0]
+                failures.setdefault(pubkey, []).append(
+                    'wg set %s: %s' % (' '.join(args), err.stderr.strip()))
+                continue
+        if verbose:
+            rem("Batch of %d peer updates failed; retrying them one by one"
+                % len(batch), '31')
+        for pubkey, args in batch:
+            try:
+                run(['wg', 'set', wg_iface] + args, dryrun, verbose)
+            except CommandError as err:
+                failures.setdefault(pubkey, []).append(
+                    'wg set %s: %s' % (' '.join(args), err.stderr.strip()))
+    return failures
 
 
-def main(wg_iface, base_url=None, config_file=None, verbose=False, dryrun=False):
+def sync(wg_iface, state, base_url=None, config_file=None, verbose=False,
+         dryrun=False, full=False):
     """
     Fetches data from Encrypt.me, parses local WireGuard interface
     configuration information and ensures all peers are configured correctly
-    based on any changes.
+    based on any changes. Returns the new state (see load_state()).
+
+    Given the `state` a successful run left, this only looks at the interface
+    (`wg show dump`) when `full` is set, it has been recreated since, or the
+    last look was DRIFT_CHECK_INTERVAL ago; otherwise it diffs against what
+    that run applied, or does nothing at all if the data from Encrypt.me is
+    the same.
     """
     # get the config data from Encrypt.me and from what is on the server now
     # then, using wg interface data we can decide:
-    with pidfile.PIDFile('/tmp/refresh-wireguard.pid'):
-        if dryrun:
-            rem("*** DRY RUN (no changes will be made) ***")
-        eme_resp_data, eme_conf = fetch_eme_conf(base_url, config_file, verbose=verbose)
+    eme_path = '%s.%d.tmp' % (PEERS_FILE, os.getpid())
+    try:
+        fingerprint = fetch_eme_data(eme_path, base_url, config_file,
+                                     verbose=verbose)
+        ifindex = interface_index(wg_iface)
+        now = time.time()
+        if (full or state is None or state.get('wg_iface') != wg_iface
+                or state.get('ifindex') != ifindex
+                or not 0 <= now - state.get('checked', 0) < DRIFT_CHECK_INTERVAL):
+            state = None
+        if state is not None and state.get('fingerprint') == fingerprint:
+            if verbose:
+                rem("No changes from Encrypt.me since the last run")
+            return state
+        with open(eme_path, encoding='utf-8') as eme_file:
+            eme_peers = PeerTable.from_pairs(iter_eme_peers(eme_file))
         if verbose:
             rem("Found %d peers from Encrypt.me; saving to %s" % (
-                len(eme_conf), PEERS_FILE
+                len(eme_peers), PEERS_FILE
             ))
         if not dryrun:
-            with open(PEERS_FILE, 'w') as peers_file:
-                peers_file.write(eme_resp_data)
-        wg_conf = fetch_wg_conf(wg_iface, verbose=verbose)
-        if verbose:
-            rem("Found %d local WireGuard peers" % (len(wg_conf)))
-        eme_pubkeys = frozenset(eme_conf.keys())
-        wg_pubkeys = frozenset(wg_conf.keys())
-
-        # --- we need to determine: ---
-        # * which peers to remove
-        pubkeys_old = wg_pubkeys - eme_pubkeys
+            os.rename(eme_path, PEERS_FILE)
+    finally:
+        if os.path.exists(eme_path):
+            os.unlink(eme_path)
+    if state is None:
+        current = fetch_wg_conf(wg_iface, verbose=verbose)
         if verbose:
-            rem("Removing %d old peers" % len(pubkeys_old))
-        for pubkey in pubkeys_old:
-            wg_down(wg_iface, wg_conf[pubkey], dryrun)
-
-        # * which peers to possibly change the IP address of
-        pubkeys_same = wg_pubkeys & eme_pubkeys
-        changed = 0
-        for pubkey in pubkeys_same:
-            eme_ipv4 = eme_conf[pubkey]
-            wg_ipv4 = wg_conf[pubkey].allowed_ips
-            if eme_ipv4 != wg_ipv4:
-                changed += 1
-                wg_down(wg_iface, wg_conf[pubkey], dryrun, verbose)
-                wg_up(wg_iface, pubkey, eme_conf[pubkey], dryrun, verbose)
+            rem("Found %d local WireGuard peers" % (len(current)))
+        checked = now
+    else:
+        current = state['peers']
+        checked = state['checked']
         if verbose:
-            rem("Changed %d peers to new IP addresses" % (changed))
+            rem("Comparing against the %d peers applied by the last run" % (
+                len(current)))
+    if not dryrun:
+        # until we're done, as whatever we don't get to would be missed
+        clear_state()
+    failures = {}  # maps pubkey to a list of errors
 
+    # work out the whole change first, so it can be applied with one
+    # `ip -batch` and as few `wg set`s as possible:
+    route_dels = []  # (pubkey, command) pairs
+    route_adds = []
+    peer_args = []  # (pubkey, `wg set` peer arguments) pairs
+    removed = changed = added = 0
+    for pubkey, wg_ipv4, eme_ipv4 in current.diff(eme_peers):
+        # * which peers to remove
+        if eme_ipv4 is None:
+            removed += 1
+            peer_args.append((pubkey, ['peer', pubkey, 'remove']))
+            for ip in _route_ips(wg_ipv4):
+                route_dels.append((pubkey, 'route del %s dev %s' % (ip, wg_iface)))
+            continue
+        problem = valid_peer(pubkey, eme_ipv4)
+        if problem:
+            failures[pubkey] = [problem]
+            continue
+        # * which peers to change the IP address of
+        if wg_ipv4 is not None:
+            changed += 1
+            for ip in _route_ips(wg_ipv4):
+                route_dels.append((pubkey, 'route del %s dev %s' % (ip, wg_iface)))
         # * which peers to add
-        pubkeys_new = eme_pubkeys - wg_pubkeys
-        if verbose:
-            rem("Adding %d new peers" % len(pubkeys_new))
-        for pubkey in pubkeys_new:
-            wg_up(wg_iface, pubkey, eme_conf[pubkey], dryrun, verbose)
+        else:
+            added += 1
+        route_adds.append((pubkey, 'route replace %s dev %s' % (eme_ipv4, wg_iface)))
+        peer_args.append((pubkey, ['peer', pubkey, 'allowed-ips', eme_ipv4]))
+    if verbose:
+        rem("Removing %d old peers" % removed)
+        rem("Changing %d peers to new IP addresses" % (changed))
+        rem("Adding %d new peers" % added)
+
+    # routes go first (old ones out before new ones in, should they
+    # overlap); a peer whose route couldn't be added is left alone so
+    # the next run tries it again
+    route_cmds = route_dels + route_adds
+    unrouted = set()
+    for number, message in apply_routes(route_cmds, dryrun, verbose).items():
+        pubkey, cmd = route_cmds[number]
+        failures.setdefault(pubkey, []).append('ip %s: %s' % (cmd, message))
+        if number >= len(route_dels):
+            unrouted.add(pubkey)
+    peer_args = [(pubkey, args) for pubkey, args in peer_args
+                 if pubkey not in unrouted]
+    for pubkey, errors in apply_peers(wg_iface, peer_args, dryrun, verbose).items():
+        failures.setdefault(pubkey, []).extend(errors)
+
+    if failures:
+        for pubkey in sorted(failures):
+            for error in failures[pubkey]:
+                rem("Peer %s: %s" % (pubkey, error), '31')
+        raise RuntimeError("Failed to update %d WireGuard peers" % (
+            len(failures)))
+    if dryrun:
+        return state
+    state = {
+        'wg_iface': wg_iface,
+        'ifindex': ifindex,
+        'fingerprint': fingerprint,
+        'checked': checked,
+        'peers': eme_peers,
+    }
+    save_state(state)
+    return state
+
+
+def run_daemon(wg_iface, base_url=None, config_file=None, verbose=False,
+               dryrun=False, interval=DAEMON_INTERVAL):
+    """
+    Syncs every `interval` seconds (give or take DAEMON_JITTER), keeping the
+    state in memory, and backing off up to DAEMON_BACKOFF_MAX while syncs
+    fail. SIGUSR1 asks for a sync right away, SIGHUP for one against the live
+    interface (like full=1); SIGTERM and SIGINT stop it.
+    """
+    wakeup_r, wakeup_w = socket.socketpair()
+    wakeup_r.setblocking(False)
+    wakeup_w.setblocking(False)
+    pending = set()
+
+    def on_signal(signum, frame):
+        pending.add(signum)
+
+    signal.set_wakeup_fd(wakeup_w.fileno())
+    for signum in (signal.SIGUSR1, signal.SIGHUP, signal.SIGTERM,
+                   signal.SIGINT):
+        signal.signal(signum, on_signal)
+    rem("Syncing WireGuard peers every %ds" % interval)
+    state = load_state()
+    full = False
+    failures = 0
+    while True:
+        try:
+            state = sync(wg_iface, state, base_url, config_file, verbose,
+                         dryrun, full)
+            failures = 0
+        except Exception as err:
+            # gone if it failed after starting to make changes, so the next
+            # sync looks at the interface
+            state = load_state()
+            failures += 1
+            rem("Sync failed (%d in a row): %s" % (failures, err), '31')
+        delay = interval
+        if failures:
+            delay = max(interval, min(interval << failures, DAEMON_BACKOFF_MAX))
+        delay *= random.uniform(1 - DAEMON_JITTER, 1 + DAEMON_JITTER)
+        deadline = time.monotonic() + delay
+        while not pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            select.select([wakeup_r], [], [], timeout)
+            try:
+                while wakeup_r.recv(4096):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+        signums, pending = set(pending), set()
+        if signums & {signal.SIGTERM, signal.SIGINT}:
+            return
+        full = signal.SIGHUP in signums
+        if signums and verbose:
+            rem("Sync requested")
+
+
+def main(wg_iface, base_url=None, config_file=None, verbose=False, dryrun=False,
+         full=False, daemon=False, interval=DAEMON_INTERVAL):
+    """
+    Syncs WireGuard peers with Encrypt.me once, or keeps doing so if
+    `daemon` is set; see sync() and run_daemon().
+    """
+    with pidfile.PIDFile(PID_FILE):
+        if dryrun:
+            rem("*** DRY RUN (no changes will be made) ***")
+        if daemon:
+            run_daemon(wg_iface, base_url, config_file, verbose, dryrun,
+                       interval)
+        else:
+            sync(wg_iface, load_state(), base_url, config_file, verbose,
+                 dryrun, full)
 
 
 #
@@ -189,6 +733,9 @@ if __name__ == '__main__':
         'base_url': os.environ['ENCRYPTME_API_URL'],
         'dryrun': False,
         'verbose': False,
+        'full': False,
+        'daemon': False,
+        'interval': DAEMON_INTERVAL,
     }
     for arg in sys.argv[1:]:
         if '=' not in arg:
@@ -1,64 +1,153 @@
 #!/usr/bin/env python3
 
-"""Substitute variables using jinja2."""
+"""Substitute variables using jinja2.
+
+Renders one template, or with --manifest every template listed in a file
+(or stdin, '-'), one per line with the same options a single run takes:
+
+    -s /etc/strongswan/ipsec.conf.j2 -o /etc/strongswan/ipsec.conf -d ...
+
+A batch shares one process, jinja2 environment and IP lookup, and parses
+every data file once. Outputs that would come out the same are left alone.
+"""
 
 import json
 import jinja2
 import argparse
+import os
+import shlex
 import socket
+import sys
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-s', '--source', help='source template file',
-                    required=True, type=str)
+parser.add_argument('-s', '--source', help='source template file', type=str)
 parser.add_argument('-x', '--extra', help='extra source template files; added to doc based on filename',
                     type=str, action='append', default=[])
-parser.add_argument('-o', '--out', help='output file',
-                    required=True, type=str)
-parser.add_argument('-d', '--data', help='json data file',
-                    required=True, type=str)
+parser.add_argument('-o', '--out', help='output file', type=str)
+parser.add_argument('-d', '--data', help='json data file', type=str)
 parser.add_argument('-v', '--var', type=str, action='append',
                     default=[], help="set variable to value (--var foo=baz)")
-args = parser.parse_args()
-
-# https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
-ip = [l for l in ([ip for ip in
-      socket.gethostbyname_ex(socket.gethostname())[2]
-      if not ip.startswith("127.")][:1],
-      [[(s.connect(('8.8.8.8', 53)), s.getsockname()[0], s.close())
-          for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]])
-      if l][0][0]
-
-
-def apply_template(data, source_file):
-    """Run file through Jinja2 Template system."""
-    template = jinja2.Template(source_file.read())
-    return template.render(**data)
-
-
-# get our source data to start
-data = None
-with open(args.data) as data_file:
-    data = json.load(data_file)
-    data = dict(data=data, ip=ip)
-
-# extend with any extra data
-for extra in args.extra:
-    with open(extra) as data_file:
-        extra_name = extra.split('.')[0].split('/')[-1]
-        data[extra_name] = json.load(data_file)
-
-# plus any one-off vars from the command line
-if args.var:
-    for var in args.var:
-        splitted = var.split("=", 1)
-        if len(splitted) == 1:
-            data[splitted[0]] = ''
-        else:
-            data[splitted[0]] = splitted[1]
-
-# finally, apply this all to the source template
-with open(args.source) as source_file:
-    content = apply_template(data, source_file)
-    with open(args.out, "w") as dest_file:
+parser.add_argument('-m', '--manifest', type=str,
+                    help="render the templates listed in this file instead, "
+                         "one set of the options above per line")
+
+
+def detect_ip():
+    # https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
+    return [l for l in ([ip for ip in
+            socket.gethostbyname_ex(socket.gethostname())[2]
+            if not ip.startswith("127.")][:1],
+            [[(s.connect(('8.8.8.8', 53)), s.getsockname()[0], s.close())
+                for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]])
+            if l][0][0]
+
+
+class Renderer(object):
+    """Renders templates, sharing what they have in common."""
+
+    def __init__(self):
+        # templates are looked up by absolute path; the environment keeps
+        # them compiled, and the bytecode cache across runs
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader('/'),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+        )
+        self.json_cache = {}
+        self._ip = None
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip = detect_ip()
+        return self._ip
+
+    def load_json(self, path):
+        if path not in self.json_cache:
+            with open(path) as data_file:
+                self.json_cache[path] = json.load(data_file)
+        return self.json_cache[path]
+
+    def render(self, job):
+        """Renders the template of a set of parsed options."""
+        # get our source data to start
+        data = dict(data=self.load_json(job.data), ip=self.ip)
+
+        # extend with any extra data
+        for extra in job.extra:
+            extra_name = extra.split('.')[0].split('/')[-1]
+            data[extra_name] = self.load_json(extra)
+
+        # plus any one-off vars from the command line
+        for var in job.var:
+            splitted = var.split("=", 1)
+            if len(splitted) == 1:
+                data[splitted[0]] = ''
+            else:
+                data[splitted[0]] = splitted[1]
+
+        # finally, apply this all to the source template
+        template = self.env.get_template(
+            os.path.abspath(job.source).lstrip('/'))
+        return template.render(**data)
+
+
+def write_if_changed(path, content):
+    """Writes the file unless it already holds `content`; True if written."""
+    try:
+        with open(path) as dest_file:
+            if dest_file.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    # in place, so the file keeps its permissions
+    with open(path, "w") as dest_file:
         dest_file.write(content)
+    return True
+
+
+def parse_job(argv):
+    job = parser.parse_args(argv)
+    if job.manifest or not (job.source and job.out and job.data):
+        parser.error('-s/--source, -o/--out and -d/--data are required')
+    return job
+
+
+def read_manifest(path):
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as manifest_file:
+            lines = manifest_file.readlines()
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            jobs.append(parse_job(shlex.split(line)))
+    return jobs
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    if args.manifest:
+        jobs = read_manifest(args.manifest)
+    else:
+        jobs = [parse_job(argv)]
+    renderer = Renderer()
+    failed = 0
+    for job in jobs:
+        try:
+            write_if_changed(job.out, renderer.render(job))
+        except jinja2.TemplateNotFound:
+            sys.stderr.write("%s: %s: No such template\n" % (
+                parser.prog, job.source))
+            failed += 1
+        except (IOError, OSError, ValueError, jinja2.TemplateError) as err:
+            # the rest of a batch may still be fine
+            sys.stderr.write("%s: %s: %s\n" % (parser.prog, job.source, err))
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
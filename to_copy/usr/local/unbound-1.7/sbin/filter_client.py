@@ -8,13 +8,44 @@ Requires Python 2.7 and uses a version of python included in Unbound:
 """
 
 import socket
+import struct
 import json
+import mmap
 import os
-from time import sleep
+import threading
+from collections import OrderedDict, deque
+from hashlib import md5
+from time import sleep, time
 
 intercept_address = "0.0.0.0"
 sock_file = "/usr/local/unbound-1.7/etc/unbound/dns_filter.sock"
+# Bloom filter of blocked domains published by the daemon; names it rules
+# out are answered without asking the daemon
+prefilter_file = "/usr/local/unbound-1.7/etc/unbound/dns_filter.bloom"
+use_prefilter = True
+# how often to look for a newly published filter
+prefilter_recheck_interval = 1.0
+# the filter is only trusted while its generation matches one the daemon
+# reported this recently
+prefilter_trust_interval = 5.0
 sock_exist = False
+sock_timeout = 2.0
+# how often to look for the socket again if the daemon wasn't running
+sock_recheck_interval = 5.0
+# talk to the daemon over a persistent binary connection; set to False to
+# fall back to one JSON request per connection
+use_binary_protocol = True
+# check the A records of resolved answers against the daemon's IP lists too
+# (binary protocol only), and answer with the intercept address if any is on
+# one, rather than leaving clients to time out on dropped traffic
+check_answers = True
+# verdicts for recently seen names are cached in-process; a size of 0
+# disables the cache
+cache_size = int(os.environ.get('DNS_FILTER_CACHE_SIZE', 50000))
+cache_ttl = float(os.environ.get('DNS_FILTER_CACHE_TTL', 60))
+# only block names on these lists (comma separated list names, e.g.
+# "security,malware"); empty blocks names on any list
+block_lists = os.environ.get('DNS_FILTER_LISTS', '').strip()
 doh_canary_domains = ["use-application-dns.net"]
 doh_provider_domains = [
     "adblock.mydns.network", "cloudflare-dns.com", "commons.host",
@@ -43,31 +74,431 @@ doh_provider_domains = [
     "resolver-eu.lelux.fi", "security.cloudflare-dns.com",
     ]
 
+# binary protocol; must match /opt/dns-filter/protocol.py
+PROTOCOL_MAGIC = b'\xfeEF\x01'
+FRAME_HEADER = struct.Struct('!HIB')
+OP_QUERY = 0x01
+OP_CHECK_IPS = 0x02
+OP_ERROR = 0xff
+QUERY_REPLY = struct.Struct('!BI')
+FLAG_BLOCKED = 0x01
+FLAG_DISABLE_DOH = 0x02
+FLAG_CHECK_IPS = 0x04
+IP_CHECK_HEADER = struct.Struct('!B')
+MAX_IP_CHECK = 255
 
-def _check_for_socket():
-    global sock_exist
-    for _ in range(4):
+# prefilter format; must match /opt/dns-filter/prefilter.py
+PREFILTER_MAGIC = b'EMEBLOOM'
+PREFILTER_VERSION = 1
+PREFILTER_HEADER = struct.Struct('=8sIIIIQ16s')
+PREFILTER_STATE = struct.Struct('=II')  # flags, generation
+PREFILTER_STATE_OFFSET = 12
+PREFILTER_DISABLE_DOH = 0x01
+PREFILTER_DIGEST = struct.Struct('<QQ')
+
+# one connection per unbound thread
+_local = threading.local()
+_cache = None
+_next_sock_check = 0
+_prefilter = None
+_next_prefilter_check = 0
+# the generation the daemon last answered with, and when
+_daemon_generation = None
+_daemon_generation_seen = 0
+# whether the daemon last said it has IP lists to check answers against
+_daemon_checks_ips = True
+
+
+class FilterError(Exception):
+    pass
+
+
+class FilterConnection(object):
+    """
+    A long-lived connection to the filter daemon. Requests may be pipelined
+    with send() and their replies collected by id with receive().
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(sock_timeout)
+        self.sock.connect(path)
+        self.sock.sendall(PROTOCOL_MAGIC)
+        self.next_id = 0
+        self.buf = b''
+        self.replies = {}
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, op, payload):
+        self.next_id = (self.next_id + 1) & 0xffffffff
+        self.sock.sendall(
+            FRAME_HEADER.pack(len(payload), self.next_id, op) + payload)
+        return self.next_id
+
+    def receive(self, request_id):
+        while request_id not in self.replies:
+            self._read_frames()
+        op, payload = self.replies.pop(request_id)
+        if op == OP_ERROR:
+            raise FilterError(payload.decode('utf-8', 'replace'))
+        return payload
+
+    def request(self, op, payload):
+        return self.receive(self.send(op, payload))
+
+    def _read_frames(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error("Connection closed by filter daemon")
+        self.buf += data
+        offset = 0
+        while len(self.buf) - offset >= FRAME_HEADER.size:
+            length, request_id, op = FRAME_HEADER.unpack_from(self.buf, offset)
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buf) < end:
+                break
+            self.replies[request_id] = (
+                op, self.buf[offset + FRAME_HEADER.size:end])
+            offset = end
+        self.buf = self.buf[offset:]
+
+
+class Prefilter(object):
+    """
+    A read-only mapping of the Bloom filter published by the daemon.
+    """
+    def __init__(self, path):
+        prefilter = open(path, 'rb')
+        try:
+            self.inode = os.fstat(prefilter.fileno()).st_ino
+            self.mapping = mmap.mmap(
+                prefilter.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            prefilter.close()
+        if len(self.mapping) < PREFILTER_HEADER.size:
+            raise ValueError("Truncated prefilter")
+        magic, version, _, _, self.hashes, self.bits, _ = \
+            PREFILTER_HEADER.unpack_from(self.mapping)
+        if magic != PREFILTER_MAGIC or version != PREFILTER_VERSION or \
+                len(self.mapping) != PREFILTER_HEADER.size + self.bits // 8:
+            raise ValueError("Unsupported prefilter")
+
+    def state(self):
+        """
+        Returns (flags, generation); the daemon updates them in place.
+        """
+        return PREFILTER_STATE.unpack_from(
+            self.mapping, PREFILTER_STATE_OFFSET)
+
+    def might_block(self, name):
+        """
+        False if neither the name nor any of its parent domains is listed.
+        """
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        mapping = self.mapping
+        bits = self.bits
+        hashes = range(self.hashes)
+        start = PREFILTER_HEADER.size
+        while b'.' in name:
+            h1, h2 = PREFILTER_DIGEST.unpack(md5(name).digest())
+            h2 |= 1
+            for i in hashes:
+                position = (h1 + i * h2) % bits
+                offset = start + (position >> 3)
+                if not ord(mapping[offset:offset + 1]) & (1 << (position & 7)):
+                    break
+            else:
+                return True
+            name = name[name.find(b'.') + 1:]
+        return False
+
+
+def _get_prefilter():
+    global _prefilter, _next_prefilter_check
+    now = time()
+    if now >= _next_prefilter_check:
+        _next_prefilter_check = now + prefilter_recheck_interval
+        try:
+            inode = os.stat(prefilter_file).st_ino
+        except OSError:
+            _prefilter = None
+        else:
+            if _prefilter is None or _prefilter.inode != inode:
+                # the old mapping may still be in use by other threads; it
+                # is unmapped once they are done with it
+                try:
+                    _prefilter = Prefilter(prefilter_file)
+                except (IOError, OSError, ValueError, struct.error):
+                    _prefilter = None
+    return _prefilter
+
+
+def _check_for_socket(tries=4):
+    global sock_exist, _next_sock_check
+    for attempt in range(tries):
         if os.path.exists(sock_file):
             sock_exist = True
             break
-        sleep(0.25)
+        if attempt + 1 < tries:
+            sleep(0.25)
+    _next_sock_check = time() + sock_recheck_interval
 
 
-def _is_blocked(name):
-    while True:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+class VerdictCache(object):
+    """
+    A bounded LRU of (is_blocked, disable_doh) verdicts keyed by name, shared
+    by all unbound threads. Entries expire after `ttl` seconds, and each is
+    kept with the filter list generation it came from: only those of the
+    current one are served.
+
+    Generations are checksums, not counters, so the ones moved on from are
+    remembered instead; a reply carrying one of them (from a thread that
+    asked before a reload, or a worker yet to catch up) isn't cached, nor
+    does it take the cache back.
+    """
+    RETIRED = 16
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.generation = None
+        self.retired = deque(maxlen=self.RETIRED)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _move_to(self, generation):
+        if generation == self.generation:
+            return
+        if self.generation is not None:
+            self.retired.append(self.generation)
+        self.generation = generation
+        self.entries.clear()
+
+    def advance(self, generation):
+        """
+        Makes `generation`, the one the daemon says it now serves (through
+        the prefilter), the current one, even if it had been moved on from.
+        """
+        with self.lock:
+            if generation in self.retired:
+                self.retired.remove(generation)
+            self._move_to(generation)
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is None or entry[0] < time() or \
+                    entry[2] != self.generation:
+                return None
+            # re-insert to mark as most recently used
+            self.entries[name] = entry
+            return entry[1]
+
+    def put(self, name, verdict, generation):
+        with self.lock:
+            if generation is None:
+                # not told (the JSON protocol): only the ttl applies
+                generation = self.generation
+            elif generation in self.retired:
+                return
+            self._move_to(generation)
+            self.entries.pop(name, None)
+            self.entries[name] = (time() + self.ttl, verdict, generation)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def _mark_socket_gone():
+    global sock_exist, _next_sock_check
+    sock_exist = False
+    _next_sock_check = time() + sock_recheck_interval
+
+
+def _get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = FilterConnection(sock_file)
+    return conn
+
+
+def _drop_connection():
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None:
+        conn.close()
+
+
+def _query_json(name):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
         sock.connect(sock_file)
-        sock.sendall(json.dumps({'domain': name}))
-        resp = str(sock.recv(2048))
-        return json.loads(resp)
+        request = {'domain': name}
+        if block_lists:
+            request['lists'] = block_lists.split(',')
+        sock.sendall(json.dumps(request).encode('utf-8'))
+        resp = sock.recv(2048)
+    finally:
+        sock.close()
+    # the JSON protocol doesn't tell us the generation
+    is_blocked, disable_doh = json.loads(resp.decode('utf-8'))
+    return (is_blocked, disable_doh), None
+
+
+def _request(op, payload):
+    """
+    Sends a binary request; returns the flags and generation replied with.
+    """
+    global _daemon_checks_ips
+    # a stale connection (e.g. the daemon restarted) gets one fresh retry
+    for attempt in (1, 2):
+        try:
+            reply = _get_connection().request(op, payload)
+            break
+        except (socket.error, socket.timeout):
+            _drop_connection()
+            if attempt == 2:
+                raise
+    flags, generation = QUERY_REPLY.unpack_from(reply)
+    _daemon_checks_ips = bool(flags & FLAG_CHECK_IPS)
+    return flags, generation
+
+
+def _query(name):
+    """
+    Asks the daemon about a name; returns the verdict and the generation of
+    the list that answered.
+    """
+    if not use_binary_protocol:
+        return _query_json(name)
+    payload = name.encode('utf-8')
+    if block_lists:
+        payload += b'\n' + block_lists.encode('utf-8')
+    flags, generation = _request(OP_QUERY, payload)
+    verdict = (bool(flags & FLAG_BLOCKED), bool(flags & FLAG_DISABLE_DOH))
+    return verdict, generation
+
+
+def _answer_addresses(qstate):
+    """
+    The addresses of the A records in the answer, packed.
+    """
+    addresses = []
+    if qstate.return_msg is None or qstate.return_msg.rep is None:
+        return addresses
+    rep = qstate.return_msg.rep
+    for i in range(rep.an_numrrsets):
+        rrset = rep.rrsets[i]
+        if rrset.rk.type != RR_TYPE_A:
+            continue
+        data = rrset.entry.data
+        for j in range(data.count):
+            # prefixed by its length
+            rdata = data.rr_data[j]
+            if len(rdata) == 6:
+                addresses.append(rdata[2:])
+    return addresses[:MAX_IP_CHECK]
+
+
+def _addresses_blocked(addresses):
+    """
+    Asks the daemon whether any of the (packed) addresses is on an IP list,
+    all of them in one request.
+    """
+    payload = IP_CHECK_HEADER.pack(len(addresses)) + b''.join(addresses)
+    if block_lists:
+        payload += block_lists.encode('utf-8')
+    flags, _ = _request(OP_CHECK_IPS, payload)
+    return bool(flags & FLAG_BLOCKED)
+
+
+def _intercept(id, qstate):
+    """
+    Answers the query with our intercept address.
+    """
+    msg = DNSMessage(qstate.qinfo.qname_str, RR_TYPE_A,
+                     RR_CLASS_IN, PKT_QR | PKT_RA | PKT_AA)
+    if (qstate.qinfo.qtype == RR_TYPE_A) or (
+            qstate.qinfo.qtype == RR_TYPE_ANY):
+        msg.answer.append(
+            "%s 10 IN A %s" % (qstate.qinfo.qname_str,
+                               intercept_address))
+
+    if not msg.set_return_msg(qstate):
+        qstate.ext_state[id] = MODULE_ERROR
+        return True
+
+    qstate.return_msg.rep.security = 2
+
+    qstate.return_rcode = RCODE_NOERROR
+    qstate.ext_state[id] = MODULE_FINISHED
+    return True
+
+
+def _check_answer(id, qstate):
+    """
+    Intercepts a resolved answer if any of its addresses is blocked.
+    """
+    addresses = _answer_addresses(qstate)
+    if not addresses:
+        return False
+    try:
+        blocked = _addresses_blocked(addresses)
+    except socket.error:
+        _mark_socket_gone()
+        return False
+    except FilterError:
+        return False
+    if not blocked:
+        return False
+    _intercept(id, qstate)
+    if qstate.ext_state[id] == MODULE_FINISHED:
+        # the iterator cached the real answer; serve ours from the cache
+        # instead until it expires
+        storeQueryInCache(qstate, qstate.qinfo, qstate.return_msg.rep, 0)
+    return True
+
+
+def _is_blocked(name):
+    global _daemon_generation, _daemon_generation_seen
+    if use_prefilter:
+        prefilter = _get_prefilter()
+        if prefilter is not None:
+            flags, generation = prefilter.state()
+            if _cache is not None:
+                # the daemon stamps it as soon as it reloads or takes a
+                # delta, so verdicts of the old list go before any query
+                _cache.advance(generation)
+            # a filter the daemon has moved on from may lack new entries
+            if generation == _daemon_generation and \
+                    time() < _daemon_generation_seen + \
+                    prefilter_trust_interval and \
+                    not prefilter.might_block(name):
+                return False, bool(flags & PREFILTER_DISABLE_DOH)
+    if _cache is not None:
+        verdict = _cache.get(name)
+        if verdict is not None:
+            return verdict
+    verdict, generation = _query(name)
+    if generation is not None:
+        _daemon_generation = generation
+        _daemon_generation_seen = time()
+    if _cache is not None:
+        _cache.put(name, verdict, generation)
+    return verdict
 
 
 def init(id, cfg):
+    global _cache
     _check_for_socket()
+    if cache_size > 0:
+        _cache = VerdictCache(cache_size, cache_ttl)
     return True
 
 
 def deinit(id):
+    _drop_connection()
     return True
 
 
@@ -78,13 +509,27 @@ def inform_super(id, qstate, superqstate, qdata):
 def operate(id, event, qstate, qdata):
     if (event == MODULE_EVENT_NEW) or (event == MODULE_EVENT_PASS):
 
+        # the daemon may have (re)started since we last looked
+        if not sock_exist and time() >= _next_sock_check:
+            _check_for_socket(tries=1)
+
         # server isn't running? do nothing
         if not sock_exist:
             qstate.ext_state[id] = MODULE_WAIT_MODULE
             return True
 
         name = qstate.qinfo.qname_str.rstrip('.')
-        is_blocked, disable_doh = _is_blocked(name)
+        try:
+            is_blocked, disable_doh = _is_blocked(name)
+        except socket.error:
+            # the daemon went away; let the query through and look for it
+            # again later
+            _mark_socket_gone()
+            qstate.ext_state[id] = MODULE_WAIT_MODULE
+            return True
+        except FilterError:
+            qstate.ext_state[id] = MODULE_WAIT_MODULE
+            return True
 
         if disable_doh:
             if name in doh_canary_domains:
@@ -103,25 +548,13 @@ def operate(id, event, qstate, qdata):
             return True
 
         # otherwise, respond with our intercept address
-        msg = DNSMessage(qstate.qinfo.qname_str, RR_TYPE_A,
-                         RR_CLASS_IN, PKT_QR | PKT_RA | PKT_AA)
-        if (qstate.qinfo.qtype == RR_TYPE_A) or (
-                qstate.qinfo.qtype == RR_TYPE_ANY):
-            msg.answer.append(
-                "%s 10 IN A %s" % (qstate.qinfo.qname_str,
-                                   intercept_address))
-
-        if not msg.set_return_msg(qstate):
-            qstate.ext_state[id] = MODULE_ERROR
-            return True
-
-        qstate.return_msg.rep.security = 2
-
-        qstate.return_rcode = RCODE_NOERROR
-        qstate.ext_state[id] = MODULE_FINISHED
-        return True
+        return _intercept(id, qstate)
 
     elif event == MODULE_EVENT_MODDONE:
+        # the answer may point somewhere on an IP list
+        if check_answers and use_binary_protocol and sock_exist and \
+                _daemon_checks_ips and _check_answer(id, qstate):
+            return True
         qstate.ext_state[id] = MODULE_FINISHED
         return True
 